@@ -1,10 +1,18 @@
 #!/usr/bin/python
 
+from enum import Enum
+
 import typer
 
 EPILOG = "Docs: <https://dbworkload.github.io/dbworkload/>"
 
 
+class Sketch(str, Enum):
+    tdigest = "tdigest"
+    hdr = "hdr"
+    ddsketch = "ddsketch"
+
+
 class Param:
     LogLevel = typer.Option(
         "info", "--log-level", "-l", show_choices=True, help="Set the logging level."
@@ -19,3 +27,14 @@ class Param:
     )
 
     CSVMaxRows = typer.Option(100000, help="Max count of rows per resulting CSV file.")
+
+    Sketch = typer.Option(
+        Sketch.tdigest,
+        "--sketch",
+        help=(
+            "Latency sketch: 'hdr' keeps all quantiles within 1.6% "
+            "(0.5us below 64us) up to 9.5 hours, 'ddsketch' within 1% over a "
+            "5e8 ratio between the lowest and highest latency, including the "
+            "extreme tail."
+        ),
+    )
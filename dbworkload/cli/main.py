@@ -92,12 +92,19 @@ import pandas as pd
 import typer
 import yaml
 
-from dbworkload.cli.dep import EPILOG, Param
+from dbworkload.cli.dep import EPILOG, Param, Sketch
 from dbworkload.cli.util import util_app
 from dbworkload.commands.run import run as multiprocessing_run_workload
+from dbworkload.commands.run_asyncio import ASYNCIO_DRIVERS
+from dbworkload.commands.run_asyncio import run as asyncio_run_workload
 from dbworkload.commands.run_gil_free import run as gil_free_run_workload
+from dbworkload.commands.run_hybrid import run as hybrid_run_workload
 from dbworkload.connection import ConnInfo
 from dbworkload.utils import common
+from dbworkload.utils.pool import POOL_DRIVERS
+from dbworkload.utils.prepared import PSYCOPG_OPTIONS
+from dbworkload.utils.results import require_pyarrow
+from dbworkload.utils.retry import RetryPolicy
 
 from .. import __version__
 
@@ -115,6 +122,7 @@ class Driver(str, Enum):
     spanner = "spanner"
     pinecone = "pinecone"
     foundationdb = "foundationdb"
+    mock = "mock"
 
 
 app = typer.Typer(
@@ -136,9 +144,38 @@ class LogLevel(str, Enum):
     error = "error"
 
 
+class ArrivalDist(str, Enum):
+    constant = "constant"
+    poisson = "poisson"
+
+
+class RateLimiter(str, Enum):
+    token_bucket = "token-bucket"
+    pause = "pause"
+
+
+class Affinity(str, Enum):
+    none = "none"
+    cores = "cores"
+    numa = "numa"
+
+
+class RetryJitter(str, Enum):
+    equal = "equal"
+    full = "full"
+    none = "none"
+
+
+class SaveFormat(str, Enum):
+    csv = "csv"
+    parquet = "parquet"
+
+
 class Runtime(str, Enum):
     multiprocessing = "multiprocessing"
     gil_free = "gil-free"
+    asyncio = "asyncio"
+    hybrid = "hybrid"
 
 
 @app.command(help="Run the workload.", epilog=EPILOG, no_args_is_help=True)
@@ -192,6 +229,28 @@ def run(
         show_default=False,
         help="Set the max-rate to have dbworkload manage concurrency. Defaults to None.",
     ),
+    rate_limiter: RateLimiter = typer.Option(
+        RateLimiter.token_bucket,
+        "--rate-limiter",
+        help="How --max-rate is enforced: a token bucket drawn before every cycle, or a pause between cycles adjusted at every stats report.",
+    ),
+    co_correction: bool = typer.Option(
+        False,
+        "--co-correction",
+        show_default=False,
+        help="With --max-rate, run each worker on a fixed schedule and record __response__ latency from the intended start of each cycle.",
+    ),
+    arrival_rate: float = typer.Option(
+        None,
+        "--arrival-rate",
+        show_default=False,
+        help="Run open-loop: start cycles at this rate per second, no matter how fast the database responds. Defaults to None.",
+    ),
+    arrival_dist: ArrivalDist = typer.Option(
+        ArrivalDist.constant,
+        "--arrival-dist",
+        help="Distribution of the time between arrivals for --arrival-rate.",
+    ),
     conn_duration: int = typer.Option(
         None,
         "-k",
@@ -229,6 +288,11 @@ def run(
         show_default=False,
         help="Save stats to CSV files.",
     ),
+    save_format: SaveFormat = typer.Option(
+        SaveFormat.csv,
+        "--save-format",
+        help="Format of the files of --save: 'parquet' requires pyarrow.",
+    ),
     schedule: str = typer.Option(
         None,
         "--schedule",
@@ -251,10 +315,88 @@ def run(
         26160,
         "--control-port",
         help=(
-            "HTTP control port for --runtime gil-free. "
+            "HTTP control port for --runtime gil-free and hybrid. "
             "Use GET /?adjust_count=<integer> to add/remove connections."
         ),
     ),
+    affinity: Affinity = typer.Option(
+        Affinity.none,
+        "--affinity",
+        help=(
+            "Pin each supervisor process, or each group of worker threads for "
+            "--runtime gil-free, to a set of cores, or to the cores of a NUMA node."
+        ),
+    ),
+    reserved_cores: int = typer.Option(
+        0,
+        "--reserved-cores",
+        help="Count of cores reserved for the coordinator and the Prometheus server.",
+    ),
+    preconnect: bool = typer.Option(
+        False,
+        "--preconnect",
+        show_default=False,
+        help=(
+            "Open the connections of the first schedule row before starting "
+            "the workload, so that connecting is not part of the measurements."
+        ),
+    ),
+    connect_rate: float = typer.Option(
+        0,
+        "--connect-rate",
+        help="Maximum count of new connections per second. 0 means unlimited.",
+    ),
+    pool_size: int = typer.Option(
+        0,
+        "--pool-size",
+        help=(
+            "Share a pool of this many connections across all workers, which "
+            "check out a connection for every cycle. 0 means one connection per worker."
+        ),
+    ),
+    pipeline: bool = typer.Option(
+        False,
+        "--pipeline",
+        show_default=False,
+        help=(
+            "Send the consecutive @pipelineable functions of a cycle together, "
+            "in a psycopg pipeline."
+        ),
+    ),
+    max_retries: int = typer.Option(
+        3,
+        "--max-retries",
+        help="Count of retries of a transaction failed by a retryable error.",
+    ),
+    retry_backoff: float = typer.Option(
+        0.1,
+        "--retry-backoff",
+        help="Base backoff in seconds, doubled for every retry of a transaction.",
+    ),
+    retry_backoff_max: float = typer.Option(
+        5.0,
+        "--retry-backoff-max",
+        help="Maximum backoff in seconds before a retry.",
+    ),
+    retry_jitter: RetryJitter = typer.Option(
+        RetryJitter.equal,
+        "--retry-jitter",
+        help="Randomize the backoff: 'equal' keeps at least half of it, 'full' all of it.",
+    ),
+    retry_budget: float = typer.Option(
+        0,
+        "--retry-budget",
+        help=(
+            "Maximum ratio of retries to transactions, eg 0.1 for 10%. "
+            "0 means unlimited."
+        ),
+    ),
+    sketch: Sketch = Param.Sketch,
+    quantiles: str = typer.Option(
+        "50,90,95,99,100",
+        "--quantiles",
+        help="Comma separated percentiles of the latency to report, eg 50,99,99.9,100.",
+    ),
     log_level: LogLevel = Param.LogLevel,
 ):
     logger.setLevel(log_level.upper())
@@ -288,6 +430,9 @@ def run(
             )
 
         if driver == "postgres":
+            # the psycopg options are not conninfo parameters
+            uri, options = common.pop_query_parameters(uri, PSYCOPG_OPTIONS)
+            conn_info.extras.update(options)
             conn_info.params["conninfo"] = uri
 
         elif driver == "mongo":
@@ -303,6 +448,11 @@ def run(
             if parse_result.path and parse_result.path != "/":
                 conn_info.params.setdefault("cluster_file", unquote(parse_result.path))
 
+        elif driver == "mock":
+            conn_info.params.update(
+                {k: v[-1] for k, v in parse_qs(parse_result.query).items() if v}
+            )
+
     else:
         # if not, the uri is a string like
         # 'user=user1,password=password1,host=localhost,port=3306,database=bank'
@@ -318,6 +468,10 @@ def run(
     if driver == "postgres":
         conn_info.params["autocommit"] = autocommit
 
+        for k in PSYCOPG_OPTIONS:
+            if k in conn_info.params:
+                conn_info.extras[k] = conn_info.params.pop(k)
+
     if driver in ["mysql", "maria"]:
         conn_info.params["autocommit"] = autocommit
 
@@ -349,6 +503,49 @@ def run(
     if driver == "oracle":
         conn_info.extras["autocommit"] = autocommit
 
+    if runtime == Runtime.asyncio and driver not in ASYNCIO_DRIVERS:
+        logger.error(
+            f"The asyncio runtime does not support driver '{driver}'. "
+            f"Supported drivers: {', '.join(ASYNCIO_DRIVERS)}"
+        )
+        sys.exit(1)
+
+    if arrival_rate and max_rate:
+        logger.error("--arrival-rate cannot be combined with --max-rate")
+        sys.exit(1)
+
+    if pipeline and (runtime == Runtime.asyncio or driver != "postgres"):
+        logger.error(
+            "--pipeline is only supported by the postgres driver, "
+            "and not by the asyncio runtime"
+        )
+        sys.exit(1)
+
+    if pool_size:
+        if runtime == Runtime.asyncio:
+            logger.error("--pool-size is not supported by the asyncio runtime")
+            sys.exit(1)
+
+        if driver not in POOL_DRIVERS:
+            logger.error(
+                f"--pool-size is not supported for driver '{driver}'. "
+                f"Supported drivers: {', '.join(POOL_DRIVERS)}"
+            )
+            sys.exit(1)
+
+    try:
+        quantiles = common.parse_quantiles(quantiles)
+    except ValueError as e:
+        logger.error(e)
+        sys.exit(1)
+
+    if save and save_format == SaveFormat.parquet:
+        try:
+            require_pyarrow()
+        except RuntimeError as e:
+            logger.error(e)
+            sys.exit(1)
+
     args = load_args(args)
 
     histogram_bins = histogram_bins.split(",")
@@ -357,6 +554,8 @@ def run(
     run_impl = {
         Runtime.multiprocessing: multiprocessing_run_workload,
         Runtime.gil_free: gil_free_run_workload,
+        Runtime.asyncio: asyncio_run_workload,
+        Runtime.hybrid: hybrid_run_workload,
     }[runtime]
 
     run_args = [
@@ -380,10 +579,33 @@ def run(
         log_level.upper(),
     ]
 
-    if runtime == Runtime.gil_free:
-        run_args.append(control_port)
+    run_kwargs = {
+        "co_correction": co_correction,
+        "arrival_rate": arrival_rate,
+        "arrival_dist": arrival_dist.value,
+        "rate_limiter": rate_limiter.value,
+        "affinity": affinity.value,
+        "reserved_cores": reserved_cores,
+        "preconnect": preconnect,
+        "connect_rate": connect_rate,
+        "pool_size": pool_size,
+        "pipeline": pipeline,
+        "retry_policy": RetryPolicy(
+            max_retries=max_retries,
+            backoff=retry_backoff,
+            backoff_max=retry_backoff_max,
+            jitter=retry_jitter.value,
+            budget=retry_budget,
+        ),
+        "sketch_name": sketch.value,
+        "quantiles": quantiles,
+        "save_format": save_format.value,
+    }
+
+    if runtime in [Runtime.gil_free, Runtime.hybrid]:
+        run_kwargs["control_port"] = control_port
 
-    run_impl(*run_args)
+    run_impl(*run_args, **run_kwargs)
 
 
 def get_app_name(driver: str):
@@ -403,6 +625,8 @@ def get_app_name(driver: str):
         return
     elif driver == "foundationdb":
         return
+    elif driver == "mock":
+        return
 
 
 def load_args(args: str):
@@ -7,7 +7,7 @@ from typing import Optional
 
 import typer
 
-from dbworkload.cli.dep import EPILOG, Param
+from dbworkload.cli.dep import EPILOG, Param, Sketch
 from dbworkload.commands import util as util_commands
 
 try:
@@ -186,14 +186,14 @@ def util_sort_merge(
     "plot",
     epilog=EPILOG,
     no_args_is_help=True,
-    help="Plot charts from the dbworkload statistics CSV file.",
+    help="Plot charts from the dbworkload statistics CSV or parquet file.",
 )
 def util_plot(
     input: Optional[Path] = typer.Option(
         ...,
         "--input",
         "-i",
-        help="Input CSV file",
+        help="Input CSV or parquet file",
         exists=True,
         file_okay=True,
         dir_okay=False,
@@ -209,14 +209,14 @@ def util_plot(
     "html",
     epilog=EPILOG,
     no_args_is_help=True,
-    help="Save charts to HTML from the dbworkload statistics CSV file.",
+    help="Save charts to HTML from the dbworkload statistics CSV or parquet file.",
 )
 def util_html(
     input: Optional[Path] = typer.Option(
         ...,
         "--input",
         "-i",
-        help="Input CSV file",
+        help="Input CSV or parquet file",
         exists=True,
         file_okay=True,
         dir_okay=False,
@@ -232,14 +232,14 @@ def util_html(
     "merge_csvs",
     epilog=EPILOG,
     no_args_is_help=True,
-    help="Merge multiple dbworkload statistic CSV files.",
+    help="Merge multiple dbworkload statistic CSV or parquet files.",
 )
 def util_merge_csvs(
     input_dir: Optional[Path] = typer.Option(
         ...,
         "--input_dir",
         "-i",
-        help="Input CSV directory",
+        help="Input CSV and parquet directory",
         exists=True,
         file_okay=False,
         dir_okay=True,
@@ -247,8 +247,9 @@ def util_merge_csvs(
         readable=True,
         resolve_path=True,
     ),
+    sketch: Sketch = Param.Sketch,
 ):
-    util_commands.util_merge_csvs(input_dir)
+    util_commands.util_merge_csvs(input_dir, sketch.value)
 
 
 @util_app.command(
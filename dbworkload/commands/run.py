@@ -1,6 +1,7 @@
 #!/usr/bin/python
 
 import errno
+import heapq
 import logging
 import math
 import multiprocessing as mp
@@ -11,16 +12,50 @@ import signal
 import sys
 import time
 import traceback
-from contextlib import contextmanager
+from collections import deque
+from contextlib import contextmanager, nullcontext
 from dataclasses import dataclass
 from threading import Lock, Thread
 
-import numpy as np
 import tabulate
 from psutil import cpu_percent, virtual_memory
 
 from dbworkload.connection import ConnInfo
-from dbworkload.utils.common import Prom, Stats, WorkerStats, import_class_at_runtime
+from dbworkload.utils import sketch
+from dbworkload.utils.affinity import (
+    format_cpulist,
+    plan_affinity,
+    run_pinned,
+    set_affinity,
+)
+from dbworkload.utils.arrival import Dispatcher
+from dbworkload.utils.clients import ClientCache
+from dbworkload.utils.common import (
+    DEFAULT_QUANTILES,
+    Prom,
+    Stats,
+    SupervisorStats,
+    WorkerStats,
+    import_class_at_runtime,
+    quantile_label,
+)
+from dbworkload.utils.control import (
+    make_control_handler,
+    start_control_server,
+    stop_control_servers,
+)
+from dbworkload.utils.pipeline import iter_batches
+from dbworkload.utils.pool import Pool, create_pool, get_saturation
+from dbworkload.utils.prepared import (
+    PreparedCounters,
+    configure_connection,
+    get_prepared_counter,
+    merge_prepared_counters,
+)
+from dbworkload.utils.ratelimit import RATE_LIMITER_BURST, TokenBucket
+from dbworkload.utils.results import ReportWriter, create_result_writer
+from dbworkload.utils.retry import Retrier, RetryPolicy, merge_counters
+from dbworkload.utils.shm import ControlBlock, StatsRing
 
 # from cassandra.cluster import Cluster, ExecutionProfile, EXEC_PROFILE_DEFAULT, Session
 # from cassandra.policies import (
@@ -32,9 +67,10 @@ from dbworkload.utils.common import Prom, Stats, WorkerStats, import_class_at_ru
 
 
 DEFAULT_SLEEP = 3
-MAX_RETRIES = 3
 FREQUENCY = 10
 STATS_BUFFER = 8
+SUPERVISOR_STATS_DELAY = STATS_BUFFER // 2
+FINAL_STATS_TIMEOUT = 5
 
 DBWORKLOAD_PIPE = "dbworkload.pipe"
 FOUNDATIONDB_DEFAULT_API_VERSION = 730
@@ -43,62 +79,58 @@ logger = logging.getLogger("dbworkload")
 _foundationdb_api_version = None
 _foundationdb_api_version_lock = Lock()
 
+# the clients shared by the workers of this process, see SHARED_CLIENT_DRIVERS
+shared_clients = ClientCache()
+
 MAX_RATE_LOWER_BAND = 0.90
 MAX_RATE_UPPER_BAND = 1.10
 MAX_RATE_MASSIVE_OVERSHOOT = 2.0
 MAX_RATE_ADJUSTMENT_COOLDOWN = 60
 MAX_RATE_MAX_CYCLE_PAUSE = 1.0
 MAX_RATE_EWMA_ALPHA = 0.40
+TOKEN_BUCKET_ADJUSTMENT_COOLDOWN = 2 * FREQUENCY
 
 sigterm_received = False
 
-HEADERS: list = [
-    "elapsed",
-    "id",
-    "threads",
-    "tot_ops",
-    "tot_ops/s",
-    "period_ops",
-    "period_ops/s",
-    "mean(ms)",
-    "p50(ms)",
-    "p90(ms)",
-    "p95(ms)",
-    "p99(ms)",
-    "max(ms)",
-]
-
-HEADERS_CSV: list = [
-    "ts",
-    "elapsed",
-    "id",
-    "threads",
-    "tot_ops",
-    "tot_ops_s",
-    "period_ops",
-    "period_ops_s",
-    "mean_ms",
-    "p50_ms",
-    "p90_ms",
-    "p95_ms",
-    "p99_ms",
-    "max_ms",
-    "centroids",
-]
-
-FINAL_HEADERS: list = [
-    "elapsed",
-    "id",
-    "threads",
-    "tot_ops",
-    "tot_ops/s",
-    "mean(ms)",
-    "p50(ms)",
-    "p90(ms)",
-    "p95(ms)",
-    "p99(ms)",
-    "max(ms)",
-]
+
+def get_headers(quantiles: list = DEFAULT_QUANTILES) -> list:
+    """Return the headers of the stats report tables."""
+    return [
+        "elapsed",
+        "id",
+        "threads",
+        "tot_ops",
+        "tot_ops/s",
+        "period_ops",
+        "period_ops/s",
+        "mean(ms)",
+    ] + [f"{quantile_label(x)}(ms)" for x in quantiles]
+
+
+def get_final_headers(quantiles: list = DEFAULT_QUANTILES) -> list:
+    """Return the headers of the summary of the whole run."""
+    return [
+        "elapsed",
+        "id",
+        "threads",
+        "tot_ops",
+        "tot_ops/s",
+        "mean(ms)",
+    ] + [f"{quantile_label(x)}(ms)" for x in quantiles]
+
+
+def get_prepared_report(counters: dict[str, list]) -> str:
+    """Return the prepared statement hits of the whole run by txn, as a table."""
+    return tabulate.tabulate(
+        [
+            [name, executed, hits, 100 * hits / executed if executed else 0]
+            for name, (executed, hits) in sorted(counters.items())
+        ],
+        ["txn", "statements", "prepared_hits", "hits(%)"],
+        tablefmt="simple_outline",
+        intfmt=",",
+        floatfmt=",.2f",
+    )
 
 
 @dataclass
@@ -148,27 +180,75 @@ def signal_handler(sig, frame):
     sigterm_received = True
 
 
-def cycle(iterable, backwards=False):
-    global current_proc
+class WorkerPlacement:
+    """Track the workers of each supervisor, to keep them balanced.
 
-    if not backwards:
-        current_proc += 1
-        return current_proc % iterable
-    else:
-        v = current_proc % iterable
-        current_proc -= 1
-        return v
+    The live count of each supervisor follows the `init`, `got_killed` and
+    `task_done` messages of its workers. Workers requested but not started
+    yet, and stops requested but not done yet, are counted too, so that a
+    burst of requests is spread before the workers report back.
+
+    Workers are always added to the least loaded supervisor and removed from
+    the most loaded one.
+    """
+
+    def __init__(self, procs: int):
+        self.lock = Lock()
+        self.live = [0] * procs
+        self.starting = [0] * procs
+        self.stopping = [0] * procs
+
+    def load(self, x: int) -> int:
+        return self.live[x] + self.starting[x] - self.stopping[x]
+
+    def add(self) -> int:
+        """Return the supervisor the next worker should be added to."""
+        with self.lock:
+            x = min(range(len(self.live)), key=self.load)
+            self.starting[x] += 1
+            return x
+
+    def remove(self) -> int | None:
+        """Return the supervisor to remove a worker from, if any is left."""
+        with self.lock:
+            x = max(range(len(self.live)), key=self.load)
+            if self.load(x) <= 0:
+                return None
+
+            self.stopping[x] += 1
+            return x
+
+    def started(self, x: int) -> None:
+        with self.lock:
+            self.live[x] += 1
+            self.starting[x] = max(0, self.starting[x] - 1)
+
+    def stopped(self, x: int) -> None:
+        """A worker stopped on request, see remove()."""
+        with self.lock:
+            self.live[x] = max(0, self.live[x] - 1)
+            self.stopping[x] = max(0, self.stopping[x] - 1)
+
+    def finished(self, x: int) -> None:
+        """A worker returned on its own, with no stop requested."""
+        with self.lock:
+            self.live[x] = max(0, self.live[x] - 1)
+
+    def get_distribution(self) -> list:
+        with self.lock:
+            return list(self.live)
 
 
 # Launch or kill worker threads based on cc_change value.
-# workers are added or removed evenly across all supervisors.
+# workers are added to the least loaded supervisor, and removed from the
+# most loaded one, see WorkerPlacement.
 # If a ramp time is specified, threads creation or destruction
 # will be paced accordingly.
 def launch_or_kill_workers(
     queues: list,
     ramp_time: int,
     cc_change: int,
-    proc_len: list,
+    placement: WorkerPlacement,
     iterations_per_thread,
     concurrency,
 ):
@@ -180,7 +260,7 @@ def launch_or_kill_workers(
 
     if cc_change > 0:
         for _ in range(cc_change):
-            queues[cycle(proc_len)].put(
+            queues[placement.add()].put(
                 (
                     thread_id,
                     iterations_per_thread,
@@ -192,7 +272,11 @@ def launch_or_kill_workers(
 
     if cc_change < 0:
         for _ in range(abs(cc_change)):
-            queues[cycle(proc_len, backwards=True)].put("kill_one")
+            x = placement.remove()
+            if x is None:
+                return
+
+            queues[x].put("kill_one")
             time.sleep(ramp_interval)
 
 
@@ -215,40 +299,60 @@ def run(
     histogram_bins: list,
     delay_stats: int,
     log_level: str,
+    co_correction: bool = False,
+    arrival_rate: float = None,
+    arrival_dist: str = "constant",
+    rate_limiter: str = "token-bucket",
+    control_port: int = 0,
+    affinity: str = "none",
+    reserved_cores: int = 0,
+    preconnect: bool = False,
+    connect_rate: float = 0,
+    pool_size: int = 0,
+    pipeline: bool = False,
+    retry_policy: RetryPolicy = None,
+    sketch_name: str = "tdigest",
+    quantiles: list = None,
+    save_format: str = "csv",
+    supervisor_target=None,
 ):
     def gracefully_shutdown():
         logger.debug("Gracefully shutting down...")
 
         end_time = int(time.time())
         _stats_received = stats_received
+        worker_distribution = placement.get_distribution()
+
+        stop_control_servers(control_servers)
 
         # notify all Supervisors to quit
         for q in queues.values():
             q.put("poison_pill")
 
-        # wait for supervisors to quit and drain
-        # the to_main_q at the same time to avoid locking
+        # wait for supervisors to quit and drain the to_main_q
+        # and the stats rings at the same time to avoid locking
         for x in supervisors.values():
             while x.is_alive():
                 try:
                     msg = to_main_q.get(block=True, timeout=0.5)
-                    if isinstance(msg, list):
-                        _stats_received += 1
-                        stats.add_tds(msg)
+                    if isinstance(msg, tuple) and msg[0] == "metrics":
+                        supervisor_metrics[msg[1]] = msg[2]
                 except queue.Empty:
                     pass
+                _stats_received += drain_rings()
 
             x.join()
 
         # Catch all for loose stats, if any?
-        while True:
-            try:
-                msg = to_main_q.get(block=False)
-                if isinstance(msg, list):
-                    _stats_received += 1
-                    stats.add_tds(msg)
-            except queue.Empty:
-                break
+        _stats_received += drain_rings()
+        check_rings()
+        check_supervisor_metrics()
+
+        for r in rings.values():
+            r.close()
+
+        for c in controls.values():
+            c.close()
 
         cpu_util = cpu_percent()
         vmem = virtual_memory().percent
@@ -261,18 +365,12 @@ def run(
         report = stats.calculate_stats(active_connections, end_time - delay_stats)
         centroids = stats.get_centroids()
 
-        if save:
-            with open(run_name + ".csv", "a") as f:
-                for row in report:
-                    f.write(str(stats.endtime) + ",")
-                    for col in row:
-                        f.write(str(col) + ",")
-                    np.savetxt(f, next(centroids), newline=";")
-                    f.write("\n")
-
         if not quiet:
             logger.info("Printing final stats")
-            print_stats(report)
+
+        # wait for the reports of all windows to be saved and printed
+        reporter.put(stats.endtime, report, centroids)
+        reporter.close()
 
         prom.publish(report)
 
@@ -281,12 +379,19 @@ def run(
         # the final stat report summarizes the entire test run
         final_stats_report = tabulate.tabulate(
             stats.calculate_final_stats(active_connections, stats.endtime),
-            FINAL_HEADERS,
+            get_final_headers(stats.quantiles),
             tablefmt="simple_outline",
             intfmt=",",
             floatfmt=",.2f",
         )
 
+        # the prepared statement hits, with the psycopg options
+        prepared = merge_prepared_counters(
+            [x.get("prepared", {}) for x in supervisor_metrics.values()]
+        )
+        if prepared:
+            final_stats_report += "\n\n" + get_prepared_report(prepared)
+
         # Print test run details
         runtime_params = tabulate.tabulate(
             [
@@ -299,6 +404,21 @@ def run(
                 ["ramp", ramp],
                 ["args", args],
                 ["delay_stats", delay_stats],
+                ["co_correction", co_correction],
+                ["arrival_rate", arrival_rate],
+                ["arrival_dist", arrival_dist],
+                ["rate_limiter", rate_limiter],
+                ["control_port", control_port],
+                ["affinity", affinity],
+                ["reserved_cores", reserved_cores],
+                ["preconnect", preconnect],
+                ["connect_rate", connect_rate],
+                ["pool_size", pool_size],
+                ["pipeline", pipeline],
+                ["retry_policy", retry_policy],
+                ["sketch", sketch_name],
+                ["quantiles", stats.quantiles],
+                ["save_format", save_format],
             ],
             headers=["Parameter", "Value"],
         )
@@ -312,6 +432,10 @@ def run(
                 ],
                 ["end_time", time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(end_time))],
                 ["test_duration", int(end_time - start_time)],
+                [
+                    "workers_per_supervisor",
+                    ", ".join(str(x) for x in worker_distribution),
+                ],
             ],
         )
 
@@ -350,6 +474,9 @@ def run(
 
     logger.setLevel(log_level)
 
+    # the supervisors send their stats as sketches of this backend
+    sketch.set_backend(sketch_name)
+
     start_time = int(time.time())
     workload = import_class_at_runtime(workload_path)
 
@@ -365,26 +492,204 @@ def run(
     # to send the stat report, so they all send it at the same time
     offset = start_time % FREQUENCY
 
-    # open a new csv file and just write the header columns
+    # validate the options before the results file is created, so that a
+    # wrong option doesn't leave an empty one behind
+    if arrival_rate and (max_rate or any(x[1] for x in schedule or [])):
+        logger.error("--arrival-rate cannot be combined with --max-rate")
+        sys.exit(1)
+
+    # pin the MainProcess to the reserved cores before starting the Prometheus
+    # server, so its thread runs there too. Supervisors are pinned at start.
+    try:
+        reserved, core_sets = plan_affinity(affinity, procs, reserved_cores)
+    except ValueError as e:
+        logger.error(e)
+        sys.exit(1)
+
+    if reserved:
+        logger.info(f"MainProcess pinned to cores {format_cpulist(reserved)}")
+        set_affinity(reserved)
+
+    writer = None
     if save:
-        with open(run_name + ".csv", "w") as f:
-            f.write(",".join(HEADERS_CSV) + "\n")
+        writer = create_result_writer(
+            save_format,
+            run_name,
+            quantiles,
+            sketch_name,
+            metadata={
+                "run_name": run_name,
+                "workload_path": workload_path,
+                "start_time": start_time,
+                "driver": driver,
+                "concurrency": concurrency,
+                "duration": duration,
+                "iterations": iterations,
+                "args": args,
+            },
+        )
 
-    # register Ctrl+C handler
-    signal.signal(signal.SIGINT, signal_handler)
+    stats = Stats(start_time, quantiles)
 
-    stats = Stats(start_time)
+    # the reports are saved and printed off the MainThread, which drains the
+    # stats of the supervisors
+    reporter = ReportWriter(
+        writer, None if quiet else lambda report: print_stats(report, stats.quantiles)
+    )
 
     prom = Prom(prom_port, stats, histogram_bins)
 
     to_main_q = mp.Queue()
+
+    def wake_up_signal_handler(sig, frame):
+        signal_handler(sig, frame)
+
+        # the MainThread blocks on to_main_q until the next deadline:
+        # wake it up so it handles the signal right away
+        to_main_q.put("wake_up")
+
+    # register Ctrl+C handler
+    signal.signal(signal.SIGINT, wake_up_signal_handler)
     cycle_pause = mp.Value("d", 0.0)
+    cycle_interval = mp.Value("d", 0.0)
+
+    # with the token-bucket rate limiter, the max-rate of the current schedule
+    # row. Every supervisor limits its workers to its share of this rate.
+    rate_limit = mp.Value("d", 0.0) if rate_limiter == "token-bucket" else None
+
+    # with --arrival-rate or the token-bucket rate limiter, every supervisor
+    # serves its share of the rate, which is proportional to its count of
+    # workers. Each supervisor is the only writer of its own slot.
+    worker_counts = mp.RawArray("i", procs)
+
+    # with --preconnect, workers wait for this Event once connected,
+    # so that no cycle starts until all connections are established
+    connect_gate = mp.Event() if preconnect else None
+
+    # the latest arrival and connection pool metrics of each supervisor
+    supervisor_metrics: dict[int, dict] = {}
+    arrival_dropped = 0
 
     global queues
     global supervisors
     supervisors = {}
     queues = {}
 
+    # stats reports are merged by each supervisor and travel to the MainProcess
+    # through a shared memory ring per supervisor, while to_main_q
+    # only carries the low volume control messages.
+    rings: dict[int, StatsRing] = {}
+    ring_counters: dict[int, dict] = {}
+
+    # the stop flags of the workers of each supervisor
+    controls: dict[int, ControlBlock] = {}
+
+    def drain_rings() -> int:
+        return sum(r.drain(stats.add_tds) for r in rings.values())
+
+    def check_rings() -> None:
+        # report backpressure and overflows since the last check.
+        # A ring overflow doesn't lose data: the supervisor keeps its window
+        # and sends it along with the next stats report. Backpressure alone is
+        # expected when a flush has more txn ids than the ring has slots.
+        for x, r in rings.items():
+            counters = r.get_counters()
+            previous = ring_counters.get(x, {})
+            if any(
+                counters[k] > previous.get(k, 0) for k in ["backpressure", "overflows"]
+            ):
+                log = (
+                    logger.warning
+                    if counters["overflows"] > previous.get("overflows", 0)
+                    else logger.debug
+                )
+                log(
+                    f"Supervisor-{x} stats ring is falling behind: "
+                    f"backpressure={counters['backpressure']}, "
+                    f"overflows={counters['overflows']}, "
+                    f"high_watermark={counters['high_watermark']}/{r.slots}"
+                )
+            ring_counters[x] = counters
+
+        prom.publish_metrics(
+            {
+                f"stats_ring_{k}": sum(x[k] for x in ring_counters.values())
+                for k in ["backpressure", "overflows"]
+            }
+        )
+
+    def check_supervisor_metrics() -> None:
+        nonlocal arrival_dropped
+
+        if not supervisor_metrics:
+            return
+
+        totals = {
+            k: sum(x[k] for x in supervisor_metrics.values())
+            for k in next(iter(supervisor_metrics.values()))
+            if k not in ["retries", "prepared"]
+        }
+
+        # the retry and prepared statement counters are cumulative, by txn
+        retries = merge_counters(
+            [x.get("retries", {}) for x in supervisor_metrics.values()]
+        )
+        if retries:
+            prom.publish_retries(retries)
+
+        prepared = merge_prepared_counters(
+            [x.get("prepared", {}) for x in supervisor_metrics.values()]
+        )
+        if prepared:
+            prom.publish_prepared(prepared)
+
+        if "arrival_dropped" in totals:
+            if totals["arrival_dropped"] > arrival_dropped:
+                logger.warning(
+                    f"Arrival backlog is full, {totals['arrival_dropped'] - arrival_dropped} "
+                    f"cycles were dropped: backlog={totals['arrival_backlog']}. "
+                    "Consider adding workers with --concurrency."
+                )
+            arrival_dropped = totals["arrival_dropped"]
+
+        if "pool_size" in totals:
+            totals["pool_saturation"] = get_saturation(totals)
+            logger.debug(f"pool metrics: {totals}")
+
+        prom.publish_metrics(totals)
+
+    def report_window() -> list:
+        """Aggregate, print, save and publish the stats of the last window."""
+        nonlocal stats_received
+
+        check_rings()
+        check_supervisor_metrics()
+
+        cpu_util = cpu_percent()
+        vmem = virtual_memory().percent
+        if stats_received != active_connections or cpu_util > 70 or vmem > 70:
+            logger.warning(
+                f"{stats_received=}, expected={active_connections}. CPU Util={cpu_util}%, Memory={vmem}%"
+            )
+
+        # remove the STATS_BUFFER seconds added
+        endtime = int(time.time() - delay_stats) - STATS_BUFFER
+
+        report = stats.calculate_stats(active_connections, endtime)
+
+        centroids = stats.get_centroids()
+
+        stats.new_window(endtime)
+        stats_received = 0
+
+        reporter.put(stats.endtime, report, centroids)
+
+        prom.publish(report)
+
+        return report
+
+    placement = WorkerPlacement(procs)
+
     # start a separate thread for messages coming in via the pipe
     # echo 5 > dbworkload.pipe # create 5 more connections
     Thread(
@@ -393,7 +698,7 @@ def run(
         args=(
             queues,
             0,
-            procs,
+            placement,
             None,
             concurrency,
         ),
@@ -402,11 +707,22 @@ def run(
     # launch supervisors in a dedicated OS process
     for x in range(procs):
         queues[x] = mp.Queue()
+        rings[x] = StatsRing()
+        controls[x] = ControlBlock()
+        if core_sets:
+            logger.info(
+                f"Supervisor-{x} pinned to cores {format_cpulist(core_sets[x])}"
+            )
+
         supervisors[x] = mp.Process(
-            target=supervisor,
+            target=run_pinned,
             args=(
+                core_sets[x] if core_sets else None,
+                supervisor_target or supervisor,
                 to_main_q,
                 queues[x],
+                rings[x],
+                controls[x],
                 log_level,
                 conn_info,
                 driver,
@@ -416,6 +732,18 @@ def run(
                 offset,
                 x,
                 cycle_pause,
+                cycle_interval,
+                arrival_rate,
+                arrival_dist,
+                worker_counts,
+                rate_limit,
+                co_correction,
+                connect_gate,
+                connect_rate,
+                math.ceil(pool_size / procs),
+                pipeline,
+                retry_policy,
+                sketch_name,
             ),
             daemon=True,
         )
@@ -430,14 +758,14 @@ def run(
     active_connections = 0
     stats_received = 0
 
-    global current_proc
     global thread_id
 
-    current_proc = -1
     current_cc = 0
     thread_id = 0
     worker_adjustment_thread = None
     max_rate_state = MaxRateControllerState()
+    control_lock = Lock()
+    control_servers = []
 
     def set_cycle_pause(pause: float) -> None:
         # Workers run in supervisor processes, so the pause must be process
@@ -450,7 +778,24 @@ def run(
         with cycle_pause.get_lock():
             return cycle_pause.value
 
-    def request_worker_target(target_cc: int, ramp_time: int) -> bool:
+    def set_cycle_interval() -> None:
+        # With --co-correction and the pause rate limiter, max-rate is enforced
+        # by having each worker start a cycle every current_cc / max_rate
+        # seconds. Knowing when a cycle was supposed to start lets workers
+        # measure the response time of the cycles that got delayed by a slow
+        # database. The token bucket provides that start time by itself.
+        with cycle_interval.get_lock():
+            if co_correction and not rate_limit and max_rate and current_cc:
+                cycle_interval.value = current_cc / max_rate
+            else:
+                cycle_interval.value = 0
+
+    def set_rate_limit() -> None:
+        if rate_limit:
+            with rate_limit.get_lock():
+                rate_limit.value = max_rate or 0
+
+    def request_worker_target_unlocked(target_cc: int, ramp_time: int) -> bool:
         nonlocal current_cc, worker_adjustment_thread
 
         target_cc = max(0, target_cc)
@@ -469,15 +814,29 @@ def run(
                 queues,
                 ramp_time,
                 cc_change,
-                procs,
+                placement,
                 iterations_per_thread,
                 concurrency,
             ),
         )
         worker_adjustment_thread.start()
         current_cc = target_cc
+        set_cycle_interval()
         return True
 
+    def request_worker_target(target_cc: int, ramp_time: int) -> bool:
+        # the schedule, max-rate and the HTTP control server can all request
+        # worker count changes: serialize them so current_cc stays accurate
+        with control_lock:
+            return request_worker_target_unlocked(target_cc, ramp_time)
+
+    def request_worker_adjustment(adjust_count: int) -> tuple[bool, int, int]:
+        with control_lock:
+            previous_target = current_cc
+            target_cc = max(0, previous_target + adjust_count)
+            changed = request_worker_target_unlocked(target_cc, 0)
+            return changed, previous_target, target_cc
+
     def cooldown_expired() -> bool:
         return time.time() >= max_rate_state.next_worker_adjustment_time
 
@@ -487,9 +846,14 @@ def run(
         # ramp_time covers the period where the requested change is still being
         # applied. Per-cycle pause remains adjustable during this period because
         # it is reversible and does not change connection count.
-        max_rate_state.next_worker_adjustment_time = (
-            time.time() + MAX_RATE_ADJUSTMENT_COOLDOWN + ramp_time
-        )
+        # The token bucket never lets the rate overshoot, so there is no risk
+        # of flapping and one clean stats window is enough.
+        if rate_limit:
+            cooldown = TOKEN_BUCKET_ADJUSTMENT_COOLDOWN
+        else:
+            cooldown = MAX_RATE_ADJUSTMENT_COOLDOWN
+
+        max_rate_state.next_worker_adjustment_time = time.time() + cooldown + ramp_time
 
     def get_cycle_rate(report: list) -> int:
         for row in report:
@@ -602,7 +966,45 @@ def run(
             max_rate_state.next_worker_adjustment_time,
         )
 
+    def apply_token_bucket_control(
+        target_rate: int, report: list, ramp_time: int
+    ) -> None:
+        """Add workers when they can't drain the token bucket.
+
+        The token bucket caps the rate of every supervisor within a fraction of
+        a second, so there is no overshoot to correct. The only decision left is
+        whether there are enough workers to draw tokens at target_rate.
+        """
+        current_rate = get_cycle_rate(report)
+
+        if current_rate >= target_rate * MAX_RATE_LOWER_BAND or not cooldown_expired():
+            return
+
+        if current_rate > 0:
+            per_worker_rate = current_rate / max(1, current_cc)
+            target_cc = max(current_cc + 1, math.ceil(target_rate / per_worker_rate))
+        else:
+            target_cc = current_cc + 1
+
+        previous_cc = current_cc
+        if not request_worker_target(target_cc, ramp_time):
+            return
+
+        record_worker_adjustment(ramp_time)
+        logger.warning(
+            "Increasing workers for max_rate: desired max_rate: %s, "
+            "current_rate: %s, current_cc: %s, target_cc: %s, cooldown_until: %.2f",
+            target_rate,
+            current_rate,
+            previous_cc,
+            target_cc,
+            max_rate_state.next_worker_adjustment_time,
+        )
+
     iterations_per_thread = None
+    if co_correction and not max_rate and not any(x[1] for x in schedule or []):
+        logger.warning("--co-correction has no effect without --max-rate")
+
     if iterations:
         # ensure we don't create more threads than the total number of iterations requested.
         # eg. we don't need 8 threads if iterations is 4: we only need 4 threads
@@ -618,123 +1020,176 @@ def run(
     if schedule is None:
         schedule = [(concurrency, max_rate, ramp, duration)]
 
-    # loop through all lines in the schedule
-    for i, s in enumerate(schedule):
-        cc, max_rate, ramp_time, dur = s
-        cc = int(cc or 0)
-        max_rate = int(max_rate or 0)
-        ramp_time = int(ramp_time or 0)
-        dur = int(dur or 0)
-
-        # sanitize
-        if dur and ramp_time > dur:
-            ramp_time = dur
-
-        logger.info(
-            f"Starting schedule {i+1}/{len(schedule)}: {cc=}, {max_rate=}, {ramp_time=}, {dur=}"
-        )
-
-        # always make sure that a duration is specified, even if none was passed
-        # in which case it defaults to infinite
-        end_schedule_time = time.time() + dur if dur else float("inf")
+    # gracefully_shutdown() closes the reporter, unless the run stops early,
+    # e.g. on a second Ctrl+C: close it anyway, as parquet results are only
+    # readable once closed
+    try:
+        if control_port:
+            control_servers = start_control_server(
+                control_port,
+                make_control_handler(
+                    request_worker_adjustment,
+                    lambda: current_cc,
+                    lambda: active_connections,
+                ),
+                "Coordinator",
+            )
 
-        if worker_adjustment_thread and worker_adjustment_thread.is_alive():
-            worker_adjustment_thread.join()
+        if preconnect:
+            # open the connections of the first schedule row before any
+            # measurement, paced by --connect-rate if set
+            cc = int(schedule[0][0] or 0) or 1
+            logger.info(
+                f"Pre-connecting {cc} connections"
+                + (f" at {connect_rate}/s" if connect_rate else "")
+            )
 
-        set_cycle_pause(0)
-        max_rate_state.reset()
+            request_worker_target(cc, 0)
+            connected = 0
 
-        # If max_rate is provided without an explicit connection count, start
-        # with one probe worker. Once dbworkload has a measured __cycle__ rate,
-        # the controller can extrapolate how many workers are needed.
-        if max_rate and cc == 0:
-            worker_adjusted = request_worker_target(1, ramp_time)
-        else:
-            worker_adjusted = request_worker_target(cc, ramp_time)
-
-        # When a max-rate row also provides an explicit connection count, the
-        # initial ramp to that count should be treated as a worker adjustment.
-        # This prevents the controller from reacting to ramp-skewed stats with
-        # another add/remove decision. Target-only rows such as ",3000,0,60" do
-        # not wait here because the initial single worker is only a probe.
-        if max_rate and cc > 0 and worker_adjusted:
-            record_worker_adjustment(ramp_time)
+            while connected < cc:
+                try:
+                    msg = to_main_q.get(
+                        block=True, timeout=max(0, report_time - time.time())
+                    )
+                except queue.Empty:
+                    msg = None
 
-        task_done_threads = 0
-
-        # loop for the entire duration of the schedule's current line
-        while time.time() < end_schedule_time:
-            try:
-                # read from the queue for stats or completion messages
-                msg = to_main_q.get(block=False)
-                # a stats report is a list obj
-                if isinstance(msg, list):
-                    stats_received += 1
-                    stats.add_tds(msg)
-                elif msg == "init":
+                if isinstance(msg, tuple) and msg[0] == "connected":
+                    connected += 1
+                elif isinstance(msg, tuple) and msg[0] == "init":
                     active_connections += 1
-                elif msg == "got_killed":
-                    active_connections -= 1
-                elif msg == "task_done":
-                    task_done_threads += 1
+                    placement.started(msg[1])
+                elif isinstance(msg, tuple) and msg[0] == "metrics":
+                    supervisor_metrics[msg[1]] = msg[2]
                 elif isinstance(msg, Exception):
                     logger.error(f"error_type={msg.__class__.__name__}, {msg=}")
                     gracefully_shutdown()
-                else:
-                    logger.error(f"unrecognized message: {msg}")
+
+                stats_received += drain_rings()
+
+                if sigterm_received:
                     gracefully_shutdown()
 
-            except queue.Empty:
-                pass
+                # the __connect__ latencies are reported while connecting
+                if time.time() >= report_time:
+                    logger.info(
+                        f"Pre-connect: {connected}/{cc} connections established"
+                    )
+                    report_window()
+                    report_time += FREQUENCY
+
+            logger.info(f"Pre-connect: all {cc} connections established")
+            connect_gate.set()
+
+        # loop through all lines in the schedule
+        for i, s in enumerate(schedule):
+            cc, max_rate, ramp_time, dur = s
+            cc = int(cc or 0)
+            max_rate = int(max_rate or 0)
+            ramp_time = int(ramp_time or 0)
+            dur = int(dur or 0)
+
+            # sanitize
+            if dur and ramp_time > dur:
+                ramp_time = dur
+
+            logger.info(
+                f"Starting schedule {i+1}/{len(schedule)}: {cc=}, {max_rate=}, {ramp_time=}, {dur=}"
+            )
 
-            if sigterm_received:
-                gracefully_shutdown()
+            # always make sure that a duration is specified, even if none was passed
+            # in which case it defaults to infinite
+            end_schedule_time = time.time() + dur if dur else float("inf")
 
-            if task_done_threads > 0 and task_done_threads >= active_connections:
-                logger.info("Requested iteration/duration limit reached")
-                gracefully_shutdown()
+            if worker_adjustment_thread and worker_adjustment_thread.is_alive():
+                worker_adjustment_thread.join()
 
-            if time.time() >= report_time:
-                cpu_util = cpu_percent()
-                vmem = virtual_memory().percent
-                if stats_received != active_connections or cpu_util > 70 or vmem > 70:
-                    logger.warning(
-                        f"{stats_received=}, expected={active_connections}. CPU Util={cpu_util}%, Memory={vmem}%"
-                    )
+            set_cycle_pause(0)
+            set_rate_limit()
+            max_rate_state.reset()
+
+            # If max_rate is provided without an explicit connection count, start
+            # with one probe worker. Once dbworkload has a measured __cycle__ rate,
+            # the controller can extrapolate how many workers are needed.
+            if max_rate and cc == 0:
+                worker_adjusted = request_worker_target(1, ramp_time)
+            else:
+                worker_adjusted = request_worker_target(cc, ramp_time)
+
+            # When a max-rate row also provides an explicit connection count, the
+            # initial ramp to that count should be treated as a worker adjustment.
+            # This prevents the controller from reacting to ramp-skewed stats with
+            # another add/remove decision. Target-only rows such as ",3000,0,60" do
+            # not wait here because the initial single worker is only a probe.
+            if max_rate and cc > 0 and worker_adjusted:
+                record_worker_adjustment(ramp_time)
 
-                # remove the STATS_BUFFER seconds added
-                endtime = int(time.time() - delay_stats) - STATS_BUFFER
+            set_cycle_interval()
 
-                report = stats.calculate_stats(active_connections, endtime)
+            task_done_threads = 0
 
-                if max_rate and report:
-                    apply_max_rate_control(max_rate, report, ramp_time)
+            # loop for the entire duration of the schedule's current line.
+            # The loop blocks on to_main_q, so it wakes up on every message,
+            # and otherwise exactly at the next report or at the end of the row.
+            while time.time() < end_schedule_time:
+                try:
+                    # read from the queue for completion messages
+                    msg = to_main_q.get(
+                        block=True,
+                        timeout=max(
+                            0, min(report_time, end_schedule_time) - time.time()
+                        ),
+                    )
+                    # worker messages carry the id of their supervisor
+                    if isinstance(msg, tuple) and msg[0] == "init":
+                        active_connections += 1
+                        placement.started(msg[1])
+                    elif isinstance(msg, tuple) and msg[0] == "got_killed":
+                        active_connections -= 1
+                        placement.stopped(msg[1])
+                    elif isinstance(msg, tuple) and msg[0] == "task_done":
+                        task_done_threads += 1
+                        placement.finished(msg[1])
+                    elif isinstance(msg, tuple) and msg[0] == "metrics":
+                        supervisor_metrics[msg[1]] = msg[2]
+                    elif isinstance(msg, tuple) and msg[0] == "connected":
+                        pass
+                    elif msg == "wake_up":
+                        pass
+                    elif isinstance(msg, Exception):
+                        logger.error(f"error_type={msg.__class__.__name__}, {msg=}")
+                        gracefully_shutdown()
+                    else:
+                        logger.error(f"unrecognized message: {msg}")
+                        gracefully_shutdown()
 
-                centroids = stats.get_centroids()
+                except queue.Empty:
+                    pass
 
-                stats.new_window(endtime)
-                stats_received = 0
+                stats_received += drain_rings()
 
-                if save:
-                    with open(run_name + ".csv", "a") as f:
-                        for row in report:
-                            f.write(str(stats.endtime) + ",")
-                            for col in row:
-                                f.write(str(col) + ",")
-                            np.savetxt(f, next(centroids), newline=";")
-                            f.write("\n")
+                if sigterm_received:
+                    gracefully_shutdown()
 
-                if not quiet:
-                    print_stats(report)
+                if task_done_threads > 0 and task_done_threads >= active_connections:
+                    logger.info("Requested iteration/duration limit reached")
+                    gracefully_shutdown()
 
-                prom.publish(report)
+                if time.time() >= report_time:
+                    report = report_window()
 
-                report_time += FREQUENCY
+                    if max_rate and report:
+                        if rate_limit:
+                            apply_token_bucket_control(max_rate, report, ramp_time)
+                        else:
+                            apply_max_rate_control(max_rate, report, ramp_time)
 
-            # pause briefly to prevent the loop from overheating the CPU
-            time.sleep(0.001)
+                    report_time += FREQUENCY
 
-    gracefully_shutdown()
+        gracefully_shutdown()
+    finally:
+        reporter.close()
 
 
 # a supervisor runs in a separate process.
@@ -748,6 +1203,8 @@ def run(
 def supervisor(
     to_main_q: mp.Queue,
     from_main_q: mp.Queue,
+    ring: StatsRing,
+    control: ControlBlock,
     log_level: str,
     conn_info: ConnInfo,
     driver: str,
@@ -757,45 +1214,184 @@ def supervisor(
     offset: int,
     id: int,
     cycle_pause,
+    cycle_interval,
+    arrival_rate: float,
+    arrival_dist: str,
+    worker_counts,
+    rate_limit,
+    co_correction: bool,
+    connect_gate,
+    connect_rate: float,
+    pool_size: int,
+    pipeline: bool,
+    retry_policy: RetryPolicy,
+    sketch_name: str,
 ):
     logger.setLevel(log_level)
     logger.debug(f"Supervisor-{id} started")
 
-    threads: list[Thread] = []
-    from_proc_q = mp.Queue()
+    sketch.set_backend(sketch_name)
+
+    # worker threads by control block slot, in the order they were started
+    threads: dict[int, Thread] = {}
+
+    # the free control block slots as a heap, so the lowest is reused first,
+    # and the slots the workers hand back when they return
+    free_slots = list(range(control.slots))
+    returned_slots: deque[int] = deque()
+
+    # with --pool-size, the workers share the connections of this pool,
+    # which reconnects every --conn-duration
+    pool = None
+    if pool_size:
+        try:
+            pool = create_pool(driver, conn_info, pool_size, conn_duration)
+        except Exception:
+            to_main_q.put(Exception(traceback.format_exc()))
+            return
+
+    # the workers retry transactions with this policy, and count the retries
+    retrier = Retrier(driver, retry_policy)
+
+    # with the psycopg options, the workers count the prepared statement hits
+    prepared_counters = PreparedCounters()
+
+    # the worker threads hand their stats to the supervisor, which merges them
+    # and sends one report per txn id to the MainProcess
+    sup_stats = SupervisorStats()
+
+    def send_stats(timeout=None) -> None:
+        tds, flushes = sup_stats.merge_window()
+        if not flushes:
+            return
+
+        unsent = ring.put(
+            [(x, sketch.pairs(td)) for x, td in tds],
+            flushes,
+            timeout,
+            wake=lambda: to_main_q.put("wake_up"),
+        )
+        if unsent is not None:
+            # the ring is full: keep the rest of the window for the next report
+            sup_stats.restore(tds[len(tds) - unsent :], flushes)
+
+    def send_metrics() -> None:
+        metrics = {}
+        if dispatcher:
+            metrics.update(dispatcher.get_metrics())
+        if pool:
+            metrics.update(pool.get_metrics())
+        if retrier.counters:
+            metrics["retries"] = retrier.get_counters()
+        if prepared_counters.counters:
+            metrics["prepared"] = prepared_counters.get_counters()
+        if metrics:
+            to_main_q.put(("metrics", id, metrics))
+
+    # in open-loop mode, the workers take their cycles from the dispatcher
+    dispatcher = None
+    if arrival_rate:
+        dispatcher = Dispatcher(
+            arrival_rate,
+            arrival_dist,
+            share=lambda: worker_counts[id] / max(1, sum(worker_counts)),
+        )
+        dispatcher.start()
+
+    # with --max-rate, the workers draw a token from the bucket before every cycle
+    rate_limiter = None
+    if rate_limit:
+        rate_limiter = TokenBucket(
+            lambda: rate_limit.value * worker_counts[id] / max(1, sum(worker_counts)),
+            burst=None if co_correction else RATE_LIMITER_BURST,
+        )
+
+    # with --connect-rate, the workers draw a token before every connection.
+    # The workers are balanced across the supervisors, so each one gets an
+    # even share of the rate.
+    connect_limiter = None
+    if connect_rate:
+        connect_limiter = TokenBucket(lambda: connect_rate / len(worker_counts))
+
+    # send stats after all worker threads have sent theirs, but
+    # ahead of the MainProcess report time, see STATS_BUFFER
+    ts = int(time.time())
+    stat_time = ts + FREQUENCY - ts % FREQUENCY + offset + SUPERVISOR_STATS_DELAY
 
     # capture KeyboardInterrupt and do nothing
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
     while True:
-        msg = from_main_q.get(block=True)
+        try:
+            msg = from_main_q.get(block=True, timeout=max(0, stat_time - time.time()))
+        except queue.Empty:
+            msg = None
+
+        if time.time() >= stat_time:
+            send_stats()
+            stat_time += FREQUENCY
+
+            worker_counts[id] = sum(x.is_alive() for x in threads.values())
+
+            send_metrics()
+
+        if msg is None:
+            continue
 
         if msg == "poison_pill":
             logger.debug(f"Supervisor-{id} terminating...")
 
+            if dispatcher:
+                dispatcher.stop()
+
             # wait for Threads to return before
             # letting the Supervisor MainThread return
-            for x in threads:
-                if x.is_alive():
-                    from_proc_q.put("poison_pill")
+            control.shutdown()
 
-            for x in threads:
+            for x in threads.values():
                 if x.is_alive():
                     x.join()
 
+            # send the final stats and counters of all threads
+            send_stats(FINAL_STATS_TIMEOUT)
+            send_metrics()
+
+            if pool:
+                pool.close()
+
+            shared_clients.close()
+
             logger.debug(f"Supervisor-{id} terminated")
             return
 
         elif msg == "kill_one":
-            from_proc_q.put("poison_pill")
+            # stop the most recent worker still running
+            for slot, x in reversed(threads.items()):
+                if x.is_alive() and not control.is_stopped(slot):
+                    control.stop(slot)
+                    worker_counts[id] = max(0, worker_counts[id] - 1)
+                    break
 
         elif isinstance(msg, tuple):
+            # reuse the slots of the workers that returned
+            while returned_slots:
+                slot = returned_slots.popleft()
+                threads.pop(slot).join()
+                heapq.heappush(free_slots, slot)
+
+            slot = heapq.heappop(free_slots)
+            control.start(slot)
+
             t = Thread(
-                target=worker,
+                target=run_worker,
                 daemon=True,
                 args=(
+                    returned_slots,
+                    slot,
                     to_main_q,
-                    from_proc_q,
+                    control,
+                    slot,
+                    sup_stats,
                     log_level,
                     conn_info,
                     driver,
@@ -804,16 +1400,38 @@ def supervisor(
                     conn_duration,
                     offset,
                     cycle_pause,
+                    cycle_interval,
+                    dispatcher,
+                    rate_limiter,
+                    co_correction,
+                    connect_gate,
+                    connect_limiter,
+                    pool,
+                    pipeline,
+                    retrier,
+                    prepared_counters,
+                    id,
                     *msg,
                 ),
             )
             t.start()
-            threads.append(t)
+            threads[slot] = t
+            worker_counts[id] += 1
+
+
+def run_worker(returned_slots: deque, slot: int, *args) -> None:
+    """Run a worker, then hand its control block slot back to the supervisor."""
+    try:
+        worker(*args)
+    finally:
+        returned_slots.append(slot)
 
 
 def worker(
     to_main_q: mp.Queue,
-    from_proc_q: mp.Queue,
+    control: ControlBlock,
+    slot: int,
+    sup_stats: SupervisorStats,
     log_level: str,
     conn_info: ConnInfo,
     driver: str,
@@ -822,19 +1440,66 @@ def worker(
     conn_duration: int,
     offset: int,
     cycle_pause,
+    cycle_interval,
+    dispatcher: Dispatcher,
+    rate_limiter: TokenBucket,
+    co_correction: bool,
+    connect_gate,
+    connect_limiter: TokenBucket,
+    pool: Pool,
+    pipeline: bool,
+    retrier: Retrier,
+    prepared_counters: PreparedCounters,
+    supervisor_id: int,
     id: int = 0,
     iterations: int = 0,
     concurrency: int = 0,
 ):
     def gracefully_return(msg):
         # send final stats
-        to_main_q.put(ws.get_tdigest_ndarray(), block=False)
+        sup_stats.add_worker_stats(ws)
 
         # send notification to MainThread
-        to_main_q.put(msg)
+        to_main_q.put((msg, supervisor_id))
 
         logger.debug(f"Thread ID {id} returned")
 
+    def stop_requested() -> bool:
+        # only the generation word is read, unless the control block changed
+        nonlocal generation
+
+        if control.generation() == generation:
+            return False
+
+        generation = control.generation()
+        return control.is_stopped(slot)
+
+    def wait_until(deadline: int) -> bool:
+        # sleep until the perf_counter_ns deadline, while checking
+        # the control block. Returns False if the worker was stopped
+        while (remaining := (deadline - time.perf_counter_ns()) / 1e9) > 0:
+            if stop_requested():
+                return False
+
+            time.sleep(min(0.05, remaining))
+
+        return True
+
+    @contextmanager
+    def checkout(conn):
+        # with --pool-size, a connection is checked out of the pool for every
+        # cycle, and the time waited for it is reported as __pool_wait__
+        if not pool:
+            yield conn
+            return
+
+        start = time.perf_counter_ns()
+        with pool.connection() as pooled_conn:
+            ws.add_latency_measurement(
+                "__pool_wait__", (time.perf_counter_ns() - start) / 1e9
+            )
+            yield pooled_conn
+
     logger.setLevel(log_level)
 
     logger.debug(f"Thread ID {id} started")
@@ -855,58 +1520,88 @@ def worker(
 
     run_init = True
 
+    # the perf_counter_ns time the current cycle was scheduled to start at.
+    # Only used with --co-correction, see set_cycle_interval()
+    intended_start = 0
+
+    # the control block generation last seen.
+    # Start from -1 so the slot flag is checked at least once
+    generation = -1
+
     # send notification that a new thread has started
-    to_main_q.put("init")
+    to_main_q.put(("init", supervisor_id))
 
     while True:
-        # listen for termination messages (poison pill)
-        try:
-            from_proc_q.get(block=False)
-            logger.debug("Poison pill received, terminating...")
+        # check whether this worker was stopped
+        if stop_requested():
+            logger.debug("Stop requested, terminating...")
             gracefully_return("got_killed")
             return
-        except queue.Empty:
-            pass
 
         if conn_duration:
             # reconnect every conn_duration +/- 20%
             conn_endtime = time.time() + int(conn_duration * random.uniform(0.8, 1.2))
 
+        # with --connect-rate, wait for a connection token
+        if connect_limiter and not pool:
+            due = connect_limiter.reserve()
+            if due and not wait_until(due):
+                logger.debug("Stop requested, terminating...")
+                gracefully_return("got_killed")
+                return
+
         try:
             logger.debug(f"driver: {driver}, params: {conn_info.params}")
+            connect_start = time.perf_counter_ns()
             # with Cluster().connect('bank') as conn:
-            with get_connection(driver, conn_info) as conn:
+            with nullcontext() if pool else get_connection(driver, conn_info) as conn:
                 logger.debug("Connection started")
 
+                # __connect__ includes the reconnections due to --conn-duration
+                if not pool:
+                    ws.add_latency_measurement(
+                        "__connect__", (time.perf_counter_ns() - connect_start) / 1e9
+                    )
+
                 # execute setup() only once per thread
                 if run_init:
                     run_init = False
 
                     if hasattr(w, "setup") and callable(w.setup):
-                        run_transaction(
-                            conn,
-                            lambda conn: w.setup(
-                                conn,
-                                id,
-                                concurrency,
-                            ),
-                            driver,
-                            max_retries=MAX_RETRIES,
-                        )
+                        with checkout(conn) as setup_conn:
+                            run_transaction(
+                                setup_conn,
+                                lambda conn: w.setup(
+                                    conn,
+                                    id,
+                                    concurrency,
+                                ),
+                                retrier,
+                                "setup",
+                            )
+
+                # with --preconnect, hold until all workers are connected
+                if connect_gate and not connect_gate.is_set():
+                    sup_stats.add_worker_stats(ws)
+                    ws.new_window()
+                    to_main_q.put(("connected", supervisor_id))
+
+                    while not connect_gate.wait(0.05):
+                        if stop_requested():
+                            logger.debug("Stop requested, terminating...")
+                            gracefully_return("got_killed")
+                            return
 
                 # send stats
                 ts = int(time.time())
                 stat_time = ts + FREQUENCY - ts % FREQUENCY + offset
 
                 while True:
-                    # listen for termination messages (poison pill)
-                    try:
-                        from_proc_q.get(block=False)
-                        logger.debug("Poison pill received, terminating...")
+                    # check whether this worker was stopped
+                    if stop_requested():
+                        logger.debug("Stop requested, terminating...")
                         gracefully_return("got_killed")
                         return
-                    except queue.Empty:
-                        pass
 
                     # return if the iteration count has been reached
                     if iterations and c >= iterations:
@@ -922,62 +1617,123 @@ def worker(
                         )
                         break
 
-                    cycle_start = time.time()
-                    for txn in w.loop():
-                        start = time.time()
-                        retries = run_transaction(
-                            conn,
-                            lambda conn: txn(conn),
-                            driver,
-                            max_retries=MAX_RETRIES,
+                    if dispatcher:
+                        # open-loop: wait for the next arrival, the ticket
+                        # holds the time at which the cycle was due
+                        while not (intended_start := dispatcher.get()):
+                            if stop_requested():
+                                logger.debug("Stop requested, terminating...")
+                                gracefully_return("got_killed")
+                                return
+
+                        cycle_start = time.perf_counter_ns()
+                        ws.add_latency_measurement(
+                            "__queue__", (cycle_start - intended_start) / 1e9
                         )
+                    elif rate_limiter:
+                        # draw a token, and wait until it is due
+                        due = rate_limiter.reserve()
+                        if due and not wait_until(due):
+                            logger.debug("Stop requested, terminating...")
+                            gracefully_return("got_killed")
+                            return
+
+                        cycle_start = time.perf_counter_ns()
+                        intended_start = due if co_correction else 0
+                    else:
+                        with cycle_interval.get_lock():
+                            interval = cycle_interval.value
+
+                        cycle_start = time.perf_counter_ns()
+
+                        if not interval:
+                            intended_start = 0
+                        elif not intended_start:
+                            intended_start = cycle_start
+
+                    with checkout(conn) as cycle_conn:
+                        for txn in iter_batches(w.loop()) if pipeline else w.loop():
+                            if isinstance(txn, list):
+                                # a batch of pipelineable functions
+                                add_pipeline_measurements(
+                                    ws,
+                                    prepared_counters,
+                                    txn,
+                                    *run_pipeline(cycle_conn, txn, retrier),
+                                )
+                                continue
+
+                            # with the psycopg options, count the prepared statement hits
+                            prepared = get_prepared_counter(cycle_conn)
+                            if prepared:
+                                executed, hits = prepared.executed, prepared.hits
+
+                            start = time.perf_counter_ns()
+                            _, ok = run_transaction(
+                                cycle_conn,
+                                lambda conn: txn(conn),
+                                retrier,
+                                txn.__name__,
+                            )
 
-                        # record how many retries there were, if any
-                        for _ in range(retries):
-                            ws.add_latency_measurement("__retries__", 0)
+                            if prepared:
+                                prepared_counters.add(
+                                    txn.__name__,
+                                    prepared.executed - executed,
+                                    prepared.hits - hits,
+                                )
 
-                        # if retries matches max_retries, then it's a total failure and we don't record the txn time
-                        if retries < MAX_RETRIES:
-                            ws.add_latency_measurement(
-                                txn.__name__, time.time() - start
-                            )
+                            # if the retries were exhausted, then it's a total failure and we don't record the txn time
+                            if ok:
+                                ws.add_latency_measurement(
+                                    txn.__name__, (time.perf_counter_ns() - start) / 1e9
+                                )
 
                     c += 1
 
-                    ws.add_latency_measurement("__cycle__", time.time() - cycle_start)
+                    cycle_end = time.perf_counter_ns()
+
+                    # __cycle__ is the service time, measured from the actual start.
+                    # __response__ is measured from the scheduled start, so it
+                    # includes the time this cycle waited behind slower ones,
+                    # or in the arrivals backlog.
+                    ws.add_latency_measurement(
+                        "__cycle__", (cycle_end - cycle_start) / 1e9
+                    )
+                    if intended_start:
+                        ws.add_latency_measurement(
+                            "__response__", (cycle_end - intended_start) / 1e9
+                        )
 
-                    if to_main_q.full():
-                        logger.error("=========== Q FULL!!!! ======================")
                     if time.time() >= stat_time:
-                        to_main_q.put(ws.get_tdigest_ndarray(), block=False)
+                        sup_stats.add_worker_stats(ws)
                         ws.new_window()
                         stat_time += FREQUENCY
 
-                    # max-rate fine control is published by the main process in
-                    # a multiprocessing.Value so all supervisor processes see
-                    # the same value. Each worker reads it once per completed
-                    # workload cycle and sleeps outside the hot transaction
-                    # loop. This keeps throttling cooperative and makes
-                    # shutdown responsive to poison-pill messages.
-                    with cycle_pause.get_lock():
-                        pause = cycle_pause.value
-
-                    if pause:
-                        sleep_until = time.time() + pause
-                        while True:
-                            remaining = sleep_until - time.time()
-                            if remaining <= 0:
-                                break
-
-                            try:
-                                from_proc_q.get(block=False)
-                                logger.debug("Poison pill received, terminating...")
-                                gracefully_return("got_killed")
-                                return
-                            except queue.Empty:
-                                pass
-
-                            time.sleep(min(0.05, remaining))
+                    if dispatcher or rate_limiter:
+                        # the pace is set by the arrivals or the token bucket
+                        sleep_until = 0
+                    elif intended_start:
+                        # the next cycle is due one interval after this one was,
+                        # no matter how late this one actually started
+                        intended_start += int(interval * 1e9)
+                        sleep_until = intended_start
+                    else:
+                        # max-rate fine control is published by the main process in
+                        # a multiprocessing.Value so all supervisor processes see
+                        # the same value. Each worker reads it once per completed
+                        # workload cycle and sleeps outside the hot transaction
+                        # loop. This keeps throttling cooperative and makes
+                        # shutdown responsive to the control block.
+                        with cycle_pause.get_lock():
+                            pause = cycle_pause.value
+
+                        sleep_until = cycle_end + int(pause * 1e9) if pause else 0
+
+                    if sleep_until and not wait_until(sleep_until):
+                        logger.debug("Stop requested, terminating...")
+                        gracefully_return("got_killed")
+                        return
 
         except Exception as e:
             if driver == "postgres":
@@ -1029,7 +1785,7 @@ def worker(
                 return
 
 
-def listen_to_pipe(queues, ramp_time, procs, iterations_per_thread, concurrency):
+def listen_to_pipe(queues, ramp_time, placement, iterations_per_thread, concurrency):
     # https://stackoverflow.com/questions/39089776/python-read-named-pipe
 
     try:
@@ -1054,7 +1810,7 @@ def listen_to_pipe(queues, ramp_time, procs, iterations_per_thread, concurrency)
                         queues,
                         ramp_time,
                         t,
-                        procs,
+                        placement,
                         iterations_per_thread,
                         concurrency,
                     ),
@@ -1067,11 +1823,11 @@ def log_and_sleep(e: Exception):
     time.sleep(DEFAULT_SLEEP)
 
 
-def print_stats(report: list):
+def print_stats(report: list, quantiles: list = DEFAULT_QUANTILES):
     print(
         tabulate.tabulate(
             report,
-            HEADERS,
+            get_headers(quantiles),
             intfmt=",",
             floatfmt=",.2f",
         ),
@@ -1079,36 +1835,103 @@ def print_stats(report: list):
     )
 
 
-def run_transaction(conn, op, driver: str, max_retries=3):
+def run_transaction(conn, op, retrier: Retrier, name: str = "") -> tuple:
     """
-    Execute the operation *op(conn)* retrying serialization failure.
+    Execute the operation *op(conn)* retrying the retryable errors.
+
+    The errors are classified, and retried, by *retrier*, which counts the
+    retries of *name*. If the database returns an error asking to retry the
+    transaction, roll back and retry it until the policy or the budget of
+    *retrier* gives up, without propagating the error. Other errors are
+    propagated.
 
-    If the database returns an error asking to retry the transaction, retry it
-    *max_retries* times before giving up (and propagate it).
+    Returns the backoff seconds before each retry, and whether *op* succeeded.
     """
-    for retry in range(1, max_retries + 1):
+    delays = []
+    retrier.start()
+
+    while True:
         try:
             op(conn)
             # If we reach this point, we were able to commit, so we break
             # from the retry loop.
-            return retry - 1
+            return delays, True
         except Exception as e:
-            if driver == "postgres":
-                import psycopg.errors
-
-                if isinstance(e, psycopg.errors.SerializationFailure):
-                    # This is a retry error, so we roll back the current
-                    # transaction and sleep for a bit before retrying. The
-                    # sleep time increases for each failed transaction.
-                    logger.debug(f"SerializationFailure:: {e}")
-                    conn.rollback()
-                    time.sleep((2**retry) * 0.1 * (random.random() + 0.5))
-                else:
-                    raise e
-            else:
+            if not retrier.is_retryable(e):
                 raise e
-    logger.debug(f"Transaction did not succeed after {max_retries} retries")
-    return retry
+
+            # This is a retry error, so we roll back the current
+            # transaction and sleep for a bit before retrying. The
+            # sleep time increases for each failed transaction.
+            logger.debug(f"{e.__class__.__name__}:: {e}")
+            if hasattr(conn, "rollback"):
+                conn.rollback()
+
+            delay = retrier.next_delay(name, len(delays))
+            if delay is None:
+                logger.debug(f"Transaction did not succeed after {len(delays)} retries")
+                return delays, False
+
+            time.sleep(delay)
+            delays.append(delay)
+
+
+def run_pipeline(conn, txns: list, retrier: Retrier) -> tuple:
+    """
+    Execute the operations *txns* in a single psycopg pipeline, retrying
+    the whole batch as *run_transaction* does.
+
+    Returns whether the batch succeeded, then the perf_counter_ns time each operation was sent at with its
+    statements and prepared statement hits, and the time of the sync point
+    that returned the results of all of them.
+    """
+    sent = []
+
+    def op(conn):
+        sent.clear()
+        prepared = get_prepared_counter(conn)
+
+        with conn.pipeline() as p:
+            for txn in txns:
+                start = time.perf_counter_ns()
+                if not prepared:
+                    txn(conn)
+                    sent.append((start, 0, 0))
+                    continue
+
+                executed, hits = prepared.executed, prepared.hits
+                txn(conn)
+                sent.append((start, prepared.executed - executed, prepared.hits - hits))
+
+            p.sync()
+
+    _, ok = run_transaction(conn, op, retrier, "__pipeline__")
+    return ok, sent, time.perf_counter_ns()
+
+
+def add_pipeline_measurements(
+    ws: WorkerStats,
+    prepared_counters: PreparedCounters,
+    txns: list,
+    ok: bool,
+    sent: list,
+    end: int,
+) -> None:
+    """Record the results of *run_pipeline*.
+
+    Every operation is measured from the time it was sent to the sync point,
+    and the whole batch as __pipeline__.
+    """
+    if not ok:
+        return
+
+    for txn, (start, executed, hits) in zip(txns, sent):
+        if executed:
+            prepared_counters.add(txn.__name__, executed, hits)
+
+        ws.add_latency_measurement(txn.__name__, (end - start) / 1e9)
+
+    ws.add_latency_measurement("__pipeline__", (end - sent[0][0]) / 1e9)
 
 
 @contextmanager
@@ -1116,10 +1939,18 @@ def get_connection_with_context(driver: str, conn_info: ConnInfo):
     if driver == "spanner":
         from google.cloud import spanner
 
-        try:
-            yield spanner.Client().instance(conn_info.params["instance"]).database(
-                conn_info.params["database"]
+        def create():
+            # with pool_size, a fixed size session pool replaces the default one
+            pool_size = conn_info.params.get("pool_size")
+            client = spanner.Client()
+            database = client.instance(conn_info.params["instance"]).database(
+                conn_info.params["database"],
+                pool=spanner.FixedSizePool(size=int(pool_size)) if pool_size else None,
             )
+            return database, client.close
+
+        try:
+            yield shared_clients.get(driver, conn_info, create)
         except Exception as e:
             logger.error(e)
         finally:
@@ -1132,9 +1963,12 @@ def get_connection_with_context(driver: str, conn_info: ConnInfo):
         )
         configure_foundationdb_api_version(fdb, api_version)
 
-        cluster_file = conn_info.params.get("cluster_file")
-        db = fdb.open(cluster_file=cluster_file) if cluster_file else fdb.open()
-        yield db
+        def create():
+            cluster_file = conn_info.params.get("cluster_file")
+            db = fdb.open(cluster_file=cluster_file) if cluster_file else fdb.open()
+            return db, None
+
+        yield shared_clients.get(driver, conn_info, create)
 
 
 def configure_foundationdb_api_version(fdb, api_version: int):
@@ -1157,7 +1991,9 @@ def get_connection(driver: str, conn_info: ConnInfo):
     if driver == "postgres":
         import psycopg
 
-        return psycopg.connect(**conn_info.params, connect_timeout=5)
+        conn = psycopg.connect(**conn_info.params, connect_timeout=5)
+        configure_connection(conn, conn_info.extras)
+        return conn
     elif driver == "mysql":
         import mysql.connector
 
@@ -1177,13 +2013,37 @@ def get_connection(driver: str, conn_info: ConnInfo):
     elif driver == "mongo":
         import pymongo
 
-        return pymongo.MongoClient(**conn_info)
+        def create():
+            # with pool_size, it is the maxPoolSize of the client
+            params = dict(conn_info.params)
+            if "pool_size" in params:
+                params["maxPoolSize"] = int(params.pop("pool_size"))
+
+            client = pymongo.MongoClient(**params)
+            return client, client.close
+
+        # the shared client must not be closed when a worker is done with it
+        return nullcontext(shared_clients.get(driver, conn_info, create))
 
     elif driver == "pinecone":
         from pinecone import Pinecone
 
-        pc = Pinecone(api_key=conn_info.params["api_key"])
-        return pc.Index(conn_info.params["index_name"])
+        def create():
+            # with pool_size, it is the count of threads of the index client
+            pool_size = conn_info.params.get("pool_size")
+            pc = Pinecone(api_key=conn_info.params["api_key"])
+            index = pc.Index(
+                conn_info.params["index_name"],
+                **({"pool_threads": int(pool_size)} if pool_size else {}),
+            )
+            return index, getattr(index, "close", None)
+
+        return nullcontext(shared_clients.get(driver, conn_info, create))
+
+    elif driver == "mock":
+        from dbworkload.utils.mockdb import MockConnection
+
+        return MockConnection(**conn_info.params)
 
     else:
         return get_connection_with_context(driver, conn_info)
@@ -0,0 +1,655 @@
+#!/usr/bin/python
+
+"""asyncio runtime.
+
+The MainProcess is the same coordinator used by the multiprocessing runtime:
+schedules, max-rate, the pipe, stats aggregation and Prometheus publishing are
+all shared. Only the supervisors differ: rather than running one OS thread per
+connection, each supervisor runs an event loop driving many sessions, where a
+session is an asyncio task holding one async database connection.
+
+Workload classes can return `async def` functions from `loop()`, which are
+awaited. Regular functions are called from the event loop, so they must not
+block.
+"""
+
+import asyncio
+import heapq
+import inspect
+import logging
+import multiprocessing as mp
+import random
+import signal
+import time
+import traceback
+from threading import Thread
+
+from dbworkload.commands.run import (
+    DEFAULT_SLEEP,
+    FINAL_STATS_TIMEOUT,
+    FREQUENCY,
+    SUPERVISOR_STATS_DELAY,
+)
+from dbworkload.commands.run import run as multiprocessing_run
+from dbworkload.connection import ConnInfo
+from dbworkload.utils import sketch
+from dbworkload.utils.arrival import AsyncDispatcher
+from dbworkload.utils.common import SupervisorStats, WorkerStats
+from dbworkload.utils.prepared import (
+    PreparedCounters,
+    configure_connection,
+    get_prepared_counter,
+)
+from dbworkload.utils.ratelimit import RATE_LIMITER_BURST, TokenBucket
+from dbworkload.utils.retry import Retrier, RetryPolicy
+from dbworkload.utils.shm import ControlBlock, StatsRing
+
+logger = logging.getLogger("dbworkload")
+
+ASYNCIO_DRIVERS = ["postgres", "mock"]
+
+# waits shorter than this are plain sleeps, longer ones also watch
+# for the session to be stopped
+STOP_CHECK_INTERVAL = 0.05
+
+
+def run(*args, **kwargs):
+    """Run a workload with the asyncio runtime."""
+    multiprocessing_run(*args, supervisor_target=supervisor, **kwargs)
+
+
+def supervisor(
+    to_main_q: mp.Queue,
+    from_main_q: mp.Queue,
+    ring: StatsRing,
+    control: ControlBlock,
+    log_level: str,
+    conn_info: ConnInfo,
+    driver: str,
+    workload: object,
+    args: dict,
+    conn_duration: int,
+    offset: int,
+    id: int,
+    cycle_pause,
+    cycle_interval,
+    arrival_rate: float,
+    arrival_dist: str,
+    worker_counts,
+    rate_limit,
+    co_correction: bool,
+    connect_gate,
+    connect_rate: float,
+    pool_size: int,
+    pipeline: bool,
+    retry_policy: RetryPolicy,
+    sketch_name: str,
+):
+    logger.setLevel(log_level)
+    logger.debug(f"Supervisor-{id} started")
+
+    sketch.set_backend(sketch_name)
+
+    # capture KeyboardInterrupt and do nothing
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    asyncio.run(
+        supervise(
+            to_main_q,
+            from_main_q,
+            ring,
+            control,
+            log_level,
+            conn_info,
+            driver,
+            workload,
+            args,
+            conn_duration,
+            offset,
+            id,
+            cycle_pause,
+            cycle_interval,
+            arrival_rate,
+            arrival_dist,
+            worker_counts,
+            rate_limit,
+            co_correction,
+            connect_gate,
+            connect_rate,
+            pool_size,
+            pipeline,
+            retry_policy,
+        )
+    )
+
+    logger.debug(f"Supervisor-{id} terminated")
+
+
+async def supervise(
+    to_main_q: mp.Queue,
+    from_main_q: mp.Queue,
+    ring: StatsRing,
+    control: ControlBlock,
+    log_level: str,
+    conn_info: ConnInfo,
+    driver: str,
+    workload: object,
+    args: dict,
+    conn_duration: int,
+    offset: int,
+    id: int,
+    cycle_pause,
+    cycle_interval,
+    arrival_rate: float,
+    arrival_dist: str,
+    worker_counts,
+    rate_limit,
+    co_correction: bool,
+    connect_gate,
+    connect_rate: float,
+    pool_size: int,
+    pipeline: bool,
+    retry_policy: RetryPolicy,
+):
+    loop = asyncio.get_running_loop()
+
+    # sessions by control block slot, in the order they were started, with
+    # the Event used to stop each of them. The Event also interrupts waits,
+    # the control block keeps the stop flags visible to the MainProcess.
+    sessions: dict[int, tuple[asyncio.Task, asyncio.Event]] = {}
+
+    # the free control block slots as a heap, so the lowest is reused first,
+    # and the slots of the sessions that returned
+    free_slots = list(range(control.slots))
+    returned_slots: list[int] = []
+
+    # from_main_q is a multiprocessing.Queue, so it is read from a thread
+    # and its messages are handed over to the event loop
+    messages = asyncio.Queue()
+
+    def listen() -> None:
+        while True:
+            msg = from_main_q.get()
+            loop.call_soon_threadsafe(messages.put_nowait, msg)
+            if msg == "poison_pill":
+                return
+
+    Thread(target=listen, daemon=True).start()
+
+    sup_stats = SupervisorStats()
+
+    retrier = Retrier(driver, retry_policy)
+
+    # with the psycopg options, the sessions count the prepared statement hits
+    prepared_counters = PreparedCounters()
+
+    def send_stats(timeout=None) -> None:
+        tds, flushes = sup_stats.merge_window()
+        if not flushes:
+            return
+
+        unsent = ring.put(
+            [(x, sketch.pairs(td)) for x, td in tds],
+            flushes,
+            timeout,
+            wake=lambda: to_main_q.put("wake_up"),
+        )
+        if unsent is not None:
+            # the ring is full: keep the rest of the window for the next report
+            sup_stats.restore(tds[len(tds) - unsent :], flushes)
+
+    def send_metrics() -> None:
+        metrics = {}
+        if dispatcher:
+            metrics.update(dispatcher.get_metrics())
+        if retrier.counters:
+            metrics["retries"] = retrier.get_counters()
+        if prepared_counters.counters:
+            metrics["prepared"] = prepared_counters.get_counters()
+        if metrics:
+            to_main_q.put(("metrics", id, metrics))
+
+    dispatcher = None
+    if arrival_rate:
+        dispatcher = AsyncDispatcher(
+            loop,
+            arrival_rate,
+            arrival_dist,
+            share=lambda: worker_counts[id] / max(1, sum(worker_counts)),
+        )
+        dispatcher.start()
+
+    rate_limiter = None
+    if rate_limit:
+        rate_limiter = TokenBucket(
+            lambda: rate_limit.value * worker_counts[id] / max(1, sum(worker_counts)),
+            burst=None if co_correction else RATE_LIMITER_BURST,
+        )
+
+    connect_limiter = None
+    if connect_rate:
+        connect_limiter = TokenBucket(lambda: connect_rate / len(worker_counts))
+
+    ts = int(time.time())
+    stat_time = ts + FREQUENCY - ts % FREQUENCY + offset + SUPERVISOR_STATS_DELAY
+
+    while True:
+        try:
+            msg = await asyncio.wait_for(
+                messages.get(), timeout=max(0, stat_time - time.time())
+            )
+        except asyncio.TimeoutError:
+            msg = None
+
+        if time.time() >= stat_time:
+            # the ring might apply backpressure: don't block the sessions
+            await asyncio.to_thread(send_stats)
+            stat_time += FREQUENCY
+
+            worker_counts[id] = sum(not x.done() for x, _ in sessions.values())
+
+            send_metrics()
+
+        if msg is None:
+            continue
+
+        if msg == "poison_pill":
+            logger.debug(f"Supervisor-{id} terminating...")
+
+            if dispatcher:
+                dispatcher.stop()
+
+            control.shutdown()
+            for _, stop in sessions.values():
+                stop.set()
+
+            await asyncio.gather(
+                *(x for x, _ in sessions.values()), return_exceptions=True
+            )
+
+            # send the final stats and counters of all sessions
+            await asyncio.to_thread(send_stats, FINAL_STATS_TIMEOUT)
+            send_metrics()
+            return
+
+        elif msg == "kill_one":
+            # stop the most recent session that is still running
+            for slot, (task, stop) in reversed(sessions.items()):
+                if not task.done() and not stop.is_set():
+                    control.stop(slot)
+                    stop.set()
+                    worker_counts[id] = max(0, worker_counts[id] - 1)
+                    break
+
+        elif isinstance(msg, tuple):
+            # reuse the slots of the sessions that returned
+            for slot in returned_slots:
+                del sessions[slot]
+                heapq.heappush(free_slots, slot)
+            returned_slots.clear()
+
+            slot = heapq.heappop(free_slots)
+            control.start(slot)
+
+            stop = asyncio.Event()
+            task = asyncio.create_task(
+                session(
+                    to_main_q,
+                    stop,
+                    sup_stats,
+                    log_level,
+                    conn_info,
+                    driver,
+                    workload,
+                    args,
+                    conn_duration,
+                    offset,
+                    cycle_pause,
+                    cycle_interval,
+                    dispatcher,
+                    rate_limiter,
+                    co_correction,
+                    connect_gate,
+                    connect_limiter,
+                    retrier,
+                    prepared_counters,
+                    id,
+                    *msg,
+                )
+            )
+            task.add_done_callback(lambda _, slot=slot: returned_slots.append(slot))
+            sessions[slot] = (task, stop)
+            worker_counts[id] += 1
+
+
+async def session(
+    to_main_q: mp.Queue,
+    stop: asyncio.Event,
+    sup_stats: SupervisorStats,
+    log_level: str,
+    conn_info: ConnInfo,
+    driver: str,
+    workload: object,
+    args: dict,
+    conn_duration: int,
+    offset: int,
+    cycle_pause,
+    cycle_interval,
+    dispatcher: AsyncDispatcher,
+    rate_limiter: TokenBucket,
+    co_correction: bool,
+    connect_gate,
+    connect_limiter: TokenBucket,
+    retrier: Retrier,
+    prepared_counters: PreparedCounters,
+    supervisor_id: int,
+    id: int = 0,
+    iterations: int = 0,
+    concurrency: int = 0,
+):
+    """The asyncio counterpart of `run.worker()`."""
+
+    def gracefully_return(msg):
+        # send final stats
+        sup_stats.add_worker_stats(ws)
+
+        # send notification to MainThread
+        to_main_q.put((msg, supervisor_id))
+
+        logger.debug(f"Session ID {id} returned")
+
+    async def wait_until(deadline: int) -> bool:
+        # sleep until the perf_counter_ns deadline.
+        # Returns False if the session was stopped
+        remaining = (deadline - time.perf_counter_ns()) / 1e9
+
+        if remaining > STOP_CHECK_INTERVAL:
+            try:
+                await asyncio.wait_for(stop.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        elif remaining > 0:
+            await asyncio.sleep(remaining)
+
+        return not stop.is_set()
+
+    logger.debug(f"Session ID {id} started")
+
+    # catch exception while instantiating the workload class
+    try:
+        w = workload(args)
+    except Exception:
+        to_main_q.put(Exception(traceback.format_exc()))
+        return
+
+    c = 0
+
+    conn_endtime = 0
+
+    ws = WorkerStats()
+
+    run_init = True
+
+    # the perf_counter_ns time the current cycle was scheduled to start at.
+    # Only used with --co-correction
+    intended_start = 0
+
+    # send notification that a new session has started
+    to_main_q.put(("init", supervisor_id))
+
+    while True:
+        if stop.is_set():
+            logger.debug("Session stopped, terminating...")
+            gracefully_return("got_killed")
+            return
+
+        if conn_duration:
+            # reconnect every conn_duration +/- 20%
+            conn_endtime = time.time() + int(conn_duration * random.uniform(0.8, 1.2))
+
+        if connect_limiter:
+            due = connect_limiter.reserve()
+            if due and not await wait_until(due):
+                logger.debug("Session stopped, terminating...")
+                gracefully_return("got_killed")
+                return
+
+        try:
+            logger.debug(f"driver: {driver}, params: {conn_info.params}")
+            connect_start = time.perf_counter_ns()
+            async with await get_connection(driver, conn_info) as conn:
+                logger.debug("Connection started")
+
+                ws.add_latency_measurement(
+                    "__connect__", (time.perf_counter_ns() - connect_start) / 1e9
+                )
+
+                # execute setup() only once per session
+                if run_init:
+                    run_init = False
+
+                    if hasattr(w, "setup") and callable(w.setup):
+                        await run_transaction(
+                            conn,
+                            lambda conn: w.setup(
+                                conn,
+                                id,
+                                concurrency,
+                            ),
+                            retrier,
+                            "setup",
+                        )
+
+                # with --preconnect, hold until all sessions are connected.
+                # The gate is a multiprocessing Event, so it is polled.
+                if connect_gate and not connect_gate.is_set():
+                    sup_stats.add_worker_stats(ws)
+                    ws.new_window()
+                    to_main_q.put(("connected", supervisor_id))
+
+                    while not connect_gate.is_set():
+                        if not await wait_until(
+                            time.perf_counter_ns() + int(STOP_CHECK_INTERVAL * 1e9)
+                        ):
+                            logger.debug("Session stopped, terminating...")
+                            gracefully_return("got_killed")
+                            return
+
+                # send stats
+                ts = int(time.time())
+                stat_time = ts + FREQUENCY - ts % FREQUENCY + offset
+
+                while True:
+                    if stop.is_set():
+                        logger.debug("Session stopped, terminating...")
+                        gracefully_return("got_killed")
+                        return
+
+                    # return if the iteration count has been reached
+                    if iterations and c >= iterations:
+                        logger.debug("Task completed!")
+                        gracefully_return("task_done")
+                        return
+
+                    # break from the inner loop if limit for connection duration has been reached
+                    # this will cause for the outer loop to reset the timer and restart with a new conn
+                    if conn_duration and time.time() >= conn_endtime:
+                        logger.debug(
+                            "conn_duration reached, will reset the connection."
+                        )
+                        break
+
+                    if dispatcher:
+                        # open-loop: wait for the next arrival, the ticket
+                        # holds the time at which the cycle was due
+                        while not (intended_start := await dispatcher.get()):
+                            if stop.is_set():
+                                break
+
+                        if not intended_start:
+                            continue
+
+                        cycle_start = time.perf_counter_ns()
+                        ws.add_latency_measurement(
+                            "__queue__", (cycle_start - intended_start) / 1e9
+                        )
+                    elif rate_limiter:
+                        # draw a token, and wait until it is due
+                        due = rate_limiter.reserve()
+                        if due and not await wait_until(due):
+                            continue
+
+                        cycle_start = time.perf_counter_ns()
+                        intended_start = due if co_correction else 0
+                    else:
+                        with cycle_interval.get_lock():
+                            interval = cycle_interval.value
+
+                        cycle_start = time.perf_counter_ns()
+
+                        if not interval:
+                            intended_start = 0
+                        elif not intended_start:
+                            intended_start = cycle_start
+
+                    for txn in w.loop():
+                        # with the psycopg options, count the prepared statement hits
+                        prepared = get_prepared_counter(conn)
+                        if prepared:
+                            executed, hits = prepared.executed, prepared.hits
+
+                        start = time.perf_counter_ns()
+                        _, ok = await run_transaction(
+                            conn,
+                            lambda conn: txn(conn),
+                            retrier,
+                            txn.__name__,
+                        )
+
+                        if prepared:
+                            prepared_counters.add(
+                                txn.__name__,
+                                prepared.executed - executed,
+                                prepared.hits - hits,
+                            )
+
+                        # if the retries were exhausted, then it's a total failure and we don't record the txn time
+                        if ok:
+                            ws.add_latency_measurement(
+                                txn.__name__, (time.perf_counter_ns() - start) / 1e9
+                            )
+
+                    c += 1
+
+                    cycle_end = time.perf_counter_ns()
+
+                    ws.add_latency_measurement(
+                        "__cycle__", (cycle_end - cycle_start) / 1e9
+                    )
+                    if intended_start:
+                        ws.add_latency_measurement(
+                            "__response__", (cycle_end - intended_start) / 1e9
+                        )
+
+                    if time.time() >= stat_time:
+                        sup_stats.add_worker_stats(ws)
+                        ws.new_window()
+                        stat_time += FREQUENCY
+
+                    if dispatcher or rate_limiter:
+                        # the pace is set by the arrivals or the token bucket
+                        continue
+
+                    if intended_start:
+                        # the next cycle is due one interval after this one was
+                        intended_start += int(interval * 1e9)
+                        await wait_until(intended_start)
+                    else:
+                        with cycle_pause.get_lock():
+                            pause = cycle_pause.value
+
+                        if pause:
+                            await wait_until(cycle_end + int(pause * 1e9))
+
+        except Exception as e:
+            if driver == "postgres":
+                import psycopg
+
+                if isinstance(e, psycopg.errors.UndefinedTable):
+                    to_main_q.put(e)
+                    return
+                await log_and_sleep(e)
+
+            else:
+                # for all other Exceptions, report and return
+                logger.error(type(e), stack_info=True)
+                to_main_q.put(e)
+                return
+
+
+async def log_and_sleep(e: Exception):
+    logger.error(f"error_type={e.__class__.__name__}, msg={e}")
+    logger.info("Sleeping for %s seconds" % (DEFAULT_SLEEP))
+    await asyncio.sleep(DEFAULT_SLEEP)
+
+
+async def run_transaction(conn, op, retrier: Retrier, name: str = "") -> tuple:
+    """
+    Execute the operation *op(conn)* retrying the retryable errors.
+
+    *op* can be a regular or an `async def` function.
+    The errors are classified and retried by *retrier*, as in `run.run_transaction()`.
+
+    Returns the backoff seconds before each retry, and whether *op* succeeded.
+    """
+    delays = []
+    retrier.start()
+
+    while True:
+        try:
+            result = op(conn)
+            if inspect.isawaitable(result):
+                await result
+            # If we reach this point, we were able to commit, so we break
+            # from the retry loop.
+            return delays, True
+        except Exception as e:
+            if not retrier.is_retryable(e):
+                raise e
+
+            # This is a retry error, so we roll back the current
+            # transaction and sleep for a bit before retrying. The
+            # sleep time increases for each failed transaction.
+            logger.debug(f"{e.__class__.__name__}:: {e}")
+            if hasattr(conn, "rollback"):
+                await conn.rollback()
+
+            delay = retrier.next_delay(name, len(delays))
+            if delay is None:
+                logger.debug(f"Transaction did not succeed after {len(delays)} retries")
+                return delays, False
+
+            await asyncio.sleep(delay)
+            delays.append(delay)
+
+
+async def get_connection(driver: str, conn_info: ConnInfo):
+    """Return an async connection, to be used as an async context manager."""
+    if driver == "postgres":
+        import psycopg
+
+        conn = await psycopg.AsyncConnection.connect(
+            **conn_info.params, connect_timeout=5
+        )
+        configure_connection(conn, conn_info.extras)
+        return conn
+
+    elif driver == "mock":
+        from dbworkload.utils.mockdb import AsyncMockConnection
+
+        return AsyncMockConnection(**conn_info.params)
+
+    raise ValueError(
+        f"The asyncio runtime does not support driver '{driver}'. "
+        f"Supported drivers: {', '.join(ASYNCIO_DRIVERS)}"
+    )
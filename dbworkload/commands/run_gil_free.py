@@ -7,37 +7,62 @@ the behavior intentionally narrow: fixed concurrency, optional ramp, optional
 duration, optional iterations, periodic stats, and graceful Ctrl+C shutdown.
 """
 
-import json
 import logging
 import math
 import random
 import signal
-import socket
 import sys
 import time
 import traceback
-from dataclasses import dataclass
-from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from http.server import ThreadingHTTPServer
 from pathlib import Path
-from threading import Event, Lock, Thread
-from urllib.parse import parse_qs, urlparse
+from threading import Event, Lock, Thread, current_thread, local
 
-import numpy as np
 import tabulate
 from psutil import cpu_percent, virtual_memory
 
 from dbworkload.commands.run import (
-    FINAL_HEADERS,
     FREQUENCY,
-    HEADERS_CSV,
-    MAX_RETRIES,
+    add_pipeline_measurements,
     get_connection,
+    get_final_headers,
+    get_prepared_report,
     log_and_sleep,
     print_stats,
+    run_pipeline,
     run_transaction,
+    shared_clients,
 )
 from dbworkload.connection import ConnInfo
-from dbworkload.utils.common import Prom, Stats, WorkerStats, import_class_at_runtime
+from dbworkload.utils import sketch
+from dbworkload.utils.affinity import (
+    format_cpulist,
+    get_available_cores,
+    plan_affinity,
+    run_pinned,
+    set_affinity,
+)
+from dbworkload.utils.arrival import Dispatcher
+from dbworkload.utils.pipeline import iter_batches
+from dbworkload.utils.pool import Pool, create_pool, get_saturation
+from dbworkload.utils.prepared import PreparedCounters, get_prepared_counter
+from dbworkload.utils.ratelimit import RATE_LIMITER_BURST, TokenBucket
+from dbworkload.utils.results import ReportWriter, create_result_writer
+from dbworkload.utils.retry import Retrier, RetryPolicy
+from dbworkload.utils.common import (
+    Prom,
+    Stats,
+    TimedLock,
+    WorkerStats,
+    import_class_at_runtime,
+)
+from dbworkload.utils.control import (
+    make_control_handler,
+    start_control_server,
+    stop_control_servers,
+)
 
 logger = logging.getLogger("dbworkload")
 
@@ -47,26 +72,23 @@ MAX_RATE_MASSIVE_OVERSHOOT = 2.0
 MAX_RATE_ADJUSTMENT_COOLDOWN = 60
 MAX_RATE_MAX_CYCLE_PAUSE = 1.0
 MAX_RATE_EWMA_ALPHA = 0.40
-CONTROL_BIND_IPV4 = "0.0.0.0"
-CONTROL_BIND_IPV6 = "::"
+TOKEN_BUCKET_ADJUSTMENT_COOLDOWN = 2 * FREQUENCY
 
 
-class IPv6ThreadingHTTPServer(ThreadingHTTPServer):
-    """ThreadingHTTPServer variant that binds an IPv6 socket only.
-
-    dbworkload starts one IPv4 listener and one IPv6 listener on the same port.
-    Setting IPV6_V6ONLY avoids the common dual-stack ambiguity where binding
-    [::] may also claim 0.0.0.0 on some platforms.
+@dataclass
+class StatsSlot:
+    """The stats reports handed over by one worker thread.
+
+    Reports are appended to the buffer of the current epoch. The reporter
+    flips the epoch, then takes the buffer of the retired one, so it never
+    competes with the workers for a shared lock: the slot lock is only held
+    to append or swap one list, and is contended at most by its own worker
+    flushing at the exact time of the flip.
     """
 
-    address_family = socket.AF_INET6
-
-    def server_bind(self) -> None:
-        try:
-            self.socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
-        except OSError:
-            logger.debug("Could not set IPV6_V6ONLY on control server socket.")
-        super().server_bind()
+    thread: Thread
+    lock: TimedLock = field(default_factory=TimedLock)
+    buffers: list = field(default_factory=lambda: [[], []])
 
 
 @dataclass
@@ -79,33 +101,112 @@ class RunState:
     active_connections: int = 0
     peak_connections: int = 0
     task_done_threads: int = 0
-    stats_received: int = 0
     cycle_pause: float = 0
+    cycle_interval: float = 0
+    co_correction: bool = False
     worker_error: BaseException | None = None
+    dispatcher: Dispatcher | None = None
+    rate_limiter: TokenBucket | None = None
+    # with --preconnect, workers wait for connect_gate once connected
+    connect_gate: Event | None = None
+    connect_limiter: TokenBucket | None = None
+    connected_connections: int = 0
+    # with --pool-size, workers check out a connection for every cycle
+    pool: Pool | None = None
+    # with --pipeline, the pipelineable txns of a cycle are sent together
+    pipeline: bool = False
+    retrier: Retrier | None = None
+    # with the psycopg options, the workers count the prepared statement hits
+    prepared_counters: PreparedCounters = field(default_factory=PreparedCounters)
+    # set whenever the main loop has something to check before its next deadline
+    wake_up: Event = field(default_factory=Event)
+    # the stats slot of every worker thread, see StatsSlot
+    epoch: int = 0
+    stats_slots: list[StatsSlot] = field(default_factory=list)
+    thread_local: local = field(default_factory=local)
 
     def add_stats(self, worker_stats: WorkerStats) -> None:
         tds = worker_stats.get_tdigest_ndarray()
         if not tds:
             return
 
-        # Stats is shared by every worker thread. On free-threaded Python the GIL
-        # does not serialize bytecode execution, so updates to the shared Stats
-        # object and its counters must be protected explicitly.
+        slot = getattr(self.thread_local, "stats_slot", None)
+        if slot is None:
+            slot = self.thread_local.stats_slot = StatsSlot(current_thread())
+            with self.lock:
+                self.stats_slots.append(slot)
+
+        # the epoch is read under the slot lock: either the reporter already
+        # flipped it, or it waits for this report before taking the buffer
+        with slot.lock:
+            slot.buffers[self.epoch].append(tds)
+
+    def collect_stats(self) -> int:
+        """Merge the reports of the retired epoch into Stats.
+
+        Only the reporting thread calls this, and only it uses Stats, so
+        merging and calculating the stats never blocks the workers.
+        Returns the count of reports merged.
+        """
+        retired = self.epoch
+        self.epoch ^= 1
+
+        with self.lock:
+            slots = list(self.stats_slots)
+
+        stats_received = 0
+        for slot in slots:
+            with slot.lock:
+                reports, slot.buffers[retired] = slot.buffers[retired], []
+
+            for tds in reports:
+                self.stats.add_tds(tds)
+            stats_received += len(reports)
+
+        # forget the slots of the workers that returned, once emptied
+        with self.lock:
+            self.stats_slots[:] = [
+                x for x in self.stats_slots if x.thread.is_alive() or any(x.buffers)
+            ]
+
+        return stats_received
+
+    def get_lock_metrics(self) -> dict:
+        """Return the contention of the state lock and of the stats slots."""
+        metrics = {f"state_lock_{k}": v for k, v in self.lock.get_metrics().items()}
+
         with self.lock:
-            self.stats.add_tds(tds)
-            self.stats_received += 1
+            slots = list(self.stats_slots)
+
+        slot_metrics = [x.lock.get_metrics() for x in slots]
+        for k in ["acquisitions", "wait_ms", "hold_ms"]:
+            metrics[f"stats_slot_lock_{k}"] = sum(x[k] for x in slot_metrics)
+        for k in ["max_wait_ms", "max_hold_ms"]:
+            metrics[f"stats_slot_lock_{k}"] = max(
+                (x[k] for x in slot_metrics), default=0
+            )
+
+        return metrics
 
     def mark_started(self) -> None:
         with self.lock:
             self.active_connections += 1
             self.peak_connections = max(self.peak_connections, self.active_connections)
 
+    def mark_connected(self) -> None:
+        with self.lock:
+            self.connected_connections += 1
+
+        self.wake_up.set()
+
     def mark_stopped(self, task_done: bool = False) -> None:
         with self.lock:
             self.active_connections = max(0, self.active_connections - 1)
             if task_done:
                 self.task_done_threads += 1
 
+        self.wake_up.set()
+
     def set_error(self, error: BaseException) -> None:
         with self.lock:
             self.worker_error = error
@@ -114,6 +215,7 @@ class RunState:
         # thread-safe latch: one thread calls set(), all other threads can poll
         # is_set() cheaply without sharing a raw bool.
         self.stop_event.set()
+        self.wake_up.set()
 
     def set_cycle_pause(self, pause: float) -> None:
         # max-rate control writes this value from the reporting thread. Workers
@@ -125,6 +227,16 @@ class RunState:
         with self.lock:
             return self.cycle_pause
 
+    def set_cycle_interval(self, interval: float) -> None:
+        # with --co-correction, workers start a cycle every `interval` seconds
+        # and measure __response__ from that intended start.
+        with self.lock:
+            self.cycle_interval = max(0, interval)
+
+    def get_cycle_interval(self) -> float:
+        with self.lock:
+            return self.cycle_interval
+
 
 @dataclass
 class WorkerHandle:
@@ -171,15 +283,17 @@ class MaxRateControllerState:
         self.next_worker_adjustment_time = 0
 
 
-def require_gil_disabled() -> None:
+def require_gil_disabled(runtime: str = "gil-free") -> None:
     is_gil_enabled = getattr(sys, "_is_gil_enabled", None)
 
     if is_gil_enabled is None:
-        logger.error("The GIL-free runtime requires Python 3.13+ free-threaded builds.")
+        logger.error(
+            f"The {runtime} runtime requires Python 3.13+ free-threaded builds."
+        )
         sys.exit(1)
 
     if is_gil_enabled():
-        logger.error("The GIL is enabled. Refusing to run --runtime gil-free.")
+        logger.error(f"The GIL is enabled. Refusing to run --runtime {runtime}.")
         sys.exit(1)
 
 
@@ -203,6 +317,20 @@ def run(
     delay_stats: int,
     log_level: str,
     control_port: int = 26160,
+    co_correction: bool = False,
+    arrival_rate: float = None,
+    arrival_dist: str = "constant",
+    rate_limiter: str = "token-bucket",
+    affinity: str = "none",
+    reserved_cores: int = 0,
+    preconnect: bool = False,
+    connect_rate: float = 0,
+    pool_size: int = 0,
+    pipeline: bool = False,
+    retry_policy: RetryPolicy = None,
+    sketch_name: str = "tdigest",
+    quantiles: list = None,
+    save_format: str = "csv",
 ):
     """Run a workload with the experimental GIL-free threaded runtime."""
 
@@ -210,6 +338,8 @@ def run(
 
     logger.setLevel(log_level)
 
+    sketch.set_backend(sketch_name)
+
     start_time = int(time.time())
     workload = import_class_at_runtime(workload_path)
     run_name = (
@@ -220,16 +350,61 @@ def run(
 
     logger.info(f"Starting workload {run_name} with GIL-free threaded runtime")
 
+    # validate the options before the results file is created, so that a
+    # wrong option doesn't leave an empty one behind
+    if arrival_rate and (max_rate or any(x[1] for x in schedule or [])):
+        logger.error("--arrival-rate cannot be combined with --max-rate")
+        sys.exit(1)
+
+    # with --affinity, worker threads are pinned in groups, one core or one
+    # NUMA node per group, in round robin. The main thread, which runs the
+    # reporting and the Prometheus server, is pinned to the reserved cores.
+    try:
+        reserved, core_sets = plan_affinity(
+            affinity, len(get_available_cores()) - reserved_cores, reserved_cores
+        )
+    except ValueError as e:
+        logger.error(e)
+        sys.exit(1)
+
+    if reserved:
+        logger.info(f"Main thread pinned to cores {format_cpulist(reserved)}")
+        set_affinity(reserved)
+
+    writer = None
     if save:
-        with open(run_name + ".csv", "w") as f:
-            f.write(",".join(HEADERS_CSV) + "\n")
+        writer = create_result_writer(
+            save_format,
+            run_name,
+            quantiles,
+            sketch_name,
+            metadata={
+                "run_name": run_name,
+                "workload_path": workload_path,
+                "start_time": start_time,
+                "driver": driver,
+                "concurrency": concurrency,
+                "duration": duration,
+                "iterations": iterations,
+                "args": args,
+            },
+        )
 
     state = RunState(
-        stats=Stats(start_time),
-        lock=Lock(),
+        stats=Stats(start_time, quantiles),
+        lock=TimedLock(),
         stop_event=Event(),
+        co_correction=co_correction,
+        retrier=Retrier(driver, retry_policy),
+    )
+    # the reports are saved and printed off the main thread, which runs the
+    # max-rate controller
+    reporter = ReportWriter(
+        writer,
+        None if quiet else lambda report: print_stats(report, state.stats.quantiles),
     )
     prom = Prom(prom_port, state.stats, histogram_bins)
+    arrival_dropped = 0
 
     # workers holds Thread objects plus their per-worker stop Events. The list
     # itself is shared by the main scheduler loop and the adjustment thread, so
@@ -252,54 +427,89 @@ def run(
         # Ctrl+C is a global stop. Workers will notice this Event at their next
         # polling point and flush their local WorkerStats before returning.
         state.stop_event.set()
-
-    def write_csv(report: list, centroids, endtime: int) -> None:
-        if not save:
-            return
-        with open(run_name + ".csv", "a") as f:
-            for row in report:
-                f.write(str(endtime) + ",")
-                for col in row:
-                    f.write(str(col) + ",")
-                np.savetxt(f, next(centroids), newline=";")
-                f.write("\n")
+        state.wake_up.set()
 
     def publish_window(endtime: int) -> list:
-        # Reporting takes a consistent snapshot of the shared Stats object, then
-        # resets the current window while workers are briefly blocked from
-        # adding new measurements.
+        # The reports of the window are taken from the stats slots of the
+        # workers, which keep flushing into the next epoch meanwhile: only
+        # the counters are read under the state lock.
+        stats_received = state.collect_stats()
+
         with state.lock:
             active_connections = state.active_connections
-            stats_received = state.stats_received
-
-            cpu_util = cpu_percent()
-            vmem = virtual_memory().percent
-            if stats_received != active_connections or cpu_util > 70 or vmem > 70:
-                logger.warning(
-                    f"{stats_received=}, expected={active_connections}. "
-                    f"CPU Util={cpu_util}%, Memory={vmem}%"
-                )
 
-            report = state.stats.calculate_stats(active_connections, endtime)
-            centroids = state.stats.get_centroids()
-            state.stats.new_window(endtime)
-            state.stats_received = 0
+        cpu_util = cpu_percent()
+        vmem = virtual_memory().percent
+        if stats_received != active_connections or cpu_util > 70 or vmem > 70:
+            logger.warning(
+                f"{stats_received=}, expected={active_connections}. "
+                f"CPU Util={cpu_util}%, Memory={vmem}%"
+            )
 
-        write_csv(report, centroids, endtime)
+        report = state.stats.calculate_stats(active_connections, endtime)
+        centroids = state.stats.get_centroids()
+        state.stats.new_window(endtime)
 
-        if not quiet:
-            print_stats(report)
+        reporter.put(endtime, report, centroids)
 
         prom.publish(report)
+        check_arrivals()
+        check_pool()
+        check_retries()
+        check_prepared()
+        check_locks()
         return report
 
+    def check_pool() -> None:
+        if not state.pool:
+            return
+
+        metrics = state.pool.get_metrics()
+        metrics["pool_saturation"] = get_saturation(metrics)
+        logger.debug(f"pool metrics: {metrics}")
+        prom.publish_metrics(metrics)
+
+    def check_retries() -> None:
+        counters = state.retrier.get_counters()
+        if counters:
+            prom.publish_retries(counters)
+
+    def check_prepared() -> None:
+        counters = state.prepared_counters.get_counters()
+        if counters:
+            prom.publish_prepared(counters)
+
+    def check_locks() -> None:
+        metrics = state.get_lock_metrics()
+        logger.debug(f"lock metrics: {metrics}")
+        prom.publish_metrics(metrics)
+
+    def check_arrivals() -> None:
+        nonlocal arrival_dropped
+
+        if not state.dispatcher:
+            return
+
+        metrics = state.dispatcher.get_metrics()
+        if metrics["arrival_dropped"] > arrival_dropped:
+            logger.warning(
+                f"Arrival backlog is full, "
+                f"{metrics['arrival_dropped'] - arrival_dropped} cycles were "
+                f"dropped: backlog={metrics['arrival_backlog']}. "
+                "Consider adding workers with --concurrency."
+            )
+        arrival_dropped = metrics["arrival_dropped"]
+
+        prom.publish_metrics(metrics)
+
     def graceful_shutdown() -> None:
         logger.debug("Gracefully shutting down GIL-free runtime...")
         state.stop_event.set()
 
-        for server in control_servers:
-            server.shutdown()
-            server.server_close()
+        if state.dispatcher:
+            state.dispatcher.stop()
+
+        stop_control_servers(control_servers)
 
         # If a schedule ramp is still adding/removing workers, wait for it before
         # joining the actual worker threads.
@@ -317,21 +527,30 @@ def run(
         for worker_handle in worker_handles:
             worker_handle.thread.join()
 
+        if state.pool:
+            state.pool.close()
+
+        shared_clients.close()
+
         end_time = int(time.time())
         final_connections = max(state.peak_connections, concurrency)
 
-        with state.lock:
-            report = state.stats.calculate_stats(
-                final_connections,
-                end_time - delay_stats,
-            )
-            centroids = state.stats.get_centroids()
+        # the workers flushed into either epoch before returning
+        state.collect_stats()
+        state.collect_stats()
 
-        write_csv(report, centroids, state.stats.endtime)
+        report = state.stats.calculate_stats(
+            final_connections,
+            end_time - delay_stats,
+        )
+        centroids = state.stats.get_centroids()
 
         if not quiet:
             logger.info("Printing final stats")
-            print_stats(report)
+
+        # wait for the reports of all windows to be saved and printed
+        reporter.put(state.stats.endtime, report, centroids)
+        reporter.close()
 
         prom.publish(report)
 
@@ -339,12 +558,17 @@ def run(
 
         final_stats_report = tabulate.tabulate(
             state.stats.calculate_final_stats(final_connections, state.stats.endtime),
-            FINAL_HEADERS,
+            get_final_headers(state.stats.quantiles),
             tablefmt="simple_outline",
             intfmt=",",
             floatfmt=",.2f",
         )
 
+        # the prepared statement hits, with the psycopg options
+        prepared = state.prepared_counters.get_counters()
+        if prepared:
+            final_stats_report += "\n\n" + get_prepared_report(prepared)
+
         runtime_params = tabulate.tabulate(
             [
                 ["runtime", "gil-free"],
@@ -358,6 +582,20 @@ def run(
                 ["args", args],
                 ["delay_stats", delay_stats],
                 ["control_port", control_port],
+                ["co_correction", co_correction],
+                ["arrival_rate", arrival_rate],
+                ["arrival_dist", arrival_dist],
+                ["rate_limiter", rate_limiter],
+                ["affinity", affinity],
+                ["reserved_cores", reserved_cores],
+                ["preconnect", preconnect],
+                ["connect_rate", connect_rate],
+                ["pool_size", pool_size],
+                ["pipeline", pipeline],
+                ["retry_policy", retry_policy],
+                ["sketch", sketch_name],
+                ["quantiles", state.stats.quantiles],
+                ["save_format", save_format],
             ],
             headers=["Parameter", "Value"],
         )
@@ -425,9 +663,11 @@ def run(
         # Event gives us a small thread-safe signalling primitive.
         worker_stop_event = Event()
         worker_thread = Thread(
-            target=worker,
+            target=run_pinned,
             daemon=True,
             args=(
+                core_sets[worker_id % len(core_sets)] if core_sets else None,
+                worker,
                 state,
                 worker_stop_event,
                 log_level,
@@ -516,8 +756,19 @@ def run(
         )
         adjustment_thread.start()
         current_cc = target_cc
+        set_cycle_interval()
         return True
 
+    def set_cycle_interval() -> None:
+        # Each worker is given a fixed schedule of one cycle every
+        # current_cc / max_rate seconds, so a cycle delayed by a slow
+        # database is still measured from when it should have started.
+        # The token bucket provides that start time by itself.
+        if co_correction and not state.rate_limiter and row_max_rate and current_cc:
+            state.set_cycle_interval(current_cc / row_max_rate)
+        else:
+            state.set_cycle_interval(0)
+
     def request_worker_target(target_cc: int, ramp_time: int) -> bool:
         # Schedule, max-rate, and the HTTP control server can all request
         # worker-count changes. Serialize those decisions so current_cc remains
@@ -541,131 +792,13 @@ def run(
         with control_lock:
             return current_cc
 
-    def make_control_handler():
-        class ControlHandler(BaseHTTPRequestHandler):
-            """HTTP control endpoint for live GIL-free concurrency adjustment."""
-
-            server_version = "dbworkload-control"
-            sys_version = ""
-
-            def log_message(self, format: str, *args) -> None:
-                logger.debug("control server: " + format, *args)
-
-            def send_json(self, status: int, payload: dict) -> None:
-                body = json.dumps(payload, sort_keys=True).encode("utf-8")
-                self.send_response(status)
-                self.send_header("Content-Type", "application/json")
-                self.send_header("Content-Length", str(len(body)))
-                self.end_headers()
-                self.wfile.write(body)
-
-            def do_GET(self) -> None:
-                parsed = urlparse(self.path)
-                values = parse_qs(parsed.query, keep_blank_values=True)
-
-                if parsed.path != "/" or "adjust_count" not in values:
-                    self.send_json(
-                        400,
-                        {
-                            "error": "expected GET /?adjust_count=<integer>",
-                            "target_connections": requested_worker_count(),
-                            "active_connections": active_worker_count(),
-                        },
-                    )
-                    return
-
-                try:
-                    adjust_count = int(values["adjust_count"][0])
-                except (TypeError, ValueError):
-                    self.send_json(
-                        400,
-                        {
-                            "error": "adjust_count must be a positive or negative integer",
-                            "target_connections": requested_worker_count(),
-                            "active_connections": active_worker_count(),
-                        },
-                    )
-                    return
-
-                changed, previous_target, target_cc = request_worker_adjustment(
-                    adjust_count, 0
-                )
-                if target_cc == previous_target:
-                    self.send_json(
-                        200,
-                        {
-                            "adjust_count": adjust_count,
-                            "active_connections": active_worker_count(),
-                            "changed": False,
-                            "target_connections": previous_target,
-                        },
-                    )
-                    return
-
-                if not changed:
-                    self.send_json(
-                        409,
-                        {
-                            "error": "worker adjustment already in progress",
-                            "active_connections": active_worker_count(),
-                            "target_connections": requested_worker_count(),
-                        },
-                    )
-                    return
-
-                logger.info(
-                    "HTTP control adjusted target connections by %s: %s -> %s",
-                    adjust_count,
-                    previous_target,
-                    target_cc,
-                )
-                self.send_json(
-                    200,
-                    {
-                        "adjust_count": adjust_count,
-                        "active_connections": active_worker_count(),
-                        "changed": True,
-                        "target_connections": target_cc,
-                    },
-                )
-
-        return ControlHandler
-
-    def start_control_server() -> None:
-        if not control_port:
-            logger.info("GIL-free HTTP control server disabled.")
-            return
-
-        handler = make_control_handler()
-        listeners = [
-            (ThreadingHTTPServer, CONTROL_BIND_IPV4),
-            (IPv6ThreadingHTTPServer, CONTROL_BIND_IPV6),
-        ]
-
-        for server_cls, host in listeners:
-            try:
-                server = server_cls((host, control_port), handler)
-            except OSError as e:
-                logger.warning(
-                    "Could not start GIL-free HTTP control server on %s:%s: %s",
-                    host,
-                    control_port,
-                    e,
-                )
-                continue
-
-            server_thread = Thread(
-                target=server.serve_forever,
-                daemon=True,
-                name=f"dbworkload-gil-free-control-{host}",
-            )
-            server_thread.start()
-            control_servers.append(server)
-            logger.info(
-                "GIL-free HTTP control server listening on %s:%s",
-                host,
-                control_port,
-            )
+    def start_control_servers() -> None:
+        handler = make_control_handler(
+            lambda adjust_count: request_worker_adjustment(adjust_count, 0),
+            requested_worker_count,
+            active_worker_count,
+        )
+        control_servers.extend(start_control_server(control_port, handler, "GIL-free"))
 
     def cooldown_expired() -> bool:
         return time.time() >= max_rate_state.next_worker_adjustment_time
@@ -680,9 +813,15 @@ def run(
         #
         # The controller therefore waits for both periods before changing the
         # worker count again. Per-cycle pause is still allowed during cooldown.
-        max_rate_state.next_worker_adjustment_time = (
-            time.time() + MAX_RATE_ADJUSTMENT_COOLDOWN + ramp_time
-        )
+        #
+        # The token bucket never lets the rate overshoot, so there is no risk
+        # of flapping and one clean stats window is enough.
+        if state.rate_limiter:
+            cooldown = TOKEN_BUCKET_ADJUSTMENT_COOLDOWN
+        else:
+            cooldown = MAX_RATE_ADJUSTMENT_COOLDOWN
+
+        max_rate_state.next_worker_adjustment_time = time.time() + cooldown + ramp_time
 
     def get_cycle_rate(report: list) -> int:
         for row in report:
@@ -690,6 +829,42 @@ def run(
                 return row[6]
         return 0
 
+    def apply_token_bucket_control(
+        target_rate: int, report: list, ramp_time: int
+    ) -> None:
+        """Add workers when they can't drain the token bucket.
+
+        The token bucket caps the rate within a fraction of a second, so there
+        is no overshoot to correct. The only decision left is whether there are
+        enough workers to draw tokens at target_rate.
+        """
+        current_rate = get_cycle_rate(report)
+
+        if current_rate >= target_rate * MAX_RATE_LOWER_BAND or not cooldown_expired():
+            return
+
+        active_cc = max(1, requested_worker_count())
+        if current_rate > 0:
+            target_cc = max(
+                active_cc + 1, math.ceil(target_rate / (current_rate / active_cc))
+            )
+        else:
+            target_cc = active_cc + 1
+
+        if not request_worker_target(target_cc, ramp_time):
+            return
+
+        record_worker_adjustment(ramp_time)
+        logger.warning(
+            "Increasing workers for max_rate: desired max_rate: %s, "
+            "current_rate: %s, current_cc: %s, target_cc: %s, cooldown_until: %.2f",
+            target_rate,
+            current_rate,
+            active_cc,
+            target_cc,
+            max_rate_state.next_worker_adjustment_time,
+        )
+
     def apply_max_rate_control(target_rate: int, report: list, ramp_time: int) -> None:
         """Adjust workers and/or per-cycle pause to approach target_rate.
 
@@ -811,10 +986,88 @@ def run(
         schedule = [(concurrency, max_rate, ramp, duration)]
 
     current_cc = 0
+    row_max_rate = 0
     adjustment_thread: Thread | None = None
-    start_control_server()
+    start_control_servers()
+
+    if co_correction and not any(s[1] for s in schedule):
+        logger.warning("--co-correction has no effect without --max-rate")
+
+    if rate_limiter == "token-bucket":
+        # workers draw a token before every cycle of a max-rate schedule row
+        state.rate_limiter = TokenBucket(
+            lambda: float(row_max_rate or 0),
+            burst=None if co_correction else RATE_LIMITER_BURST,
+        )
+
+    if arrival_rate:
+        # in open-loop mode, the workers take their cycles from the dispatcher.
+        # Arrivals are paused while there are no workers to serve them.
+        state.dispatcher = Dispatcher(
+            arrival_rate,
+            arrival_dist,
+            share=lambda: 1 if requested_worker_count() else 0,
+        )
+        state.dispatcher.start()
+
+    if connect_rate:
+        # workers draw a token before every connection
+        state.connect_limiter = TokenBucket(lambda: connect_rate)
+
+    if preconnect:
+        state.connect_gate = Event()
+
+    state.pipeline = pipeline
+
+    if pool_size:
+        # the pool reconnects every --conn-duration
+        try:
+            state.pool = create_pool(driver, conn_info, pool_size, conn_duration)
+        except Exception as e:
+            logger.error(f"Could not create the connection pool: {e}")
+            reporter.close()
+            sys.exit(1)
 
     try:
+        if preconnect:
+            # open the connections of the first schedule row before any
+            # measurement, paced by --connect-rate if set
+            cc = int(schedule[0][0] or 0) or 1
+            logger.info(
+                f"Pre-connecting {cc} connections"
+                + (f" at {connect_rate}/s" if connect_rate else "")
+            )
+
+            request_worker_target(cc, 0)
+
+            while not state.stop_event.is_set():
+                state.wake_up.clear()
+
+                with state.lock:
+                    connected = state.connected_connections
+
+                if connected >= cc:
+                    logger.info(f"Pre-connect: all {cc} connections established")
+                    break
+
+                # the __connect__ latencies are reported while connecting
+                if time.time() >= report_time:
+                    logger.info(
+                        f"Pre-connect: {connected}/{cc} connections established"
+                    )
+                    publish_window(int(time.time() - delay_stats))
+                    report_time += FREQUENCY
+
+                state.wake_up.wait(max(0, report_time - time.time()))
+
+            if state.worker_error:
+                logger.error(
+                    f"error_type={state.worker_error.__class__.__name__}, "
+                    f"worker_error={state.worker_error!r}"
+                )
+
+            state.connect_gate.set()
+
         for i, s in enumerate(schedule):
             cc, row_max_rate, ramp_time, dur = s
             cc = int(cc or 0)
@@ -856,9 +1109,15 @@ def run(
             if row_max_rate and cc > 0 and worker_adjusted:
                 record_worker_adjustment(ramp_time)
 
+            with control_lock:
+                set_cycle_interval()
+
             end_schedule_time = time.time() + dur if dur else float("inf")
 
+            # The main loop sleeps until the next report or the end of the row,
+            # unless a worker stops, fails, or Ctrl+C wakes it up earlier.
             while time.time() < end_schedule_time and not state.stop_event.is_set():
+                state.wake_up.clear()
                 reap_workers()
 
                 # The main loop only inspects shared counters under the lock.
@@ -881,15 +1140,26 @@ def run(
                 if time.time() >= report_time:
                     report = publish_window(int(time.time() - delay_stats))
                     if row_max_rate and report:
-                        apply_max_rate_control(row_max_rate, report, ramp_time)
+                        if state.rate_limiter:
+                            apply_token_bucket_control(row_max_rate, report, ramp_time)
+                        else:
+                            apply_max_rate_control(row_max_rate, report, ramp_time)
                     report_time += FREQUENCY
 
-                time.sleep(0.001)
+                state.wake_up.wait(
+                    max(0, min(report_time, end_schedule_time) - time.time())
+                )
 
             if state.worker_error or state.stop_event.is_set():
                 break
     finally:
-        graceful_shutdown()
+        # graceful_shutdown() closes the reporter, unless a second Ctrl+C
+        # stops it early: close it anyway, as parquet results are only
+        # readable once closed
+        try:
+            graceful_shutdown()
+        finally:
+            reporter.close()
 
     if state.worker_error:
         sys.exit(1)
@@ -918,12 +1188,31 @@ def worker(
         state.set_error(Exception(traceback.format_exc()))
         return
 
+    @contextmanager
+    def checkout(conn):
+        # with --pool-size, a connection is checked out of the pool for every
+        # cycle, and the time waited for it is reported as __pool_wait__
+        if not state.pool:
+            yield conn
+            return
+
+        start = time.perf_counter_ns()
+        with state.pool.connection() as pooled_conn:
+            ws.add_latency_measurement(
+                "__pool_wait__", (time.perf_counter_ns() - start) / 1e9
+            )
+            yield pooled_conn
+
     c = 0
     conn_endtime = 0
     ws = WorkerStats()
     run_init = True
     stopped = False
 
+    # the perf_counter_ns time the current cycle was scheduled to start at.
+    # Only used with --co-correction, see RunState.set_cycle_interval()
+    intended_start = 0
+
     state.mark_started()
 
     try:
@@ -935,20 +1224,54 @@ def worker(
                     conn_duration * random.uniform(0.8, 1.2)
                 )
 
+            # with --connect-rate, wait for a connection token
+            if state.connect_limiter and not state.pool:
+                due = state.connect_limiter.reserve()
+                while (
+                    not state.stop_event.is_set()
+                    and not worker_stop_event.is_set()
+                    and (remaining := (due - time.perf_counter_ns()) / 1e9) > 0
+                ):
+                    time.sleep(min(0.05, remaining))
+
+                if state.stop_event.is_set() or worker_stop_event.is_set():
+                    break
+
             try:
                 logger.debug(f"driver: {driver}, params: {conn_info.params}")
-                with get_connection(driver, conn_info) as conn:
+                connect_start = time.perf_counter_ns()
+                with (
+                    nullcontext() if state.pool else get_connection(driver, conn_info)
+                ) as conn:
                     logger.debug("Connection started")
 
+                    # __connect__ includes the reconnections due to --conn-duration
+                    if not state.pool:
+                        ws.add_latency_measurement(
+                            "__connect__",
+                            (time.perf_counter_ns() - connect_start) / 1e9,
+                        )
+
                     if run_init:
                         run_init = False
                         if hasattr(w, "setup") and callable(w.setup):
-                            run_transaction(
-                                conn,
-                                lambda conn: w.setup(conn, id, concurrency),
-                                driver,
-                                max_retries=MAX_RETRIES,
-                            )
+                            with checkout(conn) as setup_conn:
+                                run_transaction(
+                                    setup_conn,
+                                    lambda conn: w.setup(conn, id, concurrency),
+                                    state.retrier,
+                                    "setup",
+                                )
+
+                    # with --preconnect, hold until all workers are connected
+                    if state.connect_gate and not state.connect_gate.is_set():
+                        state.add_stats(ws)
+                        ws.new_window()
+                        state.mark_connected()
+
+                        while not state.connect_gate.wait(0.05):
+                            if state.stop_event.is_set() or worker_stop_event.is_set():
+                                break
 
                     ts = int(time.time())
                     stat_time = ts + FREQUENCY - ts % FREQUENCY + offset
@@ -973,48 +1296,133 @@ def worker(
                             )
                             break
 
-                        cycle_start = time.time()
-                        for txn in w.loop():
-                            if state.stop_event.is_set() or worker_stop_event.is_set():
+                        if state.dispatcher:
+                            # open-loop: wait for the next arrival, the ticket
+                            # holds the time at which the cycle was due
+                            while not (intended_start := state.dispatcher.get()):
+                                if (
+                                    state.stop_event.is_set()
+                                    or worker_stop_event.is_set()
+                                ):
+                                    break
+
+                            if not intended_start:
                                 break
 
-                            start = time.time()
-                            retries = run_transaction(
-                                conn,
-                                lambda conn: txn(conn),
-                                driver,
-                                max_retries=MAX_RETRIES,
+                            cycle_start = time.perf_counter_ns()
+                            ws.add_latency_measurement(
+                                "__queue__", (cycle_start - intended_start) / 1e9
                             )
+                        elif state.rate_limiter:
+                            # draw a token, and wait until it is due
+                            due = state.rate_limiter.reserve()
+                            while (
+                                not state.stop_event.is_set()
+                                and not worker_stop_event.is_set()
+                                and (remaining := (due - time.perf_counter_ns()) / 1e9)
+                                > 0
+                            ):
+                                time.sleep(min(0.05, remaining))
 
-                            for _ in range(retries):
-                                ws.add_latency_measurement("__retries__", 0)
+                            if state.stop_event.is_set() or worker_stop_event.is_set():
+                                break
 
-                            if retries < MAX_RETRIES:
-                                ws.add_latency_measurement(
-                                    txn.__name__, time.time() - start
+                            cycle_start = time.perf_counter_ns()
+                            intended_start = due if state.co_correction else 0
+                        else:
+                            interval = state.get_cycle_interval()
+                            cycle_start = time.perf_counter_ns()
+
+                            if not interval:
+                                intended_start = 0
+                            elif not intended_start:
+                                intended_start = cycle_start
+
+                        with checkout(conn) as cycle_conn:
+                            for txn in (
+                                iter_batches(w.loop()) if state.pipeline else w.loop()
+                            ):
+                                if (
+                                    state.stop_event.is_set()
+                                    or worker_stop_event.is_set()
+                                ):
+                                    break
+
+                                if isinstance(txn, list):
+                                    # a batch of pipelineable functions
+                                    add_pipeline_measurements(
+                                        ws,
+                                        state.prepared_counters,
+                                        txn,
+                                        *run_pipeline(cycle_conn, txn, state.retrier),
+                                    )
+                                    continue
+
+                                # with the psycopg options, count the prepared statement hits
+                                prepared = get_prepared_counter(cycle_conn)
+                                if prepared:
+                                    executed, hits = prepared.executed, prepared.hits
+
+                                start = time.perf_counter_ns()
+                                _, ok = run_transaction(
+                                    cycle_conn,
+                                    lambda conn: txn(conn),
+                                    state.retrier,
+                                    txn.__name__,
                                 )
 
+                                if prepared:
+                                    state.prepared_counters.add(
+                                        txn.__name__,
+                                        prepared.executed - executed,
+                                        prepared.hits - hits,
+                                    )
+
+                                if ok:
+                                    ws.add_latency_measurement(
+                                        txn.__name__,
+                                        (time.perf_counter_ns() - start) / 1e9,
+                                    )
+
                         c += 1
+                        cycle_end = time.perf_counter_ns()
+
+                        # __cycle__ is the service time, __response__ also
+                        # includes the time spent behind schedule.
                         ws.add_latency_measurement(
-                            "__cycle__", time.time() - cycle_start
+                            "__cycle__", (cycle_end - cycle_start) / 1e9
                         )
+                        if intended_start:
+                            ws.add_latency_measurement(
+                                "__response__", (cycle_end - intended_start) / 1e9
+                            )
 
                         if time.time() >= stat_time:
                             # WorkerStats is thread-local, so measurement writes
-                            # do not need a lock. Only the handoff into shared
-                            # RunState.stats is locked inside add_stats().
+                            # do not need a lock. The handoff only locks the
+                            # stats slot of this worker, see StatsSlot.
                             state.add_stats(ws)
                             ws.new_window()
                             stat_time += FREQUENCY
 
-                        cycle_pause = state.get_cycle_pause()
-                        if cycle_pause:
-                            sleep_until = time.time() + cycle_pause
+                        if state.dispatcher or state.rate_limiter:
+                            # the pace is set by the arrivals or the token bucket
+                            sleep_until = 0
+                        elif intended_start:
+                            intended_start += int(interval * 1e9)
+                            sleep_until = intended_start
+                        else:
+                            cycle_pause = state.get_cycle_pause()
+                            sleep_until = (
+                                cycle_end + int(cycle_pause * 1e9) if cycle_pause else 0
+                            )
+
+                        if sleep_until:
                             while (
                                 not state.stop_event.is_set()
                                 and not worker_stop_event.is_set()
                             ):
-                                remaining = sleep_until - time.time()
+                                remaining = (sleep_until - time.perf_counter_ns()) / 1e9
                                 if remaining <= 0:
                                     break
 
@@ -0,0 +1,288 @@
+#!/usr/bin/python
+
+"""Hybrid runtime, for free-threaded builds.
+
+The MainProcess is the same coordinator used by the multiprocessing runtime:
+schedules, max-rate, the pipe, stats aggregation and Prometheus publishing are
+all shared, and it also runs the HTTP control server. Each supervisor process
+runs the worker threads of the GIL-free runtime, with its own RunState, so a
+large load generator can use many processes each running many threads that
+are not serialized by the GIL.
+"""
+
+import logging
+import multiprocessing as mp
+import queue
+import signal
+import time
+import traceback
+from dataclasses import dataclass
+from threading import Event, Lock, Thread
+
+from dbworkload.commands.run import (
+    FINAL_STATS_TIMEOUT,
+    FREQUENCY,
+    SUPERVISOR_STATS_DELAY,
+    shared_clients,
+)
+from dbworkload.commands.run import run as multiprocessing_run
+from dbworkload.commands.run_gil_free import (
+    RunState,
+    WorkerHandle,
+    require_gil_disabled,
+    worker,
+)
+from dbworkload.connection import ConnInfo
+from dbworkload.utils import sketch
+from dbworkload.utils.arrival import Dispatcher
+from dbworkload.utils.common import SupervisorStats, WorkerStats
+from dbworkload.utils.pool import create_pool
+from dbworkload.utils.ratelimit import RATE_LIMITER_BURST, TokenBucket
+from dbworkload.utils.retry import Retrier, RetryPolicy
+from dbworkload.utils.shm import ControlBlock, StatsRing
+
+logger = logging.getLogger("dbworkload")
+
+
+@dataclass
+class SupervisorRunState(RunState):
+    """RunState of the worker threads of one hybrid supervisor process.
+
+    The GIL-free workers report to their RunState. Here, their stats are
+    merged by the supervisor and sent to the MainProcess through the stats
+    ring, their lifecycle is reported on to_main_q, and the pause and interval
+    of max-rate are read from the values shared by the MainProcess.
+    """
+
+    to_main_q: mp.Queue = None
+    supervisor_id: int = 0
+    sup_stats: SupervisorStats = None
+    shared_cycle_pause: object = None
+    shared_cycle_interval: object = None
+
+    def add_stats(self, worker_stats: WorkerStats) -> None:
+        self.sup_stats.add_worker_stats(worker_stats)
+
+    def mark_started(self) -> None:
+        super().mark_started()
+        self.to_main_q.put(("init", self.supervisor_id))
+
+    def mark_connected(self) -> None:
+        super().mark_connected()
+        self.to_main_q.put(("connected", self.supervisor_id))
+
+    def mark_stopped(self, task_done: bool = False) -> None:
+        super().mark_stopped(task_done)
+        self.to_main_q.put(
+            ("task_done" if task_done else "got_killed", self.supervisor_id)
+        )
+
+    def set_error(self, error: BaseException) -> None:
+        super().set_error(error)
+        self.to_main_q.put(error)
+
+    def get_cycle_pause(self) -> float:
+        with self.shared_cycle_pause.get_lock():
+            return self.shared_cycle_pause.value
+
+    def get_cycle_interval(self) -> float:
+        with self.shared_cycle_interval.get_lock():
+            return self.shared_cycle_interval.value
+
+
+def run(*args, **kwargs):
+    """Run a workload with the hybrid runtime."""
+    require_gil_disabled("hybrid")
+
+    multiprocessing_run(*args, supervisor_target=supervisor, **kwargs)
+
+
+def supervisor(
+    to_main_q: mp.Queue,
+    from_main_q: mp.Queue,
+    ring: StatsRing,
+    control: ControlBlock,
+    log_level: str,
+    conn_info: ConnInfo,
+    driver: str,
+    workload: object,
+    args: dict,
+    conn_duration: int,
+    offset: int,
+    id: int,
+    cycle_pause,
+    cycle_interval,
+    arrival_rate: float,
+    arrival_dist: str,
+    worker_counts,
+    rate_limit,
+    co_correction: bool,
+    connect_gate,
+    connect_rate: float,
+    pool_size: int,
+    pipeline: bool,
+    retry_policy: RetryPolicy,
+    sketch_name: str,
+):
+    logger.setLevel(log_level)
+    logger.debug(f"Supervisor-{id} started")
+
+    sketch.set_backend(sketch_name)
+
+    sup_stats = SupervisorStats()
+
+    state = SupervisorRunState(
+        stats=None,
+        lock=Lock(),
+        stop_event=Event(),
+        co_correction=co_correction,
+        to_main_q=to_main_q,
+        supervisor_id=id,
+        sup_stats=sup_stats,
+        shared_cycle_pause=cycle_pause,
+        shared_cycle_interval=cycle_interval,
+        connect_gate=connect_gate,
+        pipeline=pipeline,
+        retrier=Retrier(driver, retry_policy),
+    )
+
+    # worker threads in the order they were started. They are stopped through
+    # their Events, as in the GIL-free runtime, so the control block is unused.
+    workers: list[WorkerHandle] = []
+
+    def send_stats(timeout=None) -> None:
+        tds, flushes = sup_stats.merge_window()
+        if not flushes:
+            return
+
+        unsent = ring.put(
+            [(x, sketch.pairs(td)) for x, td in tds],
+            flushes,
+            timeout,
+            wake=lambda: to_main_q.put("wake_up"),
+        )
+        if unsent is not None:
+            # the ring is full: keep the rest of the window for the next report
+            sup_stats.restore(tds[len(tds) - unsent :], flushes)
+
+    def send_metrics() -> None:
+        metrics = {}
+        if state.dispatcher:
+            metrics.update(state.dispatcher.get_metrics())
+        if state.pool:
+            metrics.update(state.pool.get_metrics())
+        if state.retrier.counters:
+            metrics["retries"] = state.retrier.get_counters()
+        if state.prepared_counters.counters:
+            metrics["prepared"] = state.prepared_counters.get_counters()
+        if metrics:
+            to_main_q.put(("metrics", id, metrics))
+
+    if arrival_rate:
+        state.dispatcher = Dispatcher(
+            arrival_rate,
+            arrival_dist,
+            share=lambda: worker_counts[id] / max(1, sum(worker_counts)),
+        )
+        state.dispatcher.start()
+
+    if rate_limit:
+        state.rate_limiter = TokenBucket(
+            lambda: rate_limit.value * worker_counts[id] / max(1, sum(worker_counts)),
+            burst=None if co_correction else RATE_LIMITER_BURST,
+        )
+
+    if pool_size:
+        try:
+            state.pool = create_pool(driver, conn_info, pool_size, conn_duration)
+        except Exception:
+            to_main_q.put(Exception(traceback.format_exc()))
+            return
+
+    if connect_rate:
+        state.connect_limiter = TokenBucket(lambda: connect_rate / len(worker_counts))
+
+    ts = int(time.time())
+    stat_time = ts + FREQUENCY - ts % FREQUENCY + offset + SUPERVISOR_STATS_DELAY
+
+    # capture KeyboardInterrupt and do nothing
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    while True:
+        try:
+            msg = from_main_q.get(block=True, timeout=max(0, stat_time - time.time()))
+        except queue.Empty:
+            msg = None
+
+        if time.time() >= stat_time:
+            send_stats()
+            stat_time += FREQUENCY
+
+            workers[:] = [x for x in workers if x.thread.is_alive()]
+            worker_counts[id] = sum(not x.stopping for x in workers)
+
+            send_metrics()
+
+        if msg is None:
+            continue
+
+        if msg == "poison_pill":
+            logger.debug(f"Supervisor-{id} terminating...")
+
+            if state.dispatcher:
+                state.dispatcher.stop()
+
+            state.stop_event.set()
+
+            for x in workers:
+                x.thread.join()
+
+            # send the final stats and counters of all threads
+            send_stats(FINAL_STATS_TIMEOUT)
+            send_metrics()
+
+            if state.pool:
+                state.pool.close()
+
+            shared_clients.close()
+
+            logger.debug(f"Supervisor-{id} terminated")
+            return
+
+        elif msg == "kill_one":
+            # stop the most recent worker still running
+            for x in reversed(workers):
+                if x.thread.is_alive() and not x.stopping:
+                    x.stopping = True
+                    x.stop_event.set()
+                    worker_counts[id] = max(0, worker_counts[id] - 1)
+                    break
+
+        elif isinstance(msg, tuple):
+            worker_id, iterations, concurrency = msg
+
+            worker_stop_event = Event()
+            t = Thread(
+                target=worker,
+                daemon=True,
+                args=(
+                    state,
+                    worker_stop_event,
+                    log_level,
+                    conn_info,
+                    driver,
+                    workload,
+                    args,
+                    conn_duration,
+                    offset,
+                    worker_id,
+                    iterations,
+                    concurrency,
+                ),
+                name=f"dbworkload-hybrid-{worker_id}",
+            )
+            t.start()
+            workers.append(
+                WorkerHandle(id=worker_id, thread=t, stop_event=worker_stop_event)
+            )
+            worker_counts[id] += 1
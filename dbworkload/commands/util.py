@@ -5,12 +5,12 @@ import gzip
 import itertools
 import logging
 import os
+import re
 import shutil
 import sys
 from io import TextIOWrapper
 from pathlib import PosixPath
 
-import numpy as np
 import pandas as pd
 import plotext as plt
 import plotly.graph_objects as go
@@ -20,12 +20,15 @@ import yaml
 from jinja2 import Environment, PackageLoader
 from plotly.subplots import make_subplots
 
-from dbworkload.utils import common, tdigest
+from dbworkload.utils import common, results, sketch
 from dbworkload.utils.simplefaker import SimpleFaker
 
 logger = logging.getLogger("dbworkload")
 logger.setLevel(logging.INFO)
 
+# the columns of the quantiles in the stats CSV files, eg: p99.9_ms
+QUANTILE_COLUMN = re.compile(r"p[\d.]+_ms|max_ms")
+
 
 def util_csv(
     input: PosixPath,
@@ -291,29 +294,28 @@ def util_merge_sort(input_dir: str, output_dir: str, csv_max_rows: int, compress
     MergeSort(input_dir, output_dir, csv_max_rows, compress).run()
 
 
-def util_plot(input: PosixPath):
-    df = pd.read_csv(
-        input,
-        header=0,
-        names=[
-            "ts",
-            "elapsed",
-            "id",
-            "threads",
-            "tot_ops",
-            "tot_ops_s",
-            "period_ops",
-            "period_ops_s",
-            "mean_ms",
-            "p50_ms",
-            "p90_ms",
-            "p95_ms",
-            "p99_ms",
-            "max_ms",
-            "centroids",
-        ],
+def get_quantile_columns(columns) -> list[str]:
+    """Return the quantile columns of a stats CSV file, by increasing quantile."""
+    return sorted(
+        (x for x in columns if QUANTILE_COLUMN.fullmatch(x)),
+        key=lambda x: common.parse_quantile_label(x[:-3]),
     )
 
+
+def get_tail_column(df: pd.DataFrame) -> str:
+    """Return the quantile column to plot: p99_ms, or the highest below max."""
+    columns = get_quantile_columns(df.columns)
+
+    if "p99_ms" in columns:
+        return "p99_ms"
+
+    return ([x for x in columns if x != "max_ms"] or columns)[-1]
+
+
+def util_plot(input: PosixPath):
+    df, _ = results.read_results(input)
+    tail = get_tail_column(df)
+
     # define index column
     df.set_index("elapsed", inplace=True)
 
@@ -325,10 +327,10 @@ def util_plot(input: PosixPath):
     for id in df["id"].unique():
         df1 = df[df["id"] == id]
 
-        # p99
+        # tail latency
         plt.subplot(1, 1).plotsize(None, plt.th() // 1.7)
         plt.plot(
-            df1["p99_ms"].index, df1["p99_ms"], label=f"{id}_p99", marker="braille"
+            df1[tail].index, df1[tail], label=f"{id}_{tail[:-3]}", marker="braille"
         )
 
         # ops/s
@@ -356,27 +358,8 @@ def util_html(input: PosixPath):
 
     out = os.path.join(input.parent, input.stem + ".html")
 
-    df = pd.read_csv(
-        input,
-        header=0,
-        names=[
-            "ts",
-            "elapsed",
-            "id",
-            "threads",
-            "tot_ops",
-            "tot_ops_s",
-            "period_ops",
-            "period_ops_s",
-            "mean_ms",
-            "p50_ms",
-            "p90_ms",
-            "p95_ms",
-            "p99_ms",
-            "max_ms",
-            "centroids",
-        ],
-    )
+    df, _ = results.read_results(input)
+    tail = get_tail_column(df)
 
     # Create subplots and mention plot grid size
     fig = make_subplots(
@@ -404,9 +387,9 @@ def util_html(input: PosixPath):
 
         fig.add_trace(
             go.Scatter(
-                name=f"{id}_p99",
+                name=f"{id}_{tail[:-3]}",
                 x=df1["elapsed"],
-                y=df1["p99_ms"],
+                y=df1[tail],
                 line=dict(color=line_color, width=1.7),
             ),
             row=1,
@@ -453,17 +436,17 @@ def util_html(input: PosixPath):
     logger.info(f"Saved merged CSV file to '{out}'")
 
 
-def util_merge_csvs(input_dir: str):
+def util_merge_csvs(input_dir: str, sketch_name: str = "tdigest"):
     logger.warning(
         "This feature is experimental. Validate results and file any bug/issue."
     )
 
-    # collect only regular, CSV files.
+    # collect only regular, CSV and parquet results files.
     files = os.listdir(input_dir)
     CSVs = [
         os.path.join(input_dir, f)
         for f in files
-        if os.path.isfile(os.path.join(input_dir, f)) and f.endswith(".csv")
+        if os.path.isfile(os.path.join(input_dir, f)) and results.is_results_file(f)
     ]
 
     if not CSVs:
@@ -471,15 +454,29 @@ def util_merge_csvs(input_dir: str):
         sys.exit(1)
 
     # use one of the CSVs filename to create the output filename
-    out = os.path.basename(CSVs[0])[:-4] + ".merged.csv"
+    out = os.path.splitext(os.path.basename(CSVs[0]))[0] + ".merged.csv"
 
-    # read all CSVs into a single df, sorted by `ts``
-    df = pd.concat((pd.read_csv(f) for f in CSVs), ignore_index=True).sort_values("ts")
+    # read all CSVs, with the `centroids` as 2-dims np.arrays
+    dfs, settings = zip(*(results.read_results(f, centroids=True) for f in CSVs))
 
-    min_ts = df["ts"].min()
+    # the centroids column holds the pairs of the sketch used by the run,
+    # recorded in the version line of CSV files since version 2
+    sketches = {x.get("sketch", sketch_name) for x in settings}
+    if len(sketches) > 1:
+        logger.error(f"Cannot merge CSVs of different sketches: {sorted(sketches)}")
+        sys.exit(1)
 
-    # convert the current `centroids` string to a 2-dims np.array
-    df["centroids"] = df["centroids"].apply(str.split, args=(";",)).apply(np.genfromtxt)
+    sketch_name = sketches.pop()
+    sketch.set_backend(sketch_name)
+
+    # concat all CSVs into a single df, sorted by `ts``
+    df = pd.concat(dfs, ignore_index=True).sort_values("ts")
+
+    # the quantiles of any of the CSVs, recalculated from the merged sketches
+    quantile_columns = get_quantile_columns(df.columns)
+    quantiles = [common.parse_quantile_label(x[:-3]) for x in quantile_columns]
+
+    min_ts = df["ts"].min()
 
     def get_elapsed_bucket(x):
         """
@@ -502,11 +499,11 @@ def util_merge_csvs(input_dir: str):
 
     def combine_centroids(x):
         """
-        combine centroids of multiple TDigests together,
-        and return the new aggregated centroids.
-        Note: max_centroids=1000
+        combine the pairs of multiple sketches together,
+        and return the new aggregated pairs.
+        Note: at most sketch.MAX_PAIRS pairs
         """
-        return tdigest.centroids(tdigest.combine(tdigest.from_centroids(y) for y in x))
+        return sketch.pairs(sketch.combine(sketch.from_pairs(y) for y in x))
 
     # for each elapsed range bucket, merge the data for all `id` together
     # by aggregating the count of `threads` and by aggregating the `centroids`
@@ -514,10 +511,8 @@ def util_merge_csvs(input_dir: str):
         {"ts": min, "threads": sum, "centroids": combine_centroids}
     )
 
-    # the mass of the TDigest represents the count of ops
-    df["period_ops"] = df["centroids"].map(
-        lambda x: tdigest.count(tdigest.from_centroids(x))
-    )
+    # the mass of the sketch represents the count of ops
+    df["period_ops"] = df["centroids"].map(lambda x: sketch.count(sketch.from_pairs(x)))
 
     df["period_ops_s"] = df["period_ops"].apply(lambda x: x // 10)
 
@@ -530,16 +525,12 @@ def util_merge_csvs(input_dir: str):
 
     # calculate mean and quantiles and convert from seconds to millis
     df["mean_ms"] = df["centroids"].map(
-        lambda x: tdigest.from_centroids(x).mean() * 1000
+        lambda x: sketch.mean(sketch.from_pairs(x)) * 1000
     )
-    df[["p50_ms", "p90_ms", "p95_ms", "p99_ms", "max_ms"]] = (
+    df[quantile_columns] = (
         pd.DataFrame(
             df["centroids"]
-            .map(
-                lambda x: tdigest.from_centroids(x).quantile_vec(
-                    [0.50, 0.90, 0.95, 0.99, 1.00]
-                )
-            )
+            .map(lambda x: sketch.quantiles(sketch.from_pairs(x), quantiles))
             .tolist(),
             index=df.index,
         )
@@ -547,9 +538,9 @@ def util_merge_csvs(input_dir: str):
     )
 
     # round all values to 2 decimals
-    df[["mean_ms", "p50_ms", "p90_ms", "p95_ms", "p99_ms", "max_ms"]] = df[
-        ["mean_ms", "p50_ms", "p90_ms", "p95_ms", "p99_ms", "max_ms"]
-    ].apply(round, args=(2,))
+    df[["mean_ms"] + quantile_columns] = df[["mean_ms"] + quantile_columns].apply(
+        round, args=(2,)
+    )
 
     # rearrange cols and eliminate centroids while keeping the column
     df = df[
@@ -563,18 +554,16 @@ def util_merge_csvs(input_dir: str):
             "period_ops",
             "period_ops_s",
             "mean_ms",
-            "p50_ms",
-            "p90_ms",
-            "p95_ms",
-            "p99_ms",
-            "max_ms",
         ]
+        + quantile_columns
     ]
 
     df["centroids"] = None
 
     # finally, save the df to file
-    df.to_csv(out, index=False)
+    with open(out, "w") as f:
+        f.write(common.csv_version_line(sketch_name))
+        df.to_csv(f, index=False)
     logger.info(f"Saved merged CSV file to '{out}'")
 
 
@@ -7,3 +7,7 @@ from dataclasses import dataclass, field
 class ConnInfo:
     params: dict = field(default_factory=dict)
     extras: dict = field(default_factory=dict)
+
+    def key(self) -> str:
+        """Return a hashable key identifying these connection settings."""
+        return repr((sorted(self.params.items()), sorted(self.extras.items())))
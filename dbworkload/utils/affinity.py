@@ -0,0 +1,148 @@
+#!/usr/bin/python
+
+"""CPU affinity of the supervisor processes and worker threads.
+
+With `cores`, the available cores are split in contiguous sets, one per
+supervisor, in NUMA node order. With `numa`, every supervisor gets all the
+cores of one NUMA node, so its connections and driver buffers stay on the
+node's local memory. Reserved cores are taken out of these sets, and left to
+the MainProcess, which runs the coordinator and the Prometheus server.
+
+Topology is read from /sys/devices/system/node. On platforms without
+os.sched_setaffinity, a warning is logged and the placement is left to the
+kernel.
+"""
+
+import logging
+import os
+from pathlib import Path
+
+logger = logging.getLogger("dbworkload")
+
+AFFINITY_MODES = ["none", "cores", "numa"]
+NUMA_NODES_PATH = "/sys/devices/system/node"
+
+
+def parse_cpulist(cpulist: str) -> set[int]:
+    """Parse a kernel cpulist such as '0-3,8-11'."""
+    cores = set()
+
+    for x in cpulist.strip().split(","):
+        if not x:
+            continue
+        if "-" in x:
+            first, last = x.split("-")
+            cores.update(range(int(first), int(last) + 1))
+        else:
+            cores.add(int(x))
+
+    return cores
+
+
+def format_cpulist(cores: set[int]) -> str:
+    """Format a set of cores as a kernel cpulist, eg '0-3,8'."""
+    ranges = []
+
+    for x in sorted(cores):
+        if ranges and x == ranges[-1][1] + 1:
+            ranges[-1][1] = x
+        else:
+            ranges.append([x, x])
+
+    return ",".join(str(a) if a == b else f"{a}-{b}" for a, b in ranges)
+
+
+def get_available_cores() -> set[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return set(os.sched_getaffinity(0))
+
+    return set(range(os.cpu_count()))
+
+
+def get_numa_nodes() -> list[set[int]]:
+    """Return the cores of each NUMA node that this process can run on.
+
+    Without a NUMA topology, all the available cores are a single node.
+    """
+    available = get_available_cores()
+    nodes = []
+
+    for path in sorted(
+        Path(NUMA_NODES_PATH).glob("node[0-9]*"), key=lambda x: int(x.name[4:])
+    ):
+        try:
+            cores = parse_cpulist((path / "cpulist").read_text()) & available
+        except (OSError, ValueError):
+            continue
+
+        if cores:
+            nodes.append(cores)
+
+    return nodes or [available]
+
+
+def plan_affinity(mode: str, count: int, reserved_cores: int = 0) -> tuple:
+    """Assign a core set to each of `count` supervisors or worker groups.
+
+    Returns the cores reserved for the MainProcess, or None when no core is
+    reserved, and the list of `count` core sets, or None when the placement
+    is left to the kernel.
+    """
+    if mode not in AFFINITY_MODES:
+        raise ValueError(
+            f"Unknown affinity mode '{mode}'. "
+            f"The possible values are {', '.join(AFFINITY_MODES)}."
+        )
+
+    nodes = get_numa_nodes()
+    cores = [x for node in nodes for x in sorted(node)]
+
+    if reserved_cores >= len(cores):
+        raise ValueError(
+            f"Cannot reserve {reserved_cores} cores: only {len(cores)} are available."
+        )
+
+    # the first cores of the first node are reserved
+    reserved = set(cores[:reserved_cores]) or None
+
+    if mode == "none":
+        # without pinning, the supervisors can still use all but the reserved
+        # cores, as they would otherwise inherit the MainProcess affinity
+        return reserved, reserved and [set(cores) - reserved] * count
+
+    if mode == "numa":
+        nodes = [x - (reserved or set()) for x in nodes]
+        nodes = [x for x in nodes if x]
+        return reserved, [nodes[i % len(nodes)] for i in range(count)]
+
+    # split the cores in count contiguous sets. With fewer cores than
+    # supervisors, several supervisors share a core.
+    cores = cores[reserved_cores:]
+    if count >= len(cores):
+        return reserved, [{cores[i % len(cores)]} for i in range(count)]
+
+    return reserved, [
+        set(cores[i * len(cores) // count : (i + 1) * len(cores) // count])
+        for i in range(count)
+    ]
+
+
+def set_affinity(cores: set[int]) -> None:
+    """Pin the calling thread, and the threads it starts, to cores."""
+    if not cores:
+        return
+
+    try:
+        os.sched_setaffinity(0, cores)
+    except AttributeError:
+        logger.warning("CPU affinity is not supported on this platform.")
+    except OSError as e:
+        logger.warning(
+            f"Could not set the CPU affinity to {format_cpulist(cores)}: {e}"
+        )
+
+
+def run_pinned(cores: set[int], target, *args):
+    """Run target(*args) pinned to cores, as a Process or Thread target."""
+    set_affinity(cores)
+    return target(*args)
@@ -0,0 +1,147 @@
+#!/usr/bin/python
+
+import asyncio
+import logging
+import queue
+import random
+import time
+from threading import Event, Thread
+
+logger = logging.getLogger("dbworkload")
+
+ARRIVAL_DISTRIBUTIONS = ["constant", "poisson"]
+ARRIVAL_MAX_BACKLOG = 10000
+ARRIVAL_MAX_SLEEP = 0.05
+ARRIVAL_REFRESH = 0.1
+
+
+class Dispatcher(Thread):
+    """Issue cycle tickets at a fixed arrival rate, for open-loop workloads.
+
+    A ticket is the `time.perf_counter_ns` time at which a cycle is due. Workers
+    take tickets with `get()` and run one cycle per ticket. When the database
+    is slower than the arrival rate, tickets pile up in the backlog instead of
+    slowing the arrivals down, so the time a ticket waited is the queueing delay
+    a real client would see. Once the backlog is full, new tickets are dropped
+    and counted.
+
+    `share` returns the fraction of `rate` this dispatcher is responsible for,
+    as every supervisor process runs its own dispatcher. It is read every
+    ARRIVAL_REFRESH seconds, so the rate follows the worker count.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        dist: str = "constant",
+        share=None,
+        max_backlog: int = ARRIVAL_MAX_BACKLOG,
+    ):
+        super().__init__(daemon=True)
+
+        if dist not in ARRIVAL_DISTRIBUTIONS:
+            raise ValueError(f"Unknown arrival distribution: {dist}")
+
+        self.rate = rate
+        self.dist = dist
+        self.share = share
+        self.tickets = queue.Queue(max_backlog)
+        self.issued = 0
+        self.dropped = 0
+        self.stop_event = Event()
+
+    def get_rate(self) -> float:
+        return self.rate * self.share() if self.share else self.rate
+
+    def run(self) -> None:
+        rate = self.get_rate()
+        refresh_time = time.perf_counter_ns() + int(ARRIVAL_REFRESH * 1e9)
+        next_arrival = time.perf_counter_ns()
+
+        while not self.stop_event.is_set():
+            now = time.perf_counter_ns()
+
+            if now >= refresh_time:
+                rate = self.get_rate()
+                refresh_time = now + int(ARRIVAL_REFRESH * 1e9)
+
+            if rate <= 0:
+                # no workers to serve the arrivals: don't accumulate them
+                next_arrival = now
+                time.sleep(ARRIVAL_MAX_SLEEP)
+                continue
+
+            # at high rates, several tickets are due at every wake up
+            due = []
+            while next_arrival <= now:
+                due.append(int(next_arrival))
+
+                if self.dist == "poisson":
+                    next_arrival += random.expovariate(rate) * 1e9
+                else:
+                    next_arrival += 1e9 / rate
+
+            if due:
+                self.issue(due)
+
+            time.sleep(min(ARRIVAL_MAX_SLEEP, (next_arrival - now) / 1e9))
+
+    def issue(self, tickets: list) -> None:
+        for x in tickets:
+            try:
+                self.tickets.put_nowait(x)
+                self.issued += 1
+            except queue.Full:
+                self.dropped += 1
+
+    def get(self, timeout: float = ARRIVAL_MAX_SLEEP) -> int:
+        """Return the intended start time of the next cycle, or 0 on timeout."""
+        try:
+            return self.tickets.get(timeout=timeout)
+        except queue.Empty:
+            return 0
+
+    def get_metrics(self) -> dict:
+        return {
+            "arrival_backlog": self.tickets.qsize(),
+            "arrival_issued": self.issued,
+            "arrival_dropped": self.dropped,
+        }
+
+    def stop(self) -> None:
+        self.stop_event.set()
+
+
+class AsyncDispatcher(Dispatcher):
+    """Dispatcher for the asyncio runtime.
+
+    Arrivals are still timed by a thread, as the event loop can be late to wake
+    up when busy, but tickets are handed over to the event loop in batches and
+    sessions await them.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loop = loop
+        self.tickets = asyncio.Queue(self.tickets.maxsize)
+
+    def issue(self, tickets: list) -> None:
+        try:
+            self.loop.call_soon_threadsafe(self._issue, tickets)
+        except RuntimeError:
+            # the event loop is closed: the supervisor is shutting down
+            self.stop()
+
+    def _issue(self, tickets: list) -> None:
+        for x in tickets:
+            try:
+                self.tickets.put_nowait(x)
+                self.issued += 1
+            except asyncio.QueueFull:
+                self.dropped += 1
+
+    async def get(self, timeout: float = ARRIVAL_MAX_SLEEP) -> int:
+        try:
+            return await asyncio.wait_for(self.tickets.get(), timeout)
+        except asyncio.TimeoutError:
+            return 0
@@ -0,0 +1,54 @@
+#!/usr/bin/python
+
+"""Clients shared by the worker threads of a process.
+
+The clients of some drivers are thread-safe, and run their own connection
+pool and background threads. Rather than building one client per worker,
+the workers of a process share one client per driver and connection settings.
+"""
+
+import logging
+from threading import Lock
+
+from dbworkload.connection import ConnInfo
+
+logger = logging.getLogger("dbworkload")
+
+SHARED_CLIENT_DRIVERS = ["spanner", "mongo", "pinecone", "foundationdb"]
+
+
+class ClientCache:
+    """The shared clients of a process, keyed by driver and ConnInfo."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.clients: dict[tuple, tuple] = {}
+
+    def get(self, driver: str, conn_info: ConnInfo, create):
+        """Return the client for driver and conn_info.
+
+        On first use, the client is built by `create()`, which returns the
+        client and the function closing it, or None. The other workers wait
+        for it, so only one client is built.
+        """
+        key = (driver, conn_info.key())
+
+        with self.lock:
+            if key not in self.clients:
+                self.clients[key] = create()
+                logger.debug(f"Created a shared {driver} client")
+
+            return self.clients[key][0]
+
+    def close(self) -> None:
+        with self.lock:
+            clients, self.clients = self.clients, {}
+
+        for (driver, _), (_, close) in clients.items():
+            if not close:
+                continue
+
+            try:
+                close()
+            except Exception as e:
+                logger.warning(f"Could not close the shared {driver} client: {e}")
@@ -4,18 +4,24 @@ import importlib.util
 import logging
 import os
 import random
+import re
 import sys
 import time
 import urllib.parse
+from array import array
+from threading import Lock
 
 import numpy as np
 import prometheus_client as prom
 import yaml
-from fastdigest import TDigest
-from prometheus_client.core import REGISTRY, HistogramMetricFamily
+from prometheus_client.core import (
+    REGISTRY,
+    CounterMetricFamily,
+    HistogramMetricFamily,
+)
 from prometheus_client.registry import Collector
 
-from . import tdigest
+from . import sketch
 
 RESERVED_WORDS = [
     "unique",
@@ -48,38 +54,147 @@ DEFAULT_ARRAY_COUNT = 3
 NOT_NULL_MIN = 20
 NOT_NULL_MAX = 40
 
+# the quantiles of the stats reports, unless set with --quantiles
+DEFAULT_QUANTILES = [0.50, 0.90, 0.95, 0.99, 1.0]
+
+# the first line of the stats CSV files, followed by key=value settings.
+# Version 1 files had no such line, and the DEFAULT_QUANTILES columns.
+CSV_VERSION = 2
+CSV_VERSION_PREFIX = "# dbworkload-csv"
+
+# the initial and the max count of values of a LatencyBuffer
+LATENCY_BUFFER_SIZE = 1024
+LATENCY_BUFFER_MAX_SIZE = 65536
+
+# count of pending centroids that triggers the compaction of a WindowDigest
+WINDOW_DIGEST_BUFFER_SIZE = 8 * sketch.MAX_PAIRS
+
 logger = logging.getLogger("dbworkload")
 
-from prometheus_client.core import REGISTRY, HistogramMetricFamily
+from prometheus_client.core import (
+    REGISTRY,
+    CounterMetricFamily,
+    HistogramMetricFamily,
+)
 from prometheus_client.registry import Collector
 
 
+def quantile_label(q: float) -> str:
+    """Return the column label of quantile q, eg: p99.9, or max for 1."""
+    return "max" if q == 1 else f"p{q * 100:g}"
+
+
+def parse_quantile_label(label: str) -> float:
+    """Return the quantile of a column label, the reverse of quantile_label()."""
+    return 1.0 if label == "max" else float(label[1:]) / 100
+
+
+def parse_quantiles(quantiles: str) -> list[float]:
+    """Parse a comma separated list of percentiles, eg: '50,99,99.9,100'."""
+    error = ValueError(
+        f"Invalid quantiles '{quantiles}': expected percentiles in (0, 100]"
+    )
+
+    try:
+        qs = sorted(
+            {round(float(x) / 100, 10) for x in quantiles.split(",") if x.strip()}
+        )
+    except ValueError:
+        raise error
+
+    if not qs or any(not 0 < x <= 1 for x in qs):
+        raise error
+
+    return qs
+
+
+def csv_version_line(sketch_name: str) -> str:
+    return f"{CSV_VERSION_PREFIX} version={CSV_VERSION} sketch={sketch_name}\n"
+
+
+def read_csv_settings(path) -> dict:
+    """Return the settings of the version line of a stats CSV file."""
+    with open(path) as f:
+        line = f.readline()
+
+    if not line.startswith(CSV_VERSION_PREFIX):
+        return {"version": "1"}
+
+    return dict(x.split("=", 1) for x in line[len(CSV_VERSION_PREFIX) :].split())
+
+
+def metric_name(id: str) -> str:
+    """Return a valid Prometheus metric name for a txn id."""
+    return re.sub(r"[^a-zA-Z0-9_:]", "_", id)
+
+
+class WindowDigest:
+    """Running merge of the stats reports of a single txn id for a window.
+
+    Incoming sketch pairs are buffered, and folded into the merged sketch once
+    WINDOW_DIGEST_BUFFER_SIZE pairs are pending, in a single compression
+    of all of them. Memory stays flat, and there is little merge work left at
+    report time, no matter how many reports the window received.
+    """
+
+    __slots__ = ("digest", "pending", "pending_size")
+
+    def __init__(self):
+        self.digest = None
+        self.pending: list[np.ndarray] = []
+        self.pending_size = 0
+
+    def add(self, centroids) -> None:
+        # copy, as the centroids can be views into the stats ring
+        arr = np.array(centroids, dtype=float).reshape(-1, 2)
+
+        self.pending.append(arr)
+        self.pending_size += len(arr)
+
+        if self.pending_size >= WINDOW_DIGEST_BUFFER_SIZE:
+            self.compact()
+
+    def compact(self) -> None:
+        if not self.pending:
+            return
+
+        if self.digest is not None:
+            self.pending.append(sketch.pairs(self.digest))
+
+        self.digest = sketch.from_pairs(np.concatenate(self.pending))
+        self.pending = []
+        self.pending_size = 0
+
+    def get_tdigest(self):
+        self.compact()
+        return self.digest if self.digest is not None else sketch.empty()
+
+
 class Stats:
     """Print workload stats
     and export the stats as Prometheus endpoints
     """
 
-    def __init__(self, ts: int):
-        self.cumulative_counts: dict[str, TDigest] = {}
+    def __init__(self, ts: int, quantiles: list = None):
+        self.cumulative_counts: dict[str, object] = {}
         self.instantiation_time = ts
 
-        self.quantiles = [0.50, 0.90, 0.95, 0.99, 1.0]
+        self.quantiles = quantiles or DEFAULT_QUANTILES
 
         self.new_window(ts)
 
     # reset stats while keeping cumulative counts
     def new_window(self, start_time) -> None:
         self.window_start_time: int = start_time
-        self.window_stats: dict[str, list] = {}
+        self.window_stats: dict[str, WindowDigest] = {}
 
-        # hold the ndarray of the combined tdigest
+        # hold the pairs ndarray of the combined sketch
         self.window_stats_centroids: dict[str, np.ndarray] = {}
 
     def add_tds(self, l: list):
         for x in l:
-            self.cumulative_counts.setdefault(x[0], TDigest())
-            self.window_stats.setdefault(x[0], [])
-            self.window_stats[x[0]].append(tdigest.from_centroids(x[1]))
+            self.cumulative_counts.setdefault(x[0], sketch.empty())
+            self.window_stats.setdefault(x[0], WindowDigest()).add(x[1])
 
     # calculate the current stats this instance has collected.
     def calculate_stats(self, active_connections: int, endtime: int) -> list:
@@ -97,21 +212,21 @@ class Stats:
         )
 
         def get_stats_row(id: str):
-            td = tdigest.combine(self.window_stats[id])
+            td = self.window_stats[id].get_tdigest()
 
-            self.window_stats_centroids[id] = tdigest.centroids(td)
+            self.window_stats_centroids[id] = sketch.pairs(td)
 
-            self.cumulative_counts[id] = self.cumulative_counts[id].merge(td)
+            self.cumulative_counts[id] = sketch.merge(self.cumulative_counts[id], td)
             return [
                 elapsed,
                 id,
                 active_connections,
-                tdigest.count(self.cumulative_counts[id]),
-                tdigest.count(self.cumulative_counts[id]) // elapsed,
-                tdigest.count(td),
-                tdigest.count(td) // window_elapsed,
-                round(td.mean() * 1000, 2),
-            ] + [round(x * 1000, 2) for x in td.quantile_vec(self.quantiles)]
+                sketch.count(self.cumulative_counts[id]),
+                sketch.count(self.cumulative_counts[id]) // elapsed,
+                sketch.count(td),
+                sketch.count(td) // window_elapsed,
+                round(sketch.mean(td) * 1000, 2),
+            ] + [round(x * 1000, 2) for x in sketch.quantiles(td, self.quantiles)]
 
         return [get_stats_row(id) for id in sorted(list(self.window_stats.keys()))]
 
@@ -127,12 +242,12 @@ class Stats:
                 elapsed,
                 id,
                 active_connections,
-                tdigest.count(self.cumulative_counts[id]),
-                tdigest.count(self.cumulative_counts[id]) // elapsed,
-                round(self.cumulative_counts[id].mean() * 1000, 2),
+                sketch.count(self.cumulative_counts[id]),
+                sketch.count(self.cumulative_counts[id]) // elapsed,
+                round(sketch.mean(self.cumulative_counts[id]) * 1000, 2),
             ] + [
                 round(x * 1000, 2)
-                for x in self.cumulative_counts[id].quantile_vec(self.quantiles)
+                for x in sketch.quantiles(self.cumulative_counts[id], self.quantiles)
             ]
 
         return [get_stats_row(id) for id in sorted(list(self.window_stats.keys()))]
@@ -146,26 +261,182 @@ class Stats:
         )
 
 
-class WorkerStats:
+class LatencyBuffer:
+    """Preallocated buffer of the latency measurements of a txn id.
+
+    The values are written by index into an array('d'), through a memoryview
+    of it, as memoryview item assignment is cheaper than the array's. The
+    array doubles when full, up to LATENCY_BUFFER_MAX_SIZE values: past that,
+    the values are folded into the sketch of the window, and the array is
+    written again from the start.
+
+    `reset()` only sets the write index back to 0, so the array keeps its
+    capacity across windows and the worker memory stays flat.
+    """
+
+    __slots__ = ("values", "view", "count", "digest")
+
     def __init__(self):
-        self.quantiles = [0.50, 0.90, 0.95, 0.99, 1.0]
+        self.values = array("d", bytes(8 * LATENCY_BUFFER_SIZE))
+        self.view = memoryview(self.values)
+        self.count = 0
+        self.digest = None
+
+    def __bool__(self) -> bool:
+        return self.count > 0 or self.digest is not None
+
+    def add(self, measurement: float) -> None:
+        if self.count == len(self.values):
+            if self.count < LATENCY_BUFFER_MAX_SIZE:
+                # the array cannot be resized while the memoryview exports it
+                self.view.release()
+                self.values.frombytes(bytes(8 * self.count))
+                self.view = memoryview(self.values)
+            else:
+                self.digest = self.get_tdigest()
+                self.count = 0
+
+        self.view[self.count] = measurement
+        self.count += 1
 
+    def get_tdigest(self):
+        if not self.count:
+            return self.digest
+
+        # zero-copy view of the measurements
+        td = sketch.from_values(np.frombuffer(self.values, count=self.count))
+        return td if self.digest is None else sketch.merge(self.digest, td)
+
+    def reset(self) -> None:
+        self.count = 0
+        self.digest = None
+
+
+class WorkerStats:
+    def __init__(self):
+        self.window_stats: dict[str, LatencyBuffer] = {}
         self.new_window()
 
-    # reset stats while keeping cumulative counts
+    # reset stats while keeping the allocated buffers
     def new_window(self) -> None:
         self.window_start_time: float = time.time()
-        self.window_stats: dict[str, list] = {}
+        for buf in self.window_stats.values():
+            buf.reset()
 
     # add one latency measurement in seconds
     def add_latency_measurement(self, id: str, measurement: float) -> None:
-        self.window_stats.setdefault(id, []).append(measurement)
+        # fast path: the buffer exists and is not full
+        try:
+            buf = self.window_stats[id]
+            buf.view[buf.count] = measurement
+            buf.count += 1
+        except (KeyError, IndexError):
+            buf = self.window_stats.get(id)
+            if buf is None:
+                buf = self.window_stats[id] = LatencyBuffer()
+            buf.add(measurement)
+
+    def get_tdigests(self) -> list:
+        return [(id, buf.get_tdigest()) for id, buf in self.window_stats.items() if buf]
 
     def get_tdigest_ndarray(self):
+        return [(id, sketch.pairs(td)) for id, td in self.get_tdigests()]
+
+
+class SupervisorStats:
+    """Merge the stats reports of all worker threads of a supervisor process,
+    so that the MainProcess receives one report per txn id per supervisor
+    instead of one per worker thread.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.new_window()
+
+    def new_window(self) -> None:
+        self.window_stats: dict[str, list] = {}
+        self.flushes = 0
+
+    # called by the worker threads
+    def add_worker_stats(self, ws: WorkerStats) -> None:
+        tds = ws.get_tdigests()
+
+        with self.lock:
+            for id, td in tds:
+                self.window_stats.setdefault(id, []).append(td)
+            self.flushes += 1
+
+    def merge_window(self) -> tuple[list, int]:
+        """Start a new window and return the merged digests of the previous one,
+        along with the count of worker stats reports it holds.
+        """
+        # swap the window under the lock, but merge outside of it
+        # so that the worker threads are not blocked by the merge work.
+        with self.lock:
+            window_stats, flushes = self.window_stats, self.flushes
+            self.new_window()
+
         return [
-            (id, tdigest.centroids(tdigest.from_values(l)))
-            for id, l in self.window_stats.items()
-        ]
+            (id, sketch.combine(l)) for id, l in sorted(window_stats.items())
+        ], flushes
+
+    def restore(self, tds: list, flushes: int) -> None:
+        """Put back a merged window that could not be delivered."""
+        with self.lock:
+            for id, td in tds:
+                self.window_stats.setdefault(id, []).append(td)
+            self.flushes += flushes
+
+
+class TimedLock:
+    """A Lock that measures how long it is waited for and held.
+
+    The counters are only updated while holding the lock, so they need no
+    synchronization of their own. `get_metrics()` returns them in ms, for the
+    window since the previous call.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.acquired_at = 0
+        self.reset()
+
+    def reset(self) -> None:
+        self.acquisitions = 0
+        self.wait_ns = 0
+        self.max_wait_ns = 0
+        self.hold_ns = 0
+        self.max_hold_ns = 0
+
+    def __enter__(self):
+        start = time.perf_counter_ns()
+        self.lock.acquire()
+        self.acquired_at = time.perf_counter_ns()
+
+        wait_ns = self.acquired_at - start
+        self.acquisitions += 1
+        self.wait_ns += wait_ns
+        self.max_wait_ns = max(self.max_wait_ns, wait_ns)
+        return self
+
+    def __exit__(self, *args):
+        hold_ns = time.perf_counter_ns() - self.acquired_at
+        self.hold_ns += hold_ns
+        self.max_hold_ns = max(self.max_hold_ns, hold_ns)
+        self.lock.release()
+
+    def get_metrics(self) -> dict:
+        with self.lock:
+            metrics = {
+                "acquisitions": self.acquisitions,
+                "wait_ms": self.wait_ns / 1e6,
+                "max_wait_ms": self.max_wait_ns / 1e6,
+                "hold_ms": self.hold_ns / 1e6,
+                "max_hold_ms": self.max_hold_ns / 1e6,
+            }
+            self.reset()
+
+        return metrics
 
 
 class CustomHistogram(Collector):
@@ -177,28 +448,100 @@ class CustomHistogram(Collector):
     def get_buckets(self, name):
         td = self.stats.cumulative_counts.get(name)
         if td is None:
-            return [["+Inf", 0]]
+            return 0, [["+Inf", 0]]
 
         # create buckets from 10 ... 180
-        td_count = tdigest.count(td)
-        td_hist = [[x, int(td.cdf((int(x) + 1) / 1000) * td_count)] for x in self.bins]
+        td_count = sketch.count(td)
+        td_hist = [
+            [x, int(sketch.cdf(td, (int(x) + 1) / 1000) * td_count)] for x in self.bins
+        ]
         td_hist.append(["+Inf", td_count])
 
-        return td.mean() * 1000 * td_count, td_hist
+        return sketch.mean(td) * 1000 * td_count, td_hist
 
     def collect(self):
         sum_value, buckets = self.get_buckets(self.name)
         yield HistogramMetricFamily(
-            f"{self.name}_latency_ms",
+            f"{metric_name(self.name)}_latency_ms",
             f"Latency in ms for {self.name}",
             buckets,
             sum_value,
         )
 
 
+class RetryCollector(Collector):
+    """Export the retry counters of the run as counters labeled by txn.
+
+    The counters are cumulative, as returned by Retrier.get_counters().
+    """
+
+    def __init__(self):
+        self.counters: dict[str, list] = {}
+
+    def collect(self):
+        families = [
+            CounterMetricFamily("retries", "count of retries", labels=["txn"]),
+            CounterMetricFamily(
+                "retry_backoff_seconds",
+                "seconds waited before retrying",
+                labels=["txn"],
+            ),
+            CounterMetricFamily(
+                "retries_exhausted",
+                "count of transactions given up after the max retries",
+                labels=["txn"],
+            ),
+            CounterMetricFamily(
+                "retries_over_budget",
+                "count of retries denied by the retry budget",
+                labels=["txn"],
+            ),
+        ]
+
+        for name, values in self.counters.items():
+            for family, v in zip(families, values):
+                family.add_metric([name], v)
+
+        yield from families
+
+
+class PreparedCollector(Collector):
+    """Export the prepared statement counters of the run as counters labeled
+    by txn.
+
+    The counters are cumulative, as returned by PreparedCounters.get_counters().
+    """
+
+    def __init__(self):
+        self.counters: dict[str, list] = {}
+
+    def collect(self):
+        families = [
+            CounterMetricFamily(
+                "prepared_statements",
+                "count of statements run with the psycopg options",
+                labels=["txn"],
+            ),
+            CounterMetricFamily(
+                "prepared_statement_hits",
+                "count of statements that used a prepared statement",
+                labels=["txn"],
+            ),
+        ]
+
+        for name, values in self.counters.items():
+            for family, v in zip(families, values):
+                family.add_metric([name], v)
+
+        yield from families
+
+
 class Prom:
     def __init__(self, prom_port: int = 26260, stats: Stats = None, bins: list = []):
         self.prom_latency: dict[str, list[prom.Gauge]] = {}
+        self.prom_metrics: dict[str, prom.Gauge] = {}
+        self.prom_retries: RetryCollector = None
+        self.prom_prepared: PreparedCollector = None
         self.stats = stats
         self.bins = bins
 
@@ -215,6 +558,7 @@ class Prom:
     def publish(self, report: list, td: dict = {}):
         for row in report:
             id = row[1]
+            name = metric_name(id)
 
             if id not in self.prom_latency:
                 self.prom_latency[id] = []
@@ -222,30 +566,65 @@ class Prom:
                 REGISTRY.register(CustomHistogram(id, self.stats, self.bins))
 
                 self.prom_latency[id].append(
-                    prom.Gauge(f"{id}__tot_ops", "total count of ops")
+                    prom.Gauge(f"{name}__tot_ops", "total count of ops")
                 )
                 self.prom_latency[id].append(
                     prom.Gauge(
-                        f"{id}__tot_ops_s", "derived value from tot_ops / elapsed"
+                        f"{name}__tot_ops_s", "derived value from tot_ops / elapsed"
                     )
                 )
                 self.prom_latency[id].append(
-                    prom.Gauge(f"{id}__period_ops", "ops count for the recent window")
+                    prom.Gauge(f"{name}__period_ops", "ops count for the recent window")
                 )
                 self.prom_latency[id].append(
                     prom.Gauge(
-                        f"{id}__period_ops_s",
+                        f"{name}__period_ops_s",
                         "derived value from period_ops / window duration",
                     )
                 )
+                self.prom_latency[id].append(
+                    prom.Gauge(
+                        f"{name}__latency_quantile_ms",
+                        "latency quantiles in ms for the recent window",
+                        ["quantile"],
+                    )
+                )
 
-            for idx, v in enumerate(row[3:6]):
+            for idx, v in enumerate(row[3:7]):
                 self.prom_latency[id][idx].set(v)
 
+            # the quantiles follow the mean, in the order of Stats.quantiles
+            for q, v in zip(self.stats.quantiles, row[8:]):
+                self.prom_latency[id][4].labels(quantile=f"{q:g}").set(v)
+
         # threads value is the same for all rows
         if report:
             self.threads.set(report[0][2])
 
+    def publish_metrics(self, metrics: dict):
+        """Publish runtime metrics that are not latency series, eg: queue depths."""
+        for name, v in metrics.items():
+            if name not in self.prom_metrics:
+                self.prom_metrics[name] = prom.Gauge(name, name.replace("_", " "))
+
+            self.prom_metrics[name].set(v)
+
+    def publish_retries(self, counters: dict[str, list]):
+        """Publish the cumulative retry counters of the run, by txn."""
+        if not self.prom_retries:
+            self.prom_retries = RetryCollector()
+            REGISTRY.register(self.prom_retries)
+
+        self.prom_retries.counters = counters
+
+    def publish_prepared(self, counters: dict[str, list]):
+        """Publish the cumulative prepared statement counters of the run, by txn."""
+        if not self.prom_prepared:
+            self.prom_prepared = PreparedCollector()
+            REGISTRY.register(self.prom_prepared)
+
+        self.prom_prepared.counters = counters
+
 
 class CustomLogFilter(logging.Filter):
 
@@ -278,6 +657,7 @@ def get_driver_from_scheme(scheme: str):
         "spanner": "spanner",
         "fdb": "foundationdb",
         "foundationdb": "foundationdb",
+        "mock": "mock",
     }.get(scheme, None)
 
 
@@ -299,6 +679,26 @@ def set_query_parameter(url: str, param_name: str, param_value: str):
     return urllib.parse.urlunsplit((scheme, netloc, path, new_query_string, fragment))
 
 
+def pop_query_parameters(url: str, param_names: list[str]):
+    """convenience function to remove query parameters from a url
+
+    Args:
+        url (str): The URL string
+        param_names (list[str]): the parameters to remove
+
+    Returns:
+        tuple[str, dict]: the new URL, and the removed parameters with their last value
+    """
+    scheme, netloc, path, query_string, fragment = urllib.parse.urlsplit(url)
+    query_params = urllib.parse.parse_qs(query_string, keep_blank_values=True)
+    popped = {k: query_params.pop(k)[-1] for k in param_names if k in query_params}
+    new_query_string = urllib.parse.urlencode(query_params, doseq=True)
+    return (
+        urllib.parse.urlunsplit((scheme, netloc, path, new_query_string, fragment)),
+        popped,
+    )
+
+
 def import_class_at_runtime(path: str):
     """Imports a class with a name derived from the module name.
     Example: 'workloads/bank.py' returns class 'Bank' in module 'bank'
@@ -0,0 +1,185 @@
+#!/usr/bin/python
+
+"""HTTP control server, to add or remove connections while a workload runs.
+
+It is started by the runtimes that support it, which provide the callbacks
+that apply the requested change.
+"""
+
+import json
+import logging
+import socket
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from urllib.parse import parse_qs, urlparse
+
+logger = logging.getLogger("dbworkload")
+
+CONTROL_BIND_IPV4 = "0.0.0.0"
+CONTROL_BIND_IPV6 = "::"
+
+
+class IPv6ThreadingHTTPServer(ThreadingHTTPServer):
+    """ThreadingHTTPServer variant that binds an IPv6 socket only.
+
+    dbworkload starts one IPv4 listener and one IPv6 listener on the same port.
+    Setting IPV6_V6ONLY avoids the common dual-stack ambiguity where binding
+    [::] may also claim 0.0.0.0 on some platforms.
+    """
+
+    address_family = socket.AF_INET6
+
+    def server_bind(self) -> None:
+        try:
+            self.socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        except OSError:
+            logger.debug("Could not set IPV6_V6ONLY on control server socket.")
+        super().server_bind()
+
+
+def make_control_handler(request_adjustment, requested_count, active_count):
+    """Return the request handler class of the control server.
+
+    `request_adjustment(adjust_count)` applies a change to the target
+    connection count and returns `(changed, previous_target, target)`.
+    `requested_count()` and `active_count()` return the target and the
+    actual connection counts.
+    """
+
+    class ControlHandler(BaseHTTPRequestHandler):
+        """HTTP control endpoint for live concurrency adjustment."""
+
+        server_version = "dbworkload-control"
+        sys_version = ""
+
+        def log_message(self, format: str, *args) -> None:
+            logger.debug("control server: " + format, *args)
+
+        def send_json(self, status: int, payload: dict) -> None:
+            body = json.dumps(payload, sort_keys=True).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self) -> None:
+            parsed = urlparse(self.path)
+            values = parse_qs(parsed.query, keep_blank_values=True)
+
+            if parsed.path != "/" or "adjust_count" not in values:
+                self.send_json(
+                    400,
+                    {
+                        "error": "expected GET /?adjust_count=<integer>",
+                        "target_connections": requested_count(),
+                        "active_connections": active_count(),
+                    },
+                )
+                return
+
+            try:
+                adjust_count = int(values["adjust_count"][0])
+            except (TypeError, ValueError):
+                self.send_json(
+                    400,
+                    {
+                        "error": "adjust_count must be a positive or negative integer",
+                        "target_connections": requested_count(),
+                        "active_connections": active_count(),
+                    },
+                )
+                return
+
+            changed, previous_target, target_cc = request_adjustment(adjust_count)
+            if target_cc == previous_target:
+                self.send_json(
+                    200,
+                    {
+                        "adjust_count": adjust_count,
+                        "active_connections": active_count(),
+                        "changed": False,
+                        "target_connections": previous_target,
+                    },
+                )
+                return
+
+            if not changed:
+                self.send_json(
+                    409,
+                    {
+                        "error": "worker adjustment already in progress",
+                        "active_connections": active_count(),
+                        "target_connections": requested_count(),
+                    },
+                )
+                return
+
+            logger.info(
+                "HTTP control adjusted target connections by %s: %s -> %s",
+                adjust_count,
+                previous_target,
+                target_cc,
+            )
+            self.send_json(
+                200,
+                {
+                    "adjust_count": adjust_count,
+                    "active_connections": active_count(),
+                    "changed": True,
+                    "target_connections": target_cc,
+                },
+            )
+
+    return ControlHandler
+
+
+def start_control_server(
+    control_port: int, handler, runtime: str
+) -> list[ThreadingHTTPServer]:
+    """Start one IPv4 and one IPv6 listener, and return the running servers."""
+    servers = []
+
+    if not control_port:
+        logger.info(f"{runtime} HTTP control server disabled.")
+        return servers
+
+    listeners = [
+        (ThreadingHTTPServer, CONTROL_BIND_IPV4),
+        (IPv6ThreadingHTTPServer, CONTROL_BIND_IPV6),
+    ]
+
+    for server_cls, host in listeners:
+        try:
+            server = server_cls((host, control_port), handler)
+        except OSError as e:
+            logger.warning(
+                "Could not start %s HTTP control server on %s:%s: %s",
+                runtime,
+                host,
+                control_port,
+                e,
+            )
+            continue
+
+        server_thread = Thread(
+            target=server.serve_forever,
+            daemon=True,
+            name=f"dbworkload-control-{host}",
+        )
+        server_thread.start()
+        servers.append(server)
+        logger.info(
+            "%s HTTP control server listening on %s:%s",
+            runtime,
+            host,
+            control_port,
+        )
+
+    return servers
+
+
+def stop_control_servers(servers: list[ThreadingHTTPServer]) -> None:
+    for server in servers:
+        server.shutdown()
+        server.server_close()
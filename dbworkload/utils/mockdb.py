@@ -0,0 +1,226 @@
+#!/usr/bin/python
+
+"""Mock database driver.
+
+Connections don't talk to any database: every statement just waits for a
+latency drawn from a configurable distribution. This measures how many ops/s
+dbworkload itself can drive, and how accurate its stats are, as the latency
+distribution is known.
+
+Parameters, passed as URI query parameters or `--uri` key-value pairs:
+
+- `dist`: the latency distribution, one of LATENCY_DISTRIBUTIONS.
+    - `none`: statements return right away, to measure the harness ceiling.
+    - `fixed`: every statement takes `latency` ms.
+    - `lognormal`: the median is `latency` ms, with shape `sigma`.
+    - `bimodal`: `slow_pct` percent of the statements take `slow_latency` ms,
+      the others `latency` ms.
+- `stall_every`, `stall_duration`: every `stall_every` seconds, all statements
+  block for `stall_duration` seconds, as if the database paused. Stalls are
+  aligned on the wall clock, so all connections of all processes stall at once.
+- `seed`: seed for the latency samples of each connection.
+"""
+
+import asyncio
+import math
+import random
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+LATENCY_DISTRIBUTIONS = ["none", "fixed", "lognormal", "bimodal"]
+
+MOCK_DEFAULT_LATENCY = 1
+MOCK_DEFAULT_SIGMA = 0.5
+MOCK_DEFAULT_SLOW_PCT = 1
+MOCK_DEFAULT_SLOW_LATENCY = 100
+
+
+class Latency:
+    """Sample the latency of a statement, in seconds."""
+
+    def __init__(
+        self,
+        dist: str = "fixed",
+        latency: float = MOCK_DEFAULT_LATENCY,
+        sigma: float = MOCK_DEFAULT_SIGMA,
+        slow_pct: float = MOCK_DEFAULT_SLOW_PCT,
+        slow_latency: float = MOCK_DEFAULT_SLOW_LATENCY,
+        stall_every: float = 0,
+        stall_duration: float = 0,
+        seed: int = None,
+    ):
+        if dist not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(
+                f"Unknown latency distribution '{dist}'. "
+                f"The possible values are {', '.join(LATENCY_DISTRIBUTIONS)}."
+            )
+
+        self.dist = dist
+        self.latency = float(latency) / 1000
+        self.sigma = float(sigma)
+        self.slow_pct = float(slow_pct) / 100
+        self.slow_latency = float(slow_latency) / 1000
+        self.stall_every = float(stall_every)
+        self.stall_duration = float(stall_duration)
+        self.random = random.Random(seed)
+
+        if self.stall_duration >= self.stall_every > 0:
+            raise ValueError("stall_duration must be shorter than stall_every.")
+
+    def sample(self) -> float:
+        """Return the latency of the next statement, including any stall."""
+        if self.dist == "none":
+            latency = 0
+        elif self.dist == "fixed":
+            latency = self.latency
+        elif self.dist == "lognormal":
+            latency = self.random.lognormvariate(math.log(self.latency), self.sigma)
+        else:
+            latency = (
+                self.slow_latency
+                if self.random.random() < self.slow_pct
+                else self.latency
+            )
+
+        if self.stall_every:
+            # time left until the end of the current stall, if any
+            elapsed = time.time() % self.stall_every
+            if elapsed < self.stall_duration:
+                latency += self.stall_duration - elapsed
+
+        return latency
+
+
+class MockCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def execute(self, query=None, params=None, **kwargs):
+        self.conn.execute(query, params)
+        self.rowcount = 1
+        return self
+
+    def executemany(self, query=None, params_seq=(), **kwargs):
+        for params in params_seq:
+            self.execute(query, params)
+
+    def fetchone(self):
+        return ()
+
+    def fetchmany(self, size: int = 0):
+        return []
+
+    def fetchall(self):
+        return []
+
+    def close(self):
+        pass
+
+
+class MockConnection:
+    """Connection of the mock driver, mimicking a DB-API connection.
+
+    `executed` and `simulated` count the statements and their total simulated
+    latency, the ground truth to compare the reported stats with.
+    """
+
+    def __init__(self, **params):
+        self.latency = Latency(**params)
+        self.autocommit = True
+        self.executed = 0
+        self.simulated = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def execute(self, query=None, params=None, **kwargs):
+        latency = self.latency.sample()
+        if latency:
+            time.sleep(latency)
+
+        self.executed += 1
+        self.simulated += latency
+        return MockCursor(self)
+
+    def cursor(self, *args, **kwargs):
+        return MockCursor(self)
+
+    @contextmanager
+    def transaction(self):
+        yield self
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class AsyncMockCursor(MockCursor):
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+    async def execute(self, query=None, params=None, **kwargs):
+        await self.conn.execute(query, params)
+        self.rowcount = 1
+        return self
+
+    async def executemany(self, query=None, params_seq=(), **kwargs):
+        for params in params_seq:
+            await self.execute(query, params)
+
+    async def fetchone(self):
+        return ()
+
+    async def fetchmany(self, size: int = 0):
+        return []
+
+    async def fetchall(self):
+        return []
+
+
+class AsyncMockConnection(MockConnection):
+    """Connection of the mock driver for the asyncio runtime."""
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+    async def execute(self, query=None, params=None, **kwargs):
+        latency = self.latency.sample()
+        await asyncio.sleep(latency)
+
+        self.executed += 1
+        self.simulated += latency
+        return AsyncMockCursor(self)
+
+    def cursor(self, *args, **kwargs):
+        return AsyncMockCursor(self)
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield self
+
+    async def commit(self):
+        pass
+
+    async def rollback(self):
+        pass
@@ -0,0 +1,51 @@
+#!/usr/bin/python
+
+"""Pipeline mode for psycopg workloads.
+
+With `--pipeline`, the consecutive workload functions of a cycle marked with
+`@pipelineable` are sent together in one psycopg pipeline, and their results
+are read at a single sync point: over a high latency link, they take one round
+trip instead of one each.
+
+A function can be pipelined if it doesn't need the results of its statements
+before the sync point. Fetching a result within a pipeline is still correct,
+but psycopg then waits for it, which gives up the round trip saved.
+"""
+
+
+def pipelineable(func):
+    """Mark a workload function as safe to run in a pipeline.
+
+    ```python
+    from dbworkload.utils.pipeline import pipelineable
+
+    @pipelineable
+    def txn_insert(self, conn):
+        conn.execute("INSERT INTO kv (k, v) VALUES (%s, %s)", (k, v))
+    ```
+    """
+    func.pipelineable = True
+    return func
+
+
+def iter_batches(txns):
+    """Group the consecutive pipelineable functions of a cycle in lists.
+
+    The other functions are yielded as they are. To know where a batch ends,
+    the functions returned by loop() are read one ahead.
+    """
+    batch = []
+
+    for txn in txns:
+        if getattr(txn, "pipelineable", False):
+            batch.append(txn)
+            continue
+
+        if batch:
+            yield batch
+            batch = []
+
+        yield txn
+
+    if batch:
+        yield batch
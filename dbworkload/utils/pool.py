@@ -0,0 +1,289 @@
+#!/usr/bin/python
+
+"""Connection pools shared by the worker threads of a process.
+
+With `--pool-size`, workers don't own a connection: like the request threads
+of an application, they check one out of the pool of their process for every
+cycle, and give it back at the end of the cycle.
+
+The driver pool is used where there is one. Every pool is also gated by
+`size` permits, handed over to the waiting workers in FIFO order, so that the
+time waited for a connection, and how often the pool was exhausted, are
+measured the same way for all drivers, whether or not the driver pool blocks
+when it is exhausted. A plain Semaphore is not fair: the worker returning a
+connection would usually take it back at once, starving the others.
+"""
+
+import logging
+import queue
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock
+
+from dbworkload.connection import ConnInfo
+from dbworkload.utils.prepared import configure_connection
+
+logger = logging.getLogger("dbworkload")
+
+POOL_DRIVERS = ["postgres", "mysql", "maria", "oracle", "mongo", "mock"]
+
+# mysql-connector-python does not allow larger pools
+MYSQL_POOL_MAX_SIZE = 32
+
+
+class Pool:
+    """Base class of the pools, subclasses implement getconn() and putconn().
+
+    `connection()` is called by the worker threads. The counters are read by
+    `get_metrics()` for the window since its previous call.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.lock = Lock()
+        self.in_use = 0
+        # the workers waiting for a permit, each blocked on its own Lock
+        self.waiters: deque[Lock] = deque()
+        self.reset()
+
+    def reset(self) -> None:
+        self.checkouts = 0
+        self.waits = 0
+        self.peak_in_use = self.in_use
+
+    def getconn(self):
+        raise NotImplementedError
+
+    def putconn(self, conn, broken: bool = False) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection, waiting for one if the pool is exhausted.
+
+        The connection is discarded rather than put back if the block raised.
+        """
+        waiter = None
+
+        with self.lock:
+            self.checkouts += 1
+
+            if self.in_use < self.size and not self.waiters:
+                self.in_use += 1
+                self.peak_in_use = max(self.peak_in_use, self.in_use)
+            else:
+                self.waits += 1
+                waiter = Lock()
+                waiter.acquire()
+                self.waiters.append(waiter)
+
+        if waiter:
+            # released by release(), which hands over its permit
+            waiter.acquire()
+
+        try:
+            conn = self.getconn()
+            try:
+                yield conn
+            except BaseException:
+                self.putconn(conn, broken=True)
+                raise
+            self.putconn(conn)
+        finally:
+            self.release()
+
+    def release(self) -> None:
+        with self.lock:
+            if self.waiters:
+                self.waiters.popleft().release()
+            else:
+                self.in_use -= 1
+
+    def get_metrics(self) -> dict:
+        with self.lock:
+            metrics = {
+                "pool_size": self.size,
+                "pool_in_use": self.in_use,
+                "pool_peak_in_use": self.peak_in_use,
+                "pool_checkouts": self.checkouts,
+                "pool_waits": self.waits,
+            }
+            self.reset()
+
+        return metrics
+
+
+class QueuePool(Pool):
+    """Pool of the connections returned by `connect()`, for drivers without one.
+
+    Connections are opened on demand, and the permits keep them to `size`.
+    """
+
+    def __init__(self, size: int, connect):
+        super().__init__(size)
+        self.connect = connect
+        self.idle = queue.LifoQueue()
+
+    def getconn(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return self.connect()
+
+    def putconn(self, conn, broken: bool = False) -> None:
+        if broken:
+            close_quietly(conn)
+        else:
+            self.idle.put(conn)
+
+    def close(self) -> None:
+        while True:
+            try:
+                close_quietly(self.idle.get_nowait())
+            except queue.Empty:
+                return
+
+
+class PsycopgPool(Pool):
+    def __init__(self, size: int, conn_info: ConnInfo, max_lifetime: int = None):
+        from psycopg_pool import ConnectionPool
+
+        super().__init__(size)
+
+        params = dict(conn_info.params)
+        self.pool = ConnectionPool(
+            params.pop("conninfo", ""),
+            kwargs={**params, "connect_timeout": 5},
+            min_size=size,
+            max_size=size,
+            # reconnect every --conn-duration, as the workers do without a pool
+            max_lifetime=max_lifetime or 3600,
+            configure=lambda conn: configure_connection(conn, conn_info.extras),
+            open=True,
+        )
+
+    def getconn(self):
+        return self.pool.getconn()
+
+    def putconn(self, conn, broken: bool = False) -> None:
+        # the pool replaces the connections returned closed
+        if broken:
+            close_quietly(conn)
+        self.pool.putconn(conn)
+
+    def close(self) -> None:
+        self.pool.close()
+
+
+class OraclePool(Pool):
+    def __init__(self, size: int, conn_info: ConnInfo):
+        import oracledb
+
+        super().__init__(size)
+
+        self.autocommit = conn_info.extras.get("autocommit", False)
+        self.pool = oracledb.create_pool(
+            min=size, max=size, increment=0, **conn_info.params
+        )
+
+    def getconn(self):
+        conn = self.pool.acquire()
+        conn.autocommit = self.autocommit
+        return conn
+
+    def putconn(self, conn, broken: bool = False) -> None:
+        if broken:
+            self.pool.drop(conn)
+        else:
+            self.pool.release(conn)
+
+    def close(self) -> None:
+        self.pool.close(force=True)
+
+
+class MySQLPool(Pool):
+    def __init__(self, size: int, conn_info: ConnInfo):
+        from mysql.connector.pooling import MySQLConnectionPool
+
+        if size > MYSQL_POOL_MAX_SIZE:
+            raise ValueError(
+                f"The mysql driver pools are limited to {MYSQL_POOL_MAX_SIZE} "
+                f"connections per process, got {size}. Use more --procs."
+            )
+
+        super().__init__(size)
+
+        self.pool = MySQLConnectionPool(pool_size=size, **conn_info.params)
+
+    def getconn(self):
+        return self.pool.get_connection()
+
+    def putconn(self, conn, broken: bool = False) -> None:
+        # closing a pooled connection resets it and puts it back in the pool
+        close_quietly(conn)
+
+
+class MongoPool(Pool):
+    """A single MongoClient, which pools its connections internally.
+
+    The client is thread-safe, so every checkout returns the same client, and
+    the permits cap the count of workers using it at once.
+    """
+
+    def __init__(self, size: int, conn_info: ConnInfo):
+        import pymongo
+
+        super().__init__(size)
+
+        self.client = pymongo.MongoClient(**conn_info.params, maxPoolSize=size)
+
+    def getconn(self):
+        return self.client
+
+    def putconn(self, conn, broken: bool = False) -> None:
+        pass
+
+    def close(self) -> None:
+        self.client.close()
+
+
+def close_quietly(conn) -> None:
+    try:
+        conn.close()
+    except Exception as e:
+        logger.debug(f"Could not close a pooled connection: {e}")
+
+
+def create_pool(
+    driver: str, conn_info: ConnInfo, size: int, max_lifetime: int = None
+) -> Pool:
+    """Return a pool of `size` connections for driver."""
+    if driver == "postgres":
+        return PsycopgPool(size, conn_info, max_lifetime)
+    elif driver == "mysql":
+        return MySQLPool(size, conn_info)
+    elif driver == "maria":
+        import mariadb
+
+        return QueuePool(size, lambda: mariadb.connect(**conn_info.params))
+    elif driver == "oracle":
+        return OraclePool(size, conn_info)
+    elif driver == "mongo":
+        return MongoPool(size, conn_info)
+    elif driver == "mock":
+        from dbworkload.utils.mockdb import MockConnection
+
+        return QueuePool(size, lambda: MockConnection(**conn_info.params))
+
+    raise ValueError(
+        f"--pool-size is not supported for driver '{driver}'. "
+        f"Supported drivers: {', '.join(POOL_DRIVERS)}"
+    )
+
+
+def get_saturation(metrics: dict) -> float:
+    """Return the peak share of the pool in use, from summed pool metrics."""
+    return round(metrics["pool_peak_in_use"] / max(1, metrics["pool_size"]), 2)
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+
+"""Prepared statements and binary transfer for the psycopg connections.
+
+These options are read from the query parameters of the postgres URI, and
+kept in ConnInfo.extras as psycopg would not accept them in the conninfo:
+
+- `prepare_threshold`: the count of executions of a query after which it is
+  prepared on the server. `0` prepares every query from the first execution,
+  `none` disables prepared statements.
+- `prepared_max`: the count of prepared statements cached by each connection.
+- `binary`: `true` to transfer the query results in binary format.
+
+When any of them is set, the statements run on each connection are counted,
+along with how many of them used a statement already prepared on the
+server. The workers add them up by txn in the PreparedCounters of their
+process, which are sent to the MainProcess with the supervisor metrics.
+
+The counts are taken by wrapping the PrepareManager of the connection, which
+is the only place where psycopg decides whether a query uses a prepared
+statement.
+"""
+
+from threading import Lock
+
+PSYCOPG_OPTIONS = ["prepare_threshold", "prepared_max", "binary"]
+
+
+class PreparedCounter:
+    """Count the statements of a connection, and the prepared statement hits."""
+
+    def __init__(self, manager):
+        self.executed = 0
+        self.hits = 0
+
+        self.get = manager.get
+        manager.get = self.count
+
+    def count(self, query, prepare=None):
+        prep, name = self.get(query, prepare)
+
+        self.executed += 1
+        if prep.name == "YES":
+            self.hits += 1
+
+        return prep, name
+
+
+class PreparedCounters:
+    """Count the statements of the workers of a process, and the prepared
+    statement hits, by txn.
+
+    The counters are cumulative since the start of the run.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counters: dict[str, list] = {}
+
+    def add(self, name: str, executed: int, hits: int) -> None:
+        with self.lock:
+            counters = self.counters.setdefault(name, [0, 0])
+            counters[0] += executed
+            counters[1] += hits
+
+    def get_counters(self) -> dict[str, list]:
+        """Return [statements, hits] by txn."""
+        with self.lock:
+            return {k: list(v) for k, v in self.counters.items()}
+
+
+def merge_prepared_counters(counters: list[dict]) -> dict[str, list]:
+    """Sum the counters of several PreparedCounters."""
+    totals = {}
+
+    for x in counters:
+        for name, values in x.items():
+            total = totals.setdefault(name, [0, 0])
+            total[0] += values[0]
+            total[1] += values[1]
+
+    return totals
+
+
+def configure_connection(conn, extras: dict) -> None:
+    """Apply the PSYCOPG_OPTIONS in extras to a psycopg connection."""
+    if not any(x in extras for x in PSYCOPG_OPTIONS):
+        return
+
+    conn.dbworkload_prepared = PreparedCounter(conn._prepared)
+
+    if "prepare_threshold" in extras:
+        threshold = str(extras["prepare_threshold"])
+        conn.prepare_threshold = None if threshold.lower() == "none" else int(threshold)
+
+    if "prepared_max" in extras:
+        conn.prepared_max = int(extras["prepared_max"])
+
+    if str(extras.get("binary", "")).lower() in ["true", "1", "yes", "on"]:
+        conn.cursor_factory = binary_cursor_factory(conn.cursor_factory)
+
+
+def binary_cursor_factory(cursor_factory):
+    """Return a cursor factory whose cursors default to the binary format.
+
+    Both Connection.cursor() and Connection.execute() use the factory, and
+    an explicit `binary=False` still applies to a single query.
+    """
+    from psycopg.pq import Format
+
+    def cursor(*args, **kwargs):
+        cur = cursor_factory(*args, **kwargs)
+        cur.format = Format.BINARY
+        return cur
+
+    return cursor
+
+
+def get_prepared_counter(conn) -> PreparedCounter | None:
+    return getattr(conn, "dbworkload_prepared", None)
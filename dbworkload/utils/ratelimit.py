@@ -0,0 +1,63 @@
+#!/usr/bin/python
+
+import time
+from threading import Lock
+
+RATE_LIMITERS = ["token-bucket", "pause"]
+RATE_LIMITER_REFRESH = 0.1
+RATE_LIMITER_BURST = 1
+
+
+class TokenBucket:
+    """Token bucket rate limiter shared by the worker threads of a process.
+
+    It is implemented as a GCRA (virtual scheduling): instead of a token count
+    refilled by a timer, it only keeps `tat`, the time the next token is due.
+    Every reservation moves `tat` forward by 1/rate, so reserving is O(1),
+    needs no background thread, and tells the caller when it may start.
+
+    `rate` is a callable returning the current rate, read every
+    RATE_LIMITER_REFRESH seconds, so the rate follows the schedule and the
+    share of the workers of this process. A rate of 0 disables the limiter.
+
+    `burst` is the count of unused tokens that can be caught up at once after
+    the workers fell behind. With None, no token is ever skipped: every
+    reservation is due exactly 1/rate after the previous one, which is the
+    intended start time needed for coordinated omission correction.
+    """
+
+    def __init__(self, rate, burst: int = RATE_LIMITER_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.lock = Lock()
+        self.tat = 0
+        self.interval = 0
+        self.refresh_time = 0
+
+    def reserve(self) -> int:
+        """Reserve one token.
+
+        Returns the `time.perf_counter_ns` time at which the token is due,
+        possibly in the past, or 0 if the limiter is disabled.
+        """
+        with self.lock:
+            now = time.perf_counter_ns()
+
+            if now >= self.refresh_time:
+                rate = self.rate()
+                self.interval = int(1e9 / rate) if rate > 0 else 0
+                self.refresh_time = now + int(RATE_LIMITER_REFRESH * 1e9)
+
+            if not self.interval:
+                self.tat = 0
+                return 0
+
+            if not self.tat:
+                tat = now
+            elif self.burst is None:
+                tat = self.tat
+            else:
+                tat = max(self.tat, now - self.burst * self.interval)
+
+            self.tat = tat + self.interval
+            return tat
@@ -0,0 +1,338 @@
+#!/usr/bin/python
+
+"""Run results saved with `--save`: a row of stats per txn id and window.
+
+Each row carries the pairs of the latency sketch of the window, so that the
+results of several runs can be merged later. Results are saved as:
+
+- `csv`, the default: the pairs are a `;` separated text cell. A version line
+  records the sketch, see `common.csv_version_line()`.
+- `parquet`: the pairs are a list<fixed_size_list<double, 2>> column, so
+  that they are read as a 2-dims view of the Arrow buffers, and the run
+  settings are in the schema metadata. Every window is a row group, and the
+  file is only readable once closed: the run closes it even when it stops
+  early, but not when the process is killed. Requires pyarrow.
+
+The results are saved, and the stats reports printed, by a ReportWriter
+thread, so that a slow disk or terminal doesn't delay the coordinator.
+"""
+
+import json
+import logging
+import queue
+import traceback
+from threading import Thread
+
+import numpy as np
+import pandas as pd
+
+from dbworkload import __version__
+from dbworkload.utils import common
+
+logger = logging.getLogger("dbworkload")
+
+SAVE_FORMATS = ["csv", "parquet"]
+
+# the count of windows the ReportWriter can be behind before the coordinator
+# waits for it, several minutes of reports
+REPORT_QUEUE_SIZE = 32
+
+# the key of the dbworkload settings in the schema metadata of parquet files
+PARQUET_METADATA_KEY = b"dbworkload"
+
+
+def require_pyarrow():
+    try:
+        import pyarrow
+    except ImportError as exc:
+        raise RuntimeError(
+            "Parquet results require the optional dependency: "
+            "install dbworkload[parquet]."
+        ) from exc
+
+    return pyarrow
+
+
+def get_columns(quantiles: list = common.DEFAULT_QUANTILES) -> list[str]:
+    """Return the columns of the results, but the centroids."""
+    return [
+        "ts",
+        "elapsed",
+        "id",
+        "threads",
+        "tot_ops",
+        "tot_ops_s",
+        "period_ops",
+        "period_ops_s",
+        "mean_ms",
+    ] + [f"{common.quantile_label(x)}_ms" for x in quantiles]
+
+
+class ResultWriter:
+    """Base class of the writers, subclasses implement write() and close().
+
+    `write()` is called with the stats report of a window and the iterator of
+    its centroids, as returned by `Stats.calculate_stats()` and
+    `Stats.get_centroids()`.
+    """
+
+    extension = None
+
+    def __init__(
+        self,
+        run_name: str,
+        quantiles: list,
+        sketch_name: str,
+        metadata: dict = None,
+    ):
+        self.path = run_name + self.extension
+        self.quantiles = quantiles
+        self.columns = get_columns(quantiles)
+        self.sketch_name = sketch_name
+        self.metadata = metadata or {}
+
+    def write(self, endtime: int, report: list, centroids) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class CsvResultWriter(ResultWriter):
+    extension = ".csv"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # open a new csv file and just write the header columns
+        self.f = open(self.path, "w")
+        self.f.write(common.csv_version_line(self.sketch_name))
+        self.f.write(",".join(self.columns + ["centroids"]) + "\n")
+
+    def write(self, endtime: int, report: list, centroids) -> None:
+        for row in report:
+            self.f.write(f"{endtime},{','.join(map(str, row))},")
+            np.savetxt(self.f, next(centroids), newline=";")
+            self.f.write("\n")
+
+        # the file can be followed while the run is running
+        self.f.flush()
+
+    def close(self) -> None:
+        self.f.close()
+
+
+class ParquetResultWriter(ResultWriter):
+    extension = ".parquet"
+
+    def __init__(self, *args, **kwargs):
+        self.pa = require_pyarrow()
+        import pyarrow.parquet as pq
+
+        super().__init__(*args, **kwargs)
+
+        pa = self.pa
+        # a (value, weight) pair
+        self.centroid_type = pa.list_(pa.float64(), 2)
+        self.schema = pa.schema(
+            [(x, pa.int64()) for x in self.columns[:2]]
+            + [("id", pa.string())]
+            + [(x, pa.int64()) for x in self.columns[3:8]]
+            + [(x, pa.float64()) for x in self.columns[8:]]
+            + [("centroids", pa.list_(self.centroid_type))],
+            metadata={
+                PARQUET_METADATA_KEY: json.dumps(
+                    {
+                        "version": common.CSV_VERSION,
+                        "sketch": self.sketch_name,
+                        "quantiles": self.quantiles,
+                        "dbworkload": __version__,
+                        **self.metadata,
+                    },
+                    default=str,
+                )
+            },
+        )
+        self.writer = pq.ParquetWriter(self.path, self.schema)
+
+    def write(self, endtime: int, report: list, centroids) -> None:
+        if not report:
+            return
+
+        pa = self.pa
+
+        columns = [[endtime] * len(report)] + [list(x) for x in zip(*report)]
+        pairs = [
+            np.asarray(next(centroids), dtype=float).reshape(-1, 2) for _ in report
+        ]
+
+        # the pairs of all rows in a flat array, sliced by the list offsets
+        offsets = np.zeros(len(pairs) + 1, dtype=np.int32)
+        np.cumsum([len(x) for x in pairs], out=offsets[1:])
+        flat = np.concatenate(pairs).ravel()
+
+        arrays = [
+            pa.array(x, type=self.schema.field(i).type) for i, x in enumerate(columns)
+        ] + [
+            pa.ListArray.from_arrays(
+                pa.array(offsets), pa.FixedSizeListArray.from_arrays(pa.array(flat), 2)
+            )
+        ]
+
+        self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+WRITERS = {
+    "csv": CsvResultWriter,
+    "parquet": ParquetResultWriter,
+}
+
+
+class ReportWriter:
+    """Save and print the stats reports of the windows in a thread.
+
+    The coordinator puts the report of every window in a bounded queue, and
+    the thread writes it with the ResultWriter and prints it with
+    `print_report`, either of which can be None. The coordinator only waits
+    if the thread is REPORT_QUEUE_SIZE windows behind.
+    """
+
+    def __init__(self, writer: ResultWriter = None, print_report=None):
+        self.writer = writer
+        self.print_report = print_report
+        self.q = queue.Queue(maxsize=REPORT_QUEUE_SIZE)
+        self.thread = Thread(
+            target=self.run, daemon=True, name="dbworkload-report-writer"
+        )
+        self.thread.start()
+
+    def put(self, endtime: int, report: list, centroids) -> None:
+        if not self.writer and not self.print_report:
+            return
+
+        item = (endtime, report, list(centroids))
+
+        try:
+            self.q.put_nowait(item)
+        except queue.Full:
+            logger.warning(
+                f"The stats reports are {REPORT_QUEUE_SIZE} windows behind: "
+                "waiting for the disk or terminal to catch up"
+            )
+            self.q.put(item)
+
+    def run(self) -> None:
+        while True:
+            item = self.q.get()
+            if item is None:
+                return
+
+            endtime, report, centroids = item
+
+            if self.writer:
+                try:
+                    self.writer.write(endtime, report, iter(centroids))
+                except Exception:
+                    logger.error(
+                        f"Could not save the stats to '{self.writer.path}', "
+                        f"saving is disabled: {traceback.format_exc()}"
+                    )
+                    self.writer = None
+
+            if self.print_report:
+                self.print_report(report)
+
+    def close(self) -> None:
+        """Save and print the queued reports, then close the ResultWriter.
+
+        Closing again, e.g. when the run exits early, does nothing.
+        """
+        if self.thread.is_alive():
+            self.q.put(None)
+            self.thread.join()
+
+        if self.writer:
+            writer, self.writer = self.writer, None
+            writer.close()
+
+
+def create_result_writer(
+    save_format: str,
+    run_name: str,
+    quantiles: list,
+    sketch_name: str,
+    metadata: dict = None,
+) -> ResultWriter:
+    """Return the writer of the results of run_name, in save_format."""
+    if save_format not in WRITERS:
+        raise ValueError(
+            f"Unknown save format '{save_format}'. "
+            f"The possible values are {', '.join(SAVE_FORMATS)}."
+        )
+
+    return WRITERS[save_format](
+        run_name, quantiles or common.DEFAULT_QUANTILES, sketch_name, metadata=metadata
+    )
+
+
+def is_results_file(path: str) -> bool:
+    return path.endswith(tuple(x.extension for x in WRITERS.values()))
+
+
+def read_results(path, centroids: bool = False) -> tuple[pd.DataFrame, dict]:
+    """Read a results file, and return its rows and settings.
+
+    With `centroids`, the centroids column holds the pairs of every row as a
+    2-dims np.array, else it is dropped.
+    """
+    path = str(path)
+
+    if path.endswith(ParquetResultWriter.extension):
+        return read_parquet_results(path, centroids)
+
+    settings = common.read_csv_settings(path)
+    df = pd.read_csv(path, comment="#")
+
+    if centroids:
+        # convert the `centroids` string to a 2-dims np.array
+        df["centroids"] = (
+            df["centroids"].apply(str.split, args=(";",)).apply(np.genfromtxt)
+        )
+    else:
+        df = df.drop(columns="centroids")
+
+    return df, settings
+
+
+def read_parquet_results(path: str, centroids: bool = False) -> tuple:
+    require_pyarrow()
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(path)
+    settings = json.loads(table.schema.metadata[PARQUET_METADATA_KEY])
+
+    df = table.drop_columns(["centroids"]).to_pandas()
+
+    if centroids:
+        df["centroids"] = get_centroid_arrays(table.column("centroids"))
+
+    return df, settings
+
+
+def get_centroid_arrays(column) -> list[np.ndarray]:
+    """Return the pairs of every row of a centroids column, as 2-dims arrays.
+
+    The pairs of a row group are a 2-dims view of the Arrow buffer of their
+    values, with no copy, and each row gets a slice of them.
+    """
+    arrays = []
+
+    for chunk in column.chunks:
+        offsets = chunk.offsets.to_numpy()
+        pairs = chunk.values.flatten().to_numpy(zero_copy_only=True).reshape(-1, 2)
+        arrays.extend(pairs[offsets[i] : offsets[i + 1]] for i in range(len(chunk)))
+
+    return arrays
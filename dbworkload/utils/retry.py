@@ -0,0 +1,181 @@
+#!/usr/bin/python
+
+"""Retries of the transactions failed by a retryable error.
+
+Which errors are retryable depends on the driver: each driver has a
+classifier in CLASSIFIERS, which tells a transient conflict, such as a
+serialization failure or a deadlock, from an error the workload has to see.
+Classifiers read the error codes carried by the exceptions, so no driver
+module is imported to check an error.
+
+The backoff before each retry grows exponentially from `backoff` up to
+`backoff_max`, with jitter so that the transactions that conflicted don't
+retry in lockstep. With a `budget`, the retries are limited to that ratio of
+the transactions run: under heavy contention, retries would otherwise add to
+the load that caused them.
+"""
+
+import random
+from dataclasses import dataclass
+from threading import Lock
+
+RETRY_JITTERS = ["equal", "full", "none"]
+
+# with a budget, the retries allowed before any transaction ran, and the cap
+# of the retries saved up by the transactions that did not need one
+RETRY_BUDGET_RESERVE = 10
+RETRY_BUDGET_MAX = 100
+
+# SQLSTATE serialization_failure, as returned by CockroachDB, and deadlock_detected
+POSTGRES_RETRYABLE = ("40001", "40P01")
+# ER_LOCK_DEADLOCK and ER_LOCK_WAIT_TIMEOUT
+MYSQL_RETRYABLE = (1213, 1205)
+# ORA-00060 deadlock detected and ORA-08177 can't serialize access
+ORACLE_RETRYABLE = (60, 8177)
+# the errors for which fdb Transaction.on_error() retries a transaction that
+# did not commit: transaction_too_old, future_version, not_committed,
+# process_behind and tag_throttled
+FOUNDATIONDB_RETRYABLE = (1007, 1009, 1020, 1037, 1213)
+
+
+def is_postgres_retryable(e: Exception) -> bool:
+    return getattr(e, "sqlstate", None) in POSTGRES_RETRYABLE
+
+
+def is_mysql_retryable(e: Exception) -> bool:
+    return getattr(e, "errno", None) in MYSQL_RETRYABLE
+
+
+def is_oracle_retryable(e: Exception) -> bool:
+    # oracledb errors carry an _Error object with the ORA code
+    return bool(e.args) and getattr(e.args[0], "code", None) in ORACLE_RETRYABLE
+
+
+def is_spanner_retryable(e: Exception) -> bool:
+    return any(
+        x.__name__ == "Aborted" and x.__module__.startswith("google.api_core")
+        for x in type(e).__mro__
+    )
+
+
+def is_foundationdb_retryable(e: Exception) -> bool:
+    return (
+        type(e).__name__ == "FDBError"
+        and getattr(e, "code", None) in FOUNDATIONDB_RETRYABLE
+    )
+
+
+def is_mongo_retryable(e: Exception) -> bool:
+    has_error_label = getattr(e, "has_error_label", None)
+    return bool(has_error_label) and has_error_label("TransientTransactionError")
+
+
+CLASSIFIERS = {
+    "postgres": is_postgres_retryable,
+    "mysql": is_mysql_retryable,
+    "maria": is_mysql_retryable,
+    "oracle": is_oracle_retryable,
+    "spanner": is_spanner_retryable,
+    "foundationdb": is_foundationdb_retryable,
+    "mongo": is_mongo_retryable,
+}
+
+
+@dataclass
+class RetryPolicy:
+    """How transactions are retried, the same for all the workers of a run.
+
+    `max_retries` is the count of retries after the first attempt. A `budget`
+    of 0 doesn't limit the retries.
+    """
+
+    max_retries: int = 3
+    backoff: float = 0.1
+    backoff_max: float = 5.0
+    jitter: str = "equal"
+    budget: float = 0
+
+    def __post_init__(self):
+        if self.jitter not in RETRY_JITTERS:
+            raise ValueError(
+                f"Unknown retry jitter '{self.jitter}'. "
+                f"The possible values are {', '.join(RETRY_JITTERS)}."
+            )
+
+    def get_delay(self, retry: int) -> float:
+        """Return the seconds to wait before the retry-th retry, from 1."""
+        delay = min(self.backoff_max, self.backoff * 2**retry)
+
+        if self.jitter == "full":
+            return random.uniform(0, delay)
+        elif self.jitter == "equal":
+            return delay / 2 + random.uniform(0, delay / 2)
+
+        return delay
+
+
+class Retrier:
+    """Apply a RetryPolicy for the workers of a process, and count the retries.
+
+    The counters are cumulative since the start of the run, by transaction
+    name: the retries, the seconds waited in backoff, the transactions given
+    up after `max_retries`, and the retries denied by the budget.
+    """
+
+    def __init__(self, driver: str, policy: RetryPolicy = None):
+        self.policy = policy or RetryPolicy()
+        self.classify = CLASSIFIERS.get(driver, lambda e: False)
+        self.lock = Lock()
+        self.balance = RETRY_BUDGET_RESERVE
+        self.counters: dict[str, list] = {}
+
+    def is_retryable(self, e: Exception) -> bool:
+        return self.classify(e)
+
+    def start(self) -> None:
+        """Save up the budget share of a transaction."""
+        if self.policy.budget:
+            with self.lock:
+                self.balance = min(RETRY_BUDGET_MAX, self.balance + self.policy.budget)
+
+    def next_delay(self, name: str, retry: int) -> float | None:
+        """Return the backoff before retrying name, or None to give up.
+
+        `retry` is the count of retries already done for this transaction.
+        """
+        with self.lock:
+            counters = self.counters.setdefault(name, [0, 0.0, 0, 0])
+
+            if retry >= self.policy.max_retries:
+                counters[2] += 1
+                return None
+
+            if self.policy.budget:
+                if self.balance < 1:
+                    counters[3] += 1
+                    return None
+                self.balance -= 1
+
+            delay = self.policy.get_delay(retry + 1)
+            counters[0] += 1
+            counters[1] += delay
+
+        return delay
+
+    def get_counters(self) -> dict[str, list]:
+        """Return [retries, backoff_seconds, exhausted, over_budget] by name."""
+        with self.lock:
+            return {k: list(v) for k, v in self.counters.items()}
+
+
+def merge_counters(counters: list[dict]) -> dict[str, list]:
+    """Sum the counters of several Retriers."""
+    totals = {}
+
+    for x in counters:
+        for name, values in x.items():
+            total = totals.setdefault(name, [0, 0.0, 0, 0])
+            for i, v in enumerate(values):
+                total[i] += v
+
+    return totals
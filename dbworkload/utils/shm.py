@@ -0,0 +1,350 @@
+#!/usr/bin/python
+
+import logging
+import time
+from multiprocessing.shared_memory import SharedMemory
+from threading import Lock
+
+import numpy as np
+
+from . import sketch
+
+logger = logging.getLogger("dbworkload")
+
+STATS_RING_SLOTS = 64
+STATS_RING_ID_SIZE = 128
+STATS_RING_PUT_TIMEOUT = 1.0
+
+# header fields, all int64
+_HEAD = 0
+_TAIL = 1
+_SLOTS = 2
+_OVERFLOWS = 3
+_BACKPRESSURE = 4
+_HIGH_WATERMARK = 5
+_HEADER_LEN = 8
+
+# per-slot metadata fields, all int64
+_COUNT = 0
+_BATCH = 1
+_FLUSHES = 2
+_ID_LEN = 3
+_MORE = 4
+_META_LEN = 5
+
+
+class StatsRing:
+    """Ring buffer of fixed-size t-digest centroid slots in shared memory.
+
+    One ring is created by the MainProcess for every supervisor. The supervisor
+    process is the producer, the MainProcess is the only consumer. Producer
+    threads are serialized with a process-local Lock, so the ring itself is
+    single-producer/single-consumer: only the producer moves `head`, only the
+    consumer moves `tail`. Slot contents are written before `head` is
+    published, so the consumer never sees a half-written batch.
+
+    A batch is the list of `(id, centroids)` tuples of one stats flush and
+    takes one slot per id. Centroids are copied once, straight into the slot,
+    and the consumer reads them through a numpy view: nothing is pickled.
+    As every supervisor merges the reports of its own threads before sending
+    them, a batch is written once per supervisor per stats window, so few
+    slots are enough.
+
+    A flush of more ids than slots is written as consecutive batches of at
+    most `slots` ids, the count of flushes is on the last one. The consumer
+    keeps a copy of the batches before the last, and hands the whole flush
+    over at once.
+    """
+
+    def __init__(self, name: str = None, slots: int = STATS_RING_SLOTS):
+        if name is None:
+            self.shm = SharedMemory(create=True, size=StatsRing.size(slots))
+            self.owner = True
+        else:
+            self.shm = SharedMemory(name=name)
+            self.owner = False
+
+        self._map(slots if self.owner else None)
+        self.lock = Lock()
+        self.pending = []
+
+    @staticmethod
+    def size(slots: int) -> int:
+        return 8 * (
+            _HEADER_LEN
+            + slots * _META_LEN
+            + slots * STATS_RING_ID_SIZE // 8
+            + slots * sketch.MAX_PAIRS * 2
+        )
+
+    def _map(self, slots: int = None) -> None:
+        buf = self.shm.buf
+
+        self.header = np.ndarray((_HEADER_LEN,), dtype=np.int64, buffer=buf)
+        if slots:
+            self.header[:] = 0
+            self.header[_SLOTS] = slots
+
+        self.slots = int(self.header[_SLOTS])
+        offset = self.header.nbytes
+
+        self.meta = np.ndarray(
+            (self.slots, _META_LEN), dtype=np.int64, buffer=buf, offset=offset
+        )
+        offset += self.meta.nbytes
+
+        self.ids = np.ndarray(
+            (self.slots, STATS_RING_ID_SIZE), dtype=np.uint8, buffer=buf, offset=offset
+        )
+        offset += self.ids.nbytes
+
+        self.centroids = np.ndarray(
+            (self.slots, sketch.MAX_PAIRS, 2),
+            dtype=np.float64,
+            buffer=buf,
+            offset=offset,
+        )
+
+    # the ring travels to the supervisor as its shared memory name only
+    def __getstate__(self):
+        return {"name": self.shm.name}
+
+    def __setstate__(self, state):
+        self.shm = SharedMemory(name=state["name"])
+        self.owner = False
+        self._map()
+        self.lock = Lock()
+        self.pending = []
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def put(
+        self,
+        tds: list,
+        flushes: int = 1,
+        timeout=STATS_RING_PUT_TIMEOUT,
+        wake=None,
+    ) -> int | None:
+        """Copy one stats flush into the ring.
+
+        If the consumer is behind, call `wake` to have it drain the ring, and
+        wait up to `timeout` seconds for free slots (backpressure). If the
+        slots are still not available, the rest of the flush is not written
+        (overflow) and the count of ids not written is returned, so the caller
+        can keep them and retry at the next flush. Returns None once the whole
+        flush is written.
+        """
+        with self.lock:
+            sent = 0
+
+            while True:
+                batch = tds[sent : sent + self.slots]
+                last = sent + len(batch) >= len(tds)
+
+                if not self._reserve(max(1, len(batch)), timeout, wake):
+                    self.header[_OVERFLOWS] += 1
+                    return len(tds) - sent
+
+                self._write(batch, flushes if last else 0, not last)
+                sent += len(batch)
+
+                if last:
+                    return None
+
+    def _reserve(self, needed: int, timeout, wake) -> bool:
+        """Wait until `needed` slots are free, return False on timeout."""
+        head = int(self.header[_HEAD])
+
+        if self.slots - (head - int(self.header[_TAIL])) >= needed:
+            return True
+
+        self.header[_BACKPRESSURE] += 1
+        if wake:
+            wake()
+
+        if timeout is None:
+            timeout = STATS_RING_PUT_TIMEOUT
+
+        deadline = time.time() + timeout
+        while self.slots - (head - int(self.header[_TAIL])) < needed:
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.001)
+
+        return True
+
+    def _write(self, batch: list, flushes: int, more: bool) -> None:
+        head = int(self.header[_HEAD])
+        needed = max(1, len(batch))
+
+        for i in range(needed):
+            slot = (head + i) % self.slots
+            meta = self.meta[slot]
+
+            if not batch:
+                # an empty flush still counts as a stats report
+                meta[_COUNT] = -1
+                meta[_ID_LEN] = 0
+                continue
+
+            id, centroids = batch[i]
+            id = id.encode()[:STATS_RING_ID_SIZE]
+            self.ids[slot, : len(id)] = np.frombuffer(id, dtype=np.uint8)
+            meta[_ID_LEN] = len(id)
+
+            n = len(centroids)
+            self.centroids[slot, :n] = centroids
+            meta[_COUNT] = n
+
+        self.meta[head % self.slots, _BATCH] = needed
+        self.meta[head % self.slots, _FLUSHES] = flushes
+        self.meta[head % self.slots, _MORE] = more
+
+        # publish the batch only once every slot has been written
+        self.header[_HEAD] = head + needed
+        self.header[_HIGH_WATERMARK] = max(
+            int(self.header[_HIGH_WATERMARK]),
+            head + needed - int(self.header[_TAIL]),
+        )
+
+    def drain(self, fn) -> int:
+        """Pass every pending flush to `fn` as a list of (id, centroids) tuples.
+
+        The centroids are views into the ring: `fn` must consume them before
+        returning, as the slots are released right after.
+        Returns the count of stats flushes consumed.
+        """
+        flushes = 0
+        tail = int(self.header[_TAIL])
+        head = int(self.header[_HEAD])
+
+        while tail < head:
+            first = tail % self.slots
+            needed = int(self.meta[first, _BATCH])
+
+            batch = []
+            for i in range(needed):
+                slot = (tail + i) % self.slots
+                n = int(self.meta[slot, _COUNT])
+                if n < 0:
+                    continue
+
+                id = bytes(self.ids[slot, : self.meta[slot, _ID_LEN]]).decode(
+                    errors="replace"
+                )
+                batch.append((id, self.centroids[slot, :n]))
+
+            if self.meta[first, _MORE]:
+                # the slots are released before the rest of the flush is read
+                self.pending.extend((id, x.copy()) for id, x in batch)
+            else:
+                flushes += int(self.meta[first, _FLUSHES])
+                fn(self.pending + batch)
+                self.pending = []
+
+            tail += needed
+            self.header[_TAIL] = tail
+
+        return flushes
+
+    def get_counters(self) -> dict:
+        return {
+            "backpressure": int(self.header[_BACKPRESSURE]),
+            "overflows": int(self.header[_OVERFLOWS]),
+            "high_watermark": int(self.header[_HIGH_WATERMARK]),
+        }
+
+    def close(self) -> None:
+        # numpy views hold exported pointers to the buffer and must go first
+        self.header = self.meta = self.ids = self.centroids = None
+        self.shm.close()
+
+        if self.owner:
+            self.shm.unlink()
+
+
+CONTROL_BLOCK_SLOTS = 65536
+
+# control block header fields, all int64
+_GENERATION = 0
+_SHUTDOWN = 1
+_CONTROL_HEADER_LEN = 8
+
+
+class ControlBlock:
+    """Stop flags for the workers of one supervisor, in shared memory.
+
+    One block is created by the MainProcess for every supervisor, like
+    StatsRing. The supervisor is the only writer: it gives every worker it
+    starts a slot, and sets the slot flag to stop that worker, or the shutdown
+    word to stop them all. Every change bumps the generation word, so each
+    worker reads that single word per cycle and only looks at its flag once
+    the generation has moved.
+    """
+
+    def __init__(self, name: str = None):
+        if name is None:
+            self.shm = SharedMemory(
+                create=True, size=8 * _CONTROL_HEADER_LEN + CONTROL_BLOCK_SLOTS
+            )
+            self.owner = True
+        else:
+            self.shm = SharedMemory(name=name)
+            self.owner = False
+
+        self._map()
+
+        if self.owner:
+            self.header[:] = 0
+            self.flags[:] = 0
+
+    def _map(self) -> None:
+        buf = self.shm.buf
+
+        self.header = np.ndarray((_CONTROL_HEADER_LEN,), dtype=np.int64, buffer=buf)
+        self.flags = np.ndarray(
+            (CONTROL_BLOCK_SLOTS,),
+            dtype=np.uint8,
+            buffer=buf,
+            offset=self.header.nbytes,
+        )
+
+    # the block travels to the supervisor as its shared memory name only
+    def __getstate__(self):
+        return {"name": self.shm.name}
+
+    def __setstate__(self, state):
+        self.shm = SharedMemory(name=state["name"])
+        self.owner = False
+        self._map()
+
+    @property
+    def slots(self) -> int:
+        return len(self.flags)
+
+    def generation(self) -> int:
+        return int(self.header[_GENERATION])
+
+    def is_stopped(self, slot: int) -> bool:
+        return bool(self.flags[slot] or self.header[_SHUTDOWN])
+
+    def start(self, slot: int) -> None:
+        self.flags[slot] = 0
+
+    def stop(self, slot: int) -> None:
+        self.flags[slot] = 1
+        self.header[_GENERATION] += 1
+
+    def shutdown(self) -> None:
+        self.header[_SHUTDOWN] = 1
+        self.header[_GENERATION] += 1
+
+    def close(self) -> None:
+        # numpy views hold exported pointers to the buffer and must go first
+        self.header = self.flags = None
+        self.shm.close()
+
+        if self.owner:
+            self.shm.unlink()
@@ -0,0 +1,328 @@
+#!/usr/bin/python
+
+"""Latency sketches, the summaries of the latency measurements of a txn id.
+
+Every sketch is serialized as an array of (value, weight) pairs, which is
+what the stats ring and the CSV files carry, so the backends are
+interchangeable:
+
+- `tdigest`, the default: the pairs are the centroids of a t-digest. It is
+  accurate around the median, but has no error bound at the extreme tail.
+- `hdr`: an HDR histogram with microsecond units, sized so that its
+  buckets fit in MAX_PAIRS. Values are within 1.6% of the exact value, or
+  0.5us below 64us, up to HDR_MAX_VALUE, about 9.5 hours, which the larger
+  values are counted as.
+- `ddsketch`: a DDSketch of 1% relative accuracy.
+
+The `hdr` and `ddsketch` pairs are the representative values and counts of
+their non-empty buckets: merging them is lossless, as each value maps back to
+its bucket. At most MAX_PAIRS buckets are kept: MAX_PAIRS DDSketch buckets
+span a ratio of about 5e8 between the lowest and the highest value, eg 10us
+to an hour. Past that, the lowest buckets are collapsed, so that the
+guarantees hold for the tail.
+
+The backend is process-wide: it is set with `set_backend()` at the start of
+the run, in each process.
+"""
+
+import math
+
+import numpy as np
+from fastdigest import TDigest
+
+from dbworkload.utils import tdigest
+
+SKETCHES = ["tdigest", "hdr", "ddsketch"]
+
+MAX_PAIRS = tdigest.MAX_CENTROIDS
+
+# HDR histogram: 64 sub-buckets per power of 2, half of them used above 64
+# units, keep the values within 1/64 of the exact value. The powers of 2
+# that fit in MAX_PAIRS buckets set the highest value, in seconds.
+HDR_UNIT = 1e-6
+HDR_SUB_BUCKET_BITS = 6
+HDR_SUB_BUCKET_COUNT = 1 << HDR_SUB_BUCKET_BITS
+HDR_SUB_BUCKET_HALF_COUNT = HDR_SUB_BUCKET_COUNT // 2
+HDR_MAX_SHIFT = (MAX_PAIRS - HDR_SUB_BUCKET_COUNT) // HDR_SUB_BUCKET_HALF_COUNT
+HDR_MAX_UNITS = (1 << (HDR_MAX_SHIFT + HDR_SUB_BUCKET_BITS)) - 1
+HDR_MAX_VALUE = HDR_MAX_UNITS * HDR_UNIT
+
+# DDSketch: values below DDSKETCH_MIN_VALUE seconds go to the zero bucket
+DDSKETCH_RELATIVE_ACCURACY = 0.01
+DDSKETCH_MIN_VALUE = 1e-9
+DDSKETCH_ZERO_INDEX = np.iinfo(np.int64).min
+
+
+class TDigestBackend:
+    """The t-digest sketches are fastdigest TDigest objects."""
+
+    name = "tdigest"
+
+    def empty(self) -> TDigest:
+        return TDigest(tdigest.MAX_CENTROIDS)
+
+    def from_values(self, values) -> TDigest:
+        return tdigest.from_values(values)
+
+    def from_pairs(self, pairs) -> TDigest:
+        return tdigest.from_centroids(pairs)
+
+    def pairs(self, sk: TDigest) -> np.ndarray:
+        return tdigest.centroids(sk)
+
+    def combine(self, sketches) -> TDigest:
+        return tdigest.combine(sketches)
+
+    def merge(self, a: TDigest, b: TDigest) -> TDigest:
+        return a.merge(b)
+
+    def count(self, sk: TDigest) -> int:
+        return tdigest.count(sk)
+
+    def mean(self, sk: TDigest) -> float:
+        return sk.mean()
+
+    def quantiles(self, sk: TDigest, qs: list) -> list:
+        return sk.quantile_vec(qs)
+
+    def cdf(self, sk: TDigest, x: float) -> float:
+        return sk.cdf(x)
+
+
+class Buckets:
+    """The non-empty buckets of a histogram, by increasing index."""
+
+    __slots__ = ("index", "counts")
+
+    def __init__(self, index: np.ndarray, counts: np.ndarray):
+        self.index = index
+        self.counts = counts
+
+
+class BucketBackend:
+    """Base class of the histogram sketches.
+
+    Subclasses map values to bucket indexes with `index_of()`, and bucket
+    indexes to their representative value with `value_of()`. Indexes must
+    grow with the values.
+    """
+
+    name = None
+
+    def index_of(self, values: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+    def value_of(self, index: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+    def empty(self) -> Buckets:
+        return Buckets(np.empty(0, dtype=np.int64), np.empty(0, dtype=float))
+
+    def build(self, index: np.ndarray, counts: np.ndarray) -> Buckets:
+        index, inverse = np.unique(index, return_inverse=True)
+        counts = np.bincount(inverse, weights=counts, minlength=len(index))
+
+        # collapse the lowest buckets into the lowest one kept
+        if len(index) > MAX_PAIRS:
+            cut = len(index) - MAX_PAIRS
+            counts[cut] += counts[:cut].sum()
+            index, counts = index[cut:], counts[cut:]
+
+        return Buckets(index, counts)
+
+    def from_values(self, values) -> Buckets:
+        values = np.asarray(values, dtype=float)
+        return self.build(self.index_of(values), np.ones(len(values)))
+
+    def from_pairs(self, pairs) -> Buckets:
+        arr = np.asarray(pairs, dtype=float)
+
+        if arr.size == 0:
+            return self.empty()
+
+        arr = np.atleast_2d(arr)
+        return self.build(self.index_of(arr[:, 0]), arr[:, 1])
+
+    def pairs(self, sk: Buckets) -> np.ndarray:
+        return np.column_stack((self.value_of(sk.index), sk.counts))
+
+    def combine(self, sketches) -> Buckets:
+        sketches = list(sketches)
+
+        if not sketches:
+            return self.empty()
+
+        return self.build(
+            np.concatenate([x.index for x in sketches]),
+            np.concatenate([x.counts for x in sketches]),
+        )
+
+    def merge(self, a: Buckets, b: Buckets) -> Buckets:
+        return self.combine([a, b])
+
+    def count(self, sk: Buckets) -> int:
+        return int(sk.counts.sum())
+
+    def mean(self, sk: Buckets) -> float:
+        total = sk.counts.sum()
+        if not total:
+            return math.nan
+
+        return float((self.value_of(sk.index) * sk.counts).sum() / total)
+
+    def quantiles(self, sk: Buckets, qs: list) -> list:
+        total = sk.counts.sum()
+        if not total:
+            return [math.nan] * len(qs)
+
+        # the value of the bucket holding the ceil(q * count)-th measurement
+        ranks = np.clip(np.ceil(np.asarray(qs) * total), 1, total)
+        i = np.searchsorted(np.cumsum(sk.counts), ranks)
+        i = np.minimum(i, len(sk.index) - 1)
+
+        return self.value_of(sk.index[i]).tolist()
+
+    def cdf(self, sk: Buckets, x: float) -> float:
+        total = sk.counts.sum()
+        if not total:
+            return math.nan
+
+        return float(sk.counts[self.value_of(sk.index) <= x].sum() / total)
+
+
+class HDRBackend(BucketBackend):
+    """HDR histogram: linear sub-buckets within exponential buckets.
+
+    Values are counted in HDR_UNIT. The values below HDR_SUB_BUCKET_COUNT
+    units have a bucket each, above that, every power of 2 is split in
+    HDR_SUB_BUCKET_HALF_COUNT buckets. The values above HDR_MAX_UNITS are
+    counted in the highest bucket, so there are at most MAX_PAIRS buckets.
+    """
+
+    name = "hdr"
+
+    def index_of(self, values: np.ndarray) -> np.ndarray:
+        units = np.clip(np.floor(values / HDR_UNIT), 0, HDR_MAX_UNITS).astype(np.int64)
+
+        # the bit length of the values, exact below 2**53
+        _, bits = np.frexp(units.astype(float))
+        shift = np.maximum(bits.astype(np.int64) - HDR_SUB_BUCKET_BITS, 0)
+        sub = units >> shift
+
+        return np.where(
+            shift > 0,
+            HDR_SUB_BUCKET_COUNT
+            + (shift - 1) * HDR_SUB_BUCKET_HALF_COUNT
+            + (sub - HDR_SUB_BUCKET_HALF_COUNT),
+            units,
+        )
+
+    def value_of(self, index: np.ndarray) -> np.ndarray:
+        index = np.asarray(index, dtype=np.int64)
+
+        above = index >= HDR_SUB_BUCKET_COUNT
+        shift = np.where(
+            above, (index - HDR_SUB_BUCKET_COUNT) // HDR_SUB_BUCKET_HALF_COUNT + 1, 0
+        )
+        sub = np.where(
+            above,
+            (index - HDR_SUB_BUCKET_COUNT) % HDR_SUB_BUCKET_HALF_COUNT
+            + HDR_SUB_BUCKET_HALF_COUNT,
+            index,
+        )
+
+        # the middle of the bucket, which maps back to the same bucket
+        width = np.left_shift(1, shift)
+        return ((sub << shift) + width / 2) * HDR_UNIT
+
+
+class DDSketchBackend(BucketBackend):
+    """DDSketch: buckets of logarithmic width, for a fixed relative error."""
+
+    name = "ddsketch"
+
+    def __init__(self, relative_accuracy: float = DDSKETCH_RELATIVE_ACCURACY):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+
+    def index_of(self, values: np.ndarray) -> np.ndarray:
+        positive = values > DDSKETCH_MIN_VALUE
+        index = np.ceil(
+            np.log(np.where(positive, values, 1.0)) / self.log_gamma
+        ).astype(np.int64)
+
+        return np.where(positive, index, DDSKETCH_ZERO_INDEX)
+
+    def value_of(self, index: np.ndarray) -> np.ndarray:
+        index = np.asarray(index, dtype=np.int64)
+        zero = index == DDSKETCH_ZERO_INDEX
+
+        # the value within relative_accuracy of all the values of the bucket
+        value = 2 * np.exp(np.where(zero, 0, index) * self.log_gamma) / (self.gamma + 1)
+        return np.where(zero, 0.0, value)
+
+
+BACKENDS = {
+    "tdigest": TDigestBackend,
+    "hdr": HDRBackend,
+    "ddsketch": DDSketchBackend,
+}
+
+backend = TDigestBackend()
+
+
+def set_backend(name: str) -> None:
+    """Select the sketch used by this process."""
+    global backend
+
+    if name not in BACKENDS:
+        raise ValueError(
+            f"Unknown sketch '{name}'. The possible values are {', '.join(SKETCHES)}."
+        )
+
+    if backend.name != name:
+        backend = BACKENDS[name]()
+
+
+def get_backend() -> str:
+    return backend.name
+
+
+def empty():
+    return backend.empty()
+
+
+def from_values(values):
+    return backend.from_values(values)
+
+
+def from_pairs(pairs):
+    return backend.from_pairs(pairs)
+
+
+def pairs(sk) -> np.ndarray:
+    return backend.pairs(sk)
+
+
+def combine(sketches):
+    return backend.combine(sketches)
+
+
+def merge(a, b):
+    return backend.merge(a, b)
+
+
+def count(sk) -> int:
+    return backend.count(sk)
+
+
+def mean(sk) -> float:
+    return backend.mean(sk)
+
+
+def quantiles(sk, qs: list) -> list:
+    return backend.quantiles(sk, qs)
+
+
+def cdf(sk, x: float) -> float:
+    return backend.cdf(sk, x)
@@ -23,7 +23,14 @@ def from_centroids(centroids) -> TDigest:
 
 
 def combine(digests) -> TDigest:
-    return merge_all(list(digests))
+    td = merge_all(list(digests))
+
+    # merging can overshoot max_centroids by a few centroids, which then
+    # wouldn't fit the fixed-size slots of the stats ring
+    if td.n_centroids > MAX_CENTROIDS:
+        return from_centroids(centroids(td))
+
+    return td
 
 
 def centroids(td: TDigest) -> np.ndarray:
@@ -0,0 +1,60 @@
+import inspect
+import random
+
+
+class Bench:
+    """Benchmark workload for the mock driver.
+
+    It measures dbworkload itself: the statements only wait for the latency
+    configured in the mock driver URI. It works with all runtimes, including
+    asyncio.
+    """
+
+    def __init__(self, args: dict):
+        # args is a dict of string passed with the --args flag
+
+        # Percentage of read transactions compared to write transactions
+        self.read_pct: float = float(args.get("read_pct", 50) / 100)
+
+        # count of statements executed by each transaction
+        self.stmts_per_txn: int = int(args.get("stmts_per_txn", 1))
+
+        self.is_async = False
+
+    # the setup() function is executed only once
+    # when a new executing thread is started.
+    def setup(self, conn, id: int, total_thread_count: int):
+        # the asyncio runtime passes an async connection
+        self.is_async = inspect.iscoroutinefunction(conn.execute)
+
+    def loop(self):
+        if random.random() < self.read_pct:
+            return [self.txn_read]
+        return [self.txn_write]
+
+    def execute(self, conn, stmt: str, params: tuple, commit: bool = False):
+        # with an async connection, return a coroutine for dbworkload to await
+        if self.is_async:
+            return self.execute_async(conn, stmt, params, commit)
+
+        for _ in range(self.stmts_per_txn):
+            conn.execute(stmt, params)
+        if commit:
+            conn.commit()
+
+    async def execute_async(self, conn, stmt: str, params: tuple, commit: bool):
+        for _ in range(self.stmts_per_txn):
+            await conn.execute(stmt, params)
+        if commit:
+            await conn.commit()
+
+    def txn_read(self, conn):
+        return self.execute(conn, "SELECT v FROM kv WHERE k = %s", (random.random(),))
+
+    def txn_write(self, conn):
+        return self.execute(
+            conn,
+            "UPSERT INTO kv (k, v) VALUES (%s, %s)",
+            (random.random(), 0),
+            commit=True,
+        )